@@ -0,0 +1,306 @@
+"""Activity log of changes to songs and setlists, written in the background.
+
+Views record who changed which song or setlist, and how, with log_activity(),
+which only appends the event to an in-memory buffer, so logging costs a
+request no database round trip. A flusher thread in each process writes the
+buffer out every ACTIVITY_FLUSH_INTERVAL seconds, or as soon as
+ACTIVITY_BATCH_SIZE events are waiting, in one transaction of multi-row
+INSERTs per batch.
+
+The buffer holds ACTIVITY_MAX_PENDING events, besides a batch being retried.
+When it's full (the database is slow or down), log_activity() waits up to
+ACTIVITY_MAX_WAIT seconds for the flusher to make room, holding back the
+views producing events, and then drops the event rather than hold up the
+request any longer.
+A batch the database refuses is retried at the next flush, and dropped after
+ACTIVITY_MAX_ATTEMPTS tries. Every event is counted in /metrics
+(setlist_activity_events_total) as queued, then as written, dropped or
+failed, so any gap in a history is accounted for. Events still buffered when
+a process exits are flushed on the way out; a killed process loses them.
+
+With an in-memory database, which a flusher thread can't share, events are
+written instead whenever a history is read.
+"""
+
+import atexit
+import json
+import logging
+import os
+import threading
+import time
+from collections import deque
+from datetime import datetime
+
+from flask import g
+from sqlalchemy import inspect
+from sqlalchemy.orm import joinedload
+
+from metrics import metrics
+from models import db, ActivityEvent
+
+logger = logging.getLogger("setlist.activity")
+
+# Rows per INSERT, which keeps each statement under SQLite's parameter limit.
+INSERT_ROWS = 100
+
+settings = {
+    "background": True,
+    "flush_interval": 1.0,
+    "batch_size": 500,
+    "max_pending": 10000,
+    "max_wait": 0.05,
+    "max_attempts": 3,
+}
+
+
+class ActivityBuffer:
+    """The events waiting to be written, and the thread writing them."""
+
+    def __init__(self):
+        self.events = deque()
+        # Guards events; producers and the flusher wait on it for each other.
+        self.condition = threading.Condition()
+        # Held while writing, so batches are written one at a time, in order.
+        self.write_lock = threading.Lock()
+        self.attempts = 0
+        self.dropping = False
+        self.flusher = None
+        self.flusher_pid = None
+
+    def put(self, event):
+        """Queues an event, waiting briefly for room. Returns False if it was dropped."""
+
+        if settings["background"]:
+            self.start_flusher()
+
+        with self.condition:
+            if len(self.events) >= settings["max_pending"] and settings["background"]:
+                self.condition.notify_all()
+                self.condition.wait_for(
+                    lambda: len(self.events) < settings["max_pending"],
+                    settings["max_wait"],
+                )
+
+            queued = len(self.events) < settings["max_pending"]
+
+            if queued:
+                self.events.append(event)
+
+                if len(self.events) >= settings["batch_size"]:
+                    self.condition.notify_all()
+            elif not self.dropping:
+                self.dropping = True
+                logger.warning("Activity log buffer full; dropping events")
+
+        metrics.record_activity("queued" if queued else "dropped")
+        return queued
+
+    def take(self, limit):
+        """Removes and returns up to limit of the oldest events."""
+
+        with self.condition:
+            batch = [self.events.popleft() for _ in range(min(limit, len(self.events)))]
+
+            if batch:
+                self.dropping = False
+                self.condition.notify_all()
+
+        return batch
+
+    def give_back(self, batch):
+        """Returns a batch that couldn't be written to the front of the buffer."""
+
+        with self.condition:
+            self.events.extendleft(reversed(batch))
+
+    def pending(self):
+        """Returns the number of events waiting to be written."""
+
+        with self.condition:
+            return len(self.events)
+
+    def flush(self):
+        """Writes every buffered event now. Returns the number written.
+
+        Stops early, leaving the rest buffered, if the database refuses a
+        batch."""
+
+        written = 0
+
+        with self.write_lock:
+            while True:
+                batch = self.take(settings["batch_size"])
+                count = self.write(batch) if batch else None
+
+                if count is None:
+                    return written
+
+                written += count
+
+    def write(self, batch):
+        """Inserts a batch of events, returning the number written.
+
+        Returns None if the batch has been put back to be retried."""
+
+        table = ActivityEvent.__table__
+
+        try:
+            with db.engine.begin() as connection:
+                for start in range(0, len(batch), INSERT_ROWS):
+                    connection.execute(
+                        table.insert().values(batch[start : start + INSERT_ROWS])
+                    )
+        except Exception as error:
+            # Not the statement, which holds every event's parameters.
+            reason = getattr(error, "orig", error)
+            self.attempts += 1
+
+            if self.attempts < settings["max_attempts"]:
+                logger.warning(
+                    "Couldn't write %d activity events, retrying later: %r",
+                    len(batch),
+                    reason,
+                )
+                self.give_back(batch)
+                return None
+
+            logger.error(
+                "Couldn't write %d activity events, dropping them: %r",
+                len(batch),
+                reason,
+            )
+            self.attempts = 0
+            metrics.record_activity("failed", len(batch))
+            return 0
+
+        self.attempts = 0
+        metrics.record_activity("written", len(batch))
+        return len(batch)
+
+    def start_flusher(self):
+        """Starts this process's flusher thread, unless it's running."""
+
+        # A forked worker inherits the buffer but not the thread.
+        if self.flusher_pid == os.getpid() and self.flusher.is_alive():
+            return
+
+        with self.condition:
+            if self.flusher_pid == os.getpid() and self.flusher.is_alive():
+                return
+
+            self.flusher = threading.Thread(
+                target=self.run, name="activity-flusher", daemon=True
+            )
+            self.flusher_pid = os.getpid()
+            self.flusher.start()
+
+    def run(self):
+        """Flushes the buffer whenever a batch is ready or the interval passes."""
+
+        while True:
+            with self.condition:
+                self.condition.wait_for(
+                    lambda: len(self.events) >= settings["batch_size"],
+                    settings["flush_interval"],
+                )
+
+            try:
+                self.flush()
+            except Exception:
+                logger.exception("Activity log flusher failed")
+
+            if self.attempts:
+                # The database refused the last batch; give it time.
+                time.sleep(settings["flush_interval"])
+
+
+buffer = ActivityBuffer()
+
+
+def log_activity(action, song_id=None, setlist_id=None, **details):
+    """Logs that the current user did something to a song or setlist.
+
+    Call it once the change has committed. Details (any that aren't empty)
+    are stored as JSON."""
+
+    details = {name: value for name, value in details.items() if value}
+    user = g.get("user")
+
+    return buffer.put(
+        {
+            "created_at": datetime.utcnow(),
+            # The user's id, without reloading them after the commit.
+            "user_id": inspect(user).identity[0] if user else None,
+            "song_id": song_id,
+            "setlist_id": setlist_id,
+            "action": action,
+            "details": json.dumps(details, sort_keys=True) if details else None,
+        }
+    )
+
+
+def changed_fields(instance, **values):
+    """Returns the names of the fields given new values that differ from instance's.
+
+    A None value means the field isn't being changed; an empty one matches a
+    missing one."""
+
+    return [
+        name
+        for name, value in values.items()
+        if value is not None and (getattr(instance, name) or "") != value
+    ]
+
+
+def song_op_counts(ops):
+    """Returns how many songs a list of setlist song ops inserts, moves and removes."""
+
+    counts = {}
+
+    for op in ops:
+        counts[op["op"]] = counts.get(op["op"], 0) + 1
+
+    return counts
+
+
+def activity_history(song_id=None, setlist_id=None):
+    """Returns a query of the events about a song or setlist, newest first.
+
+    Without a flusher thread, writes the buffered events first."""
+
+    if not settings["background"]:
+        buffer.flush()
+
+    if song_id is not None:
+        criterion = ActivityEvent.song_id == song_id
+    else:
+        criterion = ActivityEvent.setlist_id == setlist_id
+
+    return (
+        ActivityEvent.query.options(joinedload(ActivityEvent.user))
+        .filter(criterion)
+        .order_by(ActivityEvent.created_at.desc(), ActivityEvent.id.desc())
+    )
+
+
+def init_activity(app):
+    """Sets up the activity log for the Flask app."""
+
+    in_memory = app.config["SQLALCHEMY_DATABASE_URI"] in (
+        "sqlite://",
+        "sqlite:///:memory:",
+    )
+
+    # A flusher thread can't see an in-memory database.
+    settings["background"] = not in_memory
+
+    for name in (
+        "flush_interval",
+        "batch_size",
+        "max_pending",
+        "max_wait",
+        "max_attempts",
+    ):
+        settings[name] = app.config.get(f"ACTIVITY_{name.upper()}", settings[name])
+
+    atexit.register(buffer.flush)
@@ -1,8 +1,11 @@
 import os
 import requests
 
+from datetime import datetime
+
 from flask import (
     Flask,
+    abort,
     render_template,
     request,
     flash,
@@ -13,7 +16,10 @@ from flask import (
     g,
 )
 from flask_debugtoolbar import DebugToolbarExtension
+from flask_sqlalchemy import Pagination
+from sqlalchemy import and_, case, func
 from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import joinedload, selectinload
 
 from forms import (
     UserAddForm,
@@ -25,7 +31,40 @@ from forms import (
     SetlistChangeSongsForm,
     SearchForm,
 )
-from models import db, connect_db, User, Song, Setlist, SetlistSong
+from models import (
+    db,
+    connect_db,
+    User,
+    Song,
+    SongLyrics,
+    CanonicalSong,
+    CanonicalLyrics,
+    Setlist,
+    SetlistSong,
+    UserStats,
+    apply_text_delta,
+    binary_collation,
+    text_delta,
+    song_list_ops,
+    ORDER_GAP,
+)
+from metrics import init_metrics
+from querylog import init_querylog
+from migrations import init_migrations, init_schema
+from livesync import init_livesync, publish_setlist_event, setlist_event_response
+from replicas import init_replicas, reads_from_replica
+from compression import init_compression
+from catalog import current_snapshot, init_catalog
+from export import export_response, init_export, parse_formats
+from stats import init_stats, largest_catalogs, latest_refresh, top_artists, top_songs
+from ratelimit import init_ratelimit
+from activity import (
+    activity_history,
+    changed_fields,
+    init_activity,
+    log_activity,
+    song_op_counts,
+)
 
 CURR_USER_KEY = "curr_user"
 LYRICS_API_KEY = os.environ.get("LYRICS_API_KEY", "no_key")
@@ -36,15 +75,99 @@ app.config["SQLALCHEMY_DATABASE_URI"] = os.environ.get(
     "DATABASE_URL", "postgres:///setlist-manager"
 )
 
+# Read replicas, as a comma-separated list of database URLs (see replicas.py).
+app.config["SQLALCHEMY_BINDS"] = {
+    f"replica{number}": url.strip()
+    for number, url in enumerate(
+        filter(None, os.environ.get("DATABASE_REPLICA_URLS", "").split(",")), start=1
+    )
+}
+app.config["REPLICA_LAG_WINDOW"] = float(os.environ.get("REPLICA_LAG_WINDOW", 5))
 app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
 app.config["SQLALCHEMY_ECHO"] = False
 app.config["DEBUG_TB_INTERCEPT_REDIRECTS"] = False
 app.config["SECRET_KEY"] = os.environ.get("SECRET_KEY", "hunter2")
+app.config["BCRYPT_LOG_ROUNDS"] = int(os.environ.get("BCRYPT_LOG_ROUNDS", 12))
 toolbar = DebugToolbarExtension(app)
 app.config["ITEMS_PER_PAGE"] = 20
+app.config["MAX_SEARCH_RESULTS"] = int(os.environ.get("MAX_SEARCH_RESULTS", 500))
+app.config["AUTOCOMPLETE_MAX_RESULTS"] = 20
+app.config["AUTOCOMPLETE_MAX_AGE"] = int(os.environ.get("AUTOCOMPLETE_MAX_AGE", 300))
+app.config["METRICS_ENABLED"] = os.environ.get("METRICS_ENABLED", "1") == "1"
+app.config["QUERY_LOG_ENABLED"] = os.environ.get("QUERY_LOG_ENABLED", "1") == "1"
+app.config["QUERY_LOG_PATH"] = os.environ.get("QUERY_LOG_PATH")
+app.config["SLOW_QUERY_THRESHOLD_MS"] = float(
+    os.environ.get("SLOW_QUERY_THRESHOLD_MS", 100)
+)
+app.config["N_PLUS_ONE_THRESHOLD"] = int(os.environ.get("N_PLUS_ONE_THRESHOLD", 5))
+app.config["LYRICS_COMPRESS_OVER"] = (
+    int(os.environ["LYRICS_COMPRESS_OVER"])
+    if os.environ.get("LYRICS_COMPRESS_OVER")
+    else None
+)
+app.config["LIVE_SYNC_BROKER"] = os.environ.get(
+    "LIVE_SYNC_BROKER",
+    (
+        "postgres"
+        if app.config["SQLALCHEMY_DATABASE_URI"].startswith("postgres")
+        else "memory"
+    ),
+)
+app.config["LIVE_SYNC_KEEPALIVE"] = float(os.environ.get("LIVE_SYNC_KEEPALIVE", 15))
+app.config["LYRICS_API_URL"] = os.environ.get(
+    "LYRICS_API_URL", "https://orion.apiseeds.com/api/music/lyric/"
+)
+app.config["LYRICS_API_TIMEOUT"] = float(os.environ.get("LYRICS_API_TIMEOUT", 10))
+app.config["COMPRESS_ENABLED"] = os.environ.get("COMPRESS_ENABLED", "1") == "1"
+app.config["COMPRESS_MIN_SIZE"] = int(os.environ.get("COMPRESS_MIN_SIZE", 500))
+app.config["COMPRESS_GZIP_LEVEL"] = int(os.environ.get("COMPRESS_GZIP_LEVEL", 6))
+app.config["COMPRESS_BROTLI_LEVEL"] = int(os.environ.get("COMPRESS_BROTLI_LEVEL", 4))
+app.config["COMPRESS_CACHE_SIZE"] = int(os.environ.get("COMPRESS_CACHE_SIZE", 256))
+# Where to keep the shared catalog snapshot; empty to turn it off (catalog.py).
+app.config["CATALOG_PATH"] = os.environ.get("CATALOG_PATH")
+app.config["CATALOG_REBUILD"] = os.environ.get("CATALOG_REBUILD", "background")
+app.config["STATS_MAX_AGE"] = int(os.environ.get("STATS_MAX_AGE", 300))
+app.config["STATS_REFRESH"] = os.environ.get("STATS_REFRESH", "background")
+app.config["STATS_TOP"] = 20
+app.config["CATALOG_CHANGE_WINDOW"] = int(os.environ.get("CATALOG_CHANGE_WINDOW", 600))
+# The activity log's write buffer (see activity.py).
+app.config["ACTIVITY_FLUSH_INTERVAL"] = float(
+    os.environ.get("ACTIVITY_FLUSH_INTERVAL", 1)
+)
+app.config["ACTIVITY_BATCH_SIZE"] = 500
+app.config["ACTIVITY_MAX_PENDING"] = int(os.environ.get("ACTIVITY_MAX_PENDING", 10000))
+app.config["ACTIVITY_MAX_WAIT"] = float(os.environ.get("ACTIVITY_MAX_WAIT", 0.05))
+app.config["ACTIVITY_MAX_ATTEMPTS"] = 3
+# Token-bucket rate limits by endpoint name or pattern (see ratelimit.py).
+app.config["RATE_LIMIT_ENABLED"] = os.environ.get("RATE_LIMIT_ENABLED", "1") == "1"
+app.config["RATE_LIMIT_STORAGE_URL"] = os.environ.get("RATE_LIMIT_STORAGE_URL")
+app.config["RATE_LIMIT_PROXIES"] = int(os.environ.get("RATE_LIMIT_PROXIES", 0))
+app.config["RATE_LIMIT_SESSION_KEY"] = CURR_USER_KEY
+app.config["RATE_LIMITS"] = {
+    "get_songs_in_setlist": [("user", "120/minute")],
+    "update_setlist": [("user", "60/minute")],
+    "patch_setlist": [("user", "60/minute")],
+    "do_search": [("user", "30/minute"), ("ip", "120/minute")],
+    "fetch_lyrics": [
+        ("user", "10/minute"),
+        ("endpoint", os.environ.get("LYRICS_API_RATE_LIMIT", "1000/day")),
+    ],
+    "api_*": [("user", "300/minute")],
+}
 
 connect_db(app)
-db.create_all()
+init_metrics(app)
+init_ratelimit(app)
+init_querylog(app)
+init_migrations(app)
+init_livesync(app)
+init_replicas(app)
+init_compression(app)
+init_catalog(app)
+init_export(app)
+init_stats(app)
+init_activity(app)
+init_schema()
 
 ############################################################
 # Error-handling
@@ -189,6 +312,7 @@ def show_home():
 
 
 @app.route("/users/<int:user_id>")
+@reads_from_replica
 def show_user(user_id):
     """Shows a user."""
 
@@ -263,6 +387,25 @@ def show_my_setlists():
     return render_template("your-setlists.html")
 
 
+@app.route("/your-setlists/export")
+def export_my_setlists():
+    """Downloads the user's setlists, with lyrics, as a ZIP archive to use offline.
+
+    ?formats=html,md,json picks the formats included (all by default)."""
+
+    if not g.user:
+        flash("You're not logged in!", "danger")
+        return redirect("/")
+
+    try:
+        formats = parse_formats(request.args.get("formats"))
+    except ValueError as error:
+        flash(str(error), "danger")
+        return redirect("/your-setlists")
+
+    return export_response(g.user, formats)
+
+
 @app.route("/your-songs")
 def show_my_songs():
     """Shows the songs of the currently logged-in user."""
@@ -280,14 +423,37 @@ def show_my_songs():
 # Songs
 
 
+def in_catalog_order(query):
+    """Orders a query of songs as the catalog snapshot lists them, by normalized
+    title (ignoring case and accents), then id."""
+
+    return query.outerjoin(Song.canonical).order_by(
+        binary_collation(CanonicalSong.title_key), Song.id
+    )
+
+
 @app.route("/songs")
+@reads_from_replica
 def show_all_songs():
     """Shows a list of every song in the database."""
 
     page = request.args.get("page", 1, type=int)
-    songs = Song.query.order_by(Song.title.asc()).paginate(
-        page, app.config["ITEMS_PER_PAGE"], False
-    )
+    per_page = app.config["ITEMS_PER_PAGE"]
+    snapshot = current_snapshot()
+
+    if snapshot is not None:
+        page = max(page, 1)
+        start = (page - 1) * per_page
+        songs = Pagination(
+            None,
+            page,
+            per_page,
+            len(snapshot),
+            snapshot.by_title(start, start + per_page),
+        )
+    else:
+        songs = in_catalog_order(Song.query).paginate(page, per_page, False)
+
     next_url = f"/songs?page={songs.next_num}" if songs.has_next else None
     prev_url = f"/songs?page={songs.prev_num}" if songs.has_prev else None
     return render_template(
@@ -319,10 +485,11 @@ def add_song():
 
 
 @app.route("/songs/<int:song_id>")
+@reads_from_replica
 def view_song(song_id):
     """Views a song."""
 
-    song = Song.query.get_or_404(song_id)
+    song = Song.query.options(*Song.with_lyrics).get_or_404(song_id)
 
     return render_template("show-song.html", song=song)
 
@@ -331,21 +498,27 @@ def view_song(song_id):
 def update_song(song_id):
     """Updates a song."""
 
-    song = Song.query.get_or_404(song_id)
+    song = Song.query.options(*Song.with_lyrics).get_or_404(song_id)
     form = SongUpdateForm(obj=song)
 
     if form.validate_on_submit():
         new_title = form.title.data
         new_artist = form.artist.data
         new_lyrics = form.lyrics.data
+        fields = changed_fields(
+            song, title=new_title, artist=new_artist, lyrics=new_lyrics
+        )
 
-        song.title = new_title
-        song.artist = new_artist
+        song.rename(new_title, new_artist)
         song.lyrics = new_lyrics
 
         db.session.add(song)
+        Setlist.refresh_summaries(Setlist.songs.any(Song.id == song.id), touch=False)
         db.session.commit()
 
+        if fields:
+            log_activity("song.update", song_id=song_id, fields=fields)
+
         return redirect(f"/songs/{song_id}")
 
     return render_template("update-song.html", song=song, form=form)
@@ -366,9 +539,15 @@ def fetch_lyrics(song_id):
         flash("You don't have permission to edit that song.", "danger")
         return redirect("/")
 
-    base_api_url = "https://orion.apiseeds.com/api/music/lyric/"
+    base_api_url = app.config["LYRICS_API_URL"]
     specific_api_url = f"{song.artist}/{song.title}?apikey={LYRICS_API_KEY}"
-    res = requests.get(base_api_url + specific_api_url).json()
+
+    try:
+        res = requests.get(
+            base_api_url + specific_api_url, timeout=app.config["LYRICS_API_TIMEOUT"]
+        ).json()
+    except (requests.RequestException, ValueError):
+        res = {"error": "Lyrics API unavailable"}
 
     if res.get("error"):
         flash("Lyrics could not be imported; try manually entering lyrics.", "danger")
@@ -377,11 +556,27 @@ def fetch_lyrics(song_id):
         new_lyrics = res.get("result").get("track").get("text")
         song.lyrics = new_lyrics
         db.session.add(song)
+        Setlist.refresh_summaries(Setlist.songs.any(Song.id == song.id), touch=False)
         db.session.commit()
+        log_activity("song.fetch_lyrics", song_id=song_id)
         flash("Lyrics successfully imported!", "success")
         return redirect(f"/songs/{song_id}/update")
 
 
+@app.route("/songs/<int:song_id>/history")
+@reads_from_replica
+def show_song_history(song_id):
+    """Shows who has changed a song, and how, newest first."""
+
+    song = Song.query.get_or_404(song_id)
+
+    return render_history(
+        activity_history(song_id=song_id),
+        f"{song.title} by {song.artist}",
+        f"/songs/{song_id}",
+    )
+
+
 @app.route("/songs/<int:song_id>/delete", methods=["GET", "POST"])
 def del_song(song_id):
     """Deletes a song from the database."""
@@ -396,7 +591,7 @@ def del_song(song_id):
         return redirect(f"/songs/{song_id}")
 
     if request.method == "POST":
-        db.session.delete(song)
+        Song.delete_where(Song.id == song_id)
         db.session.commit()
         flash("Song deleted successfully!", "success")
         return redirect("/your-songs")
@@ -409,13 +604,16 @@ def del_song(song_id):
 
 
 @app.route("/setlists")
+@reads_from_replica
 def show_all_setlists():
     """Shows a list of every setlist in the database."""
 
     page = request.args.get("page", 1, type=int)
 
-    setlists = Setlist.query.order_by(Setlist.name.asc()).paginate(
-        page, app.config["ITEMS_PER_PAGE"], False
+    setlists = (
+        Setlist.query.options(joinedload(Setlist.user))
+        .order_by(Setlist.name.asc())
+        .paginate(page, app.config["ITEMS_PER_PAGE"], False)
     )
 
     next_url = f"/setlists?page={setlists.next_num}" if setlists.has_next else None
@@ -451,12 +649,48 @@ def add_setlist():
 
 
 @app.route("/setlists/<int:setlist_id>")
+@reads_from_replica
 def show_setlist(setlist_id):
     """Shows a setlist."""
 
     setlist = Setlist.query.get_or_404(setlist_id)
 
-    return render_template("show-setlist.html", setlist=setlist)
+    return render_template(
+        "show-setlist.html",
+        setlist=setlist,
+        live_songs=[song.serialize() for song in setlist.songs],
+    )
+
+
+@app.route("/setlists/<int:setlist_id>/history")
+@reads_from_replica
+def show_setlist_history(setlist_id):
+    """Shows who has changed a setlist, and how, newest first."""
+
+    setlist = Setlist.query.get_or_404(setlist_id)
+
+    return render_history(
+        activity_history(setlist_id=setlist_id), setlist.name, f"/setlists/{setlist_id}"
+    )
+
+
+def render_history(events, name, url):
+    """Renders a page of the activity log of the song or setlist at url."""
+
+    page = request.args.get("page", 1, type=int)
+    events = events.paginate(page, app.config["ITEMS_PER_PAGE"], False)
+
+    next_url = f"{url}/history?page={events.next_num}" if events.has_next else None
+    prev_url = f"{url}/history?page={events.prev_num}" if events.has_prev else None
+
+    return render_template(
+        "history.html",
+        name=name,
+        url=url,
+        events=events.items,
+        next_url=next_url,
+        prev_url=prev_url,
+    )
 
 
 @app.route("/setlists/<int:setlist_id>/edit")
@@ -498,64 +732,233 @@ def del_setlist(setlist_id):
     return render_template("/del-setlist.html", setlist=setlist)
 
 
+@app.route("/setlists/<int:setlist_id>/clone", methods=["POST"])
+def clone_setlist(setlist_id):
+    """Copies a setlist, with its notes and songs, and opens the copy's editor."""
+
+    if not g.user:
+        flash("You must be logged in to copy a setlist.", "danger")
+        return redirect(f"/setlists/{setlist_id}")
+
+    setlist = Setlist.query.get_or_404(setlist_id)
+    if setlist.user_id != g.user.id:
+        flash("You can't copy someone else's setlist.", "danger")
+        return redirect(f"/setlists/{setlist_id}")
+
+    (copy,) = Setlist.clone([setlist_id], g.user.id)
+    db.session.commit()
+
+    flash("Setlist copied successfully!", "success")
+    return redirect(f"/setlists/{copy.id}/edit")
+
+
 @app.route("/setlists/<int:setlist_id>/perform/<int:active_song_id>")
 def perform_setlist(setlist_id, active_song_id):
-    """For performing from a setlist; shows songs, current song, lyrics"""
+    """For performing from a setlist; shows songs, current song, lyrics.
+
+    With ?mode=lead, the setlist's owner moves everyone following along with
+    ?mode=follow to each song they open."""
 
     setlist = Setlist.query.get_or_404(setlist_id)
-    active_song = Song.query.get_or_404(active_song_id)
+    active_song = Song.query.options(*Song.with_lyrics).get_or_404(active_song_id)
+    mode = request.args.get("mode")
+    is_owner = g.user and g.user.id == setlist.user_id
 
-    return render_template("perform.html", setlist=setlist, active_song=active_song)
+    if mode not in ("lead", "follow") or (mode == "lead" and not is_owner):
+        mode = None
+
+    return render_template(
+        "perform.html",
+        setlist=setlist,
+        active_song=active_song,
+        mode=mode,
+        live_songs=[song.serialize() for song in setlist.songs],
+    )
 
 
 ############################################################
 # Misc
 
 
+def search_query(category, term):
+    """Returns the (unevaluated) query and result type for a search."""
+
+    if category == "title":
+        return (
+            Song.query.filter(Song.title.ilike(f"%{term}%")).order_by(Song.title.asc()),
+            "songs",
+        )
+    elif category == "artist":
+        return (
+            Song.query.filter(Song.artist.ilike(f"%{term}%")).order_by(
+                Song.artist.asc()
+            ),
+            "songs",
+        )
+    elif category == "lyrics":
+        # A song's own lyrics take the place of the shared ones. Compressed
+        # lyrics (see LYRICS_COMPRESS_OVER) can't be searched in SQL.
+        lyrics = case(
+            [(SongLyrics.song_id.isnot(None), SongLyrics.text)],
+            else_=CanonicalLyrics.text,
+        )
+        return (
+            Song.query.outerjoin(Song.lyrics_row)
+            .outerjoin(
+                CanonicalLyrics,
+                and_(
+                    CanonicalLyrics.canonical_id == Song.canonical_id,
+                    Song.shares_lyrics,
+                ),
+            )
+            .filter(lyrics.ilike(f"%{term}%"))
+            .order_by(Song.title.asc()),
+            "songs",
+        )
+    elif category == "setlist":
+        return (
+            Setlist.query.options(joinedload(Setlist.user))
+            .filter(Setlist.name.ilike(f"%{term}%"))
+            .order_by(Setlist.name.asc()),
+            "setlists",
+        )
+    elif category == "user":
+        return (
+            User.query.filter(User.username.ilike(f"%{term}%")).order_by(
+                User.username.asc()
+            ),
+            "users",
+        )
+
+    return None, "nothing"
+
+
+def paginate_search(query, page):
+    """Materializes one page of search results.
+
+    The count is bounded by MAX_SEARCH_RESULTS, so huge result sets cost a
+    capped COUNT rather than a full scan; pages past the cap aren't served."""
+
+    per_page = app.config["ITEMS_PER_PAGE"]
+    cap = app.config["MAX_SEARCH_RESULTS"]
+
+    capped_query = query.order_by(None).limit(cap + 1).subquery()
+    count = db.session.query(func.count()).select_from(capped_query).scalar()
+    total = min(count, cap)
+
+    last_page = max((total - 1) // per_page + 1, 1)
+    page = min(max(page, 1), last_page)
+
+    items = query.limit(per_page).offset((page - 1) * per_page).all()
+
+    return Pagination(query, page, per_page, total, items), count > cap
+
+
 @app.route("/search", methods=["GET", "POST"])
+@reads_from_replica
 def do_search():
-    """Searches the database."""
+    """Searches the database.
 
-    form = SearchForm()
+    Searches are GET requests with query parameters, so result pages can be
+    bookmarked and cached; POSTed searches are redirected to that form."""
 
-    if form.validate_on_submit():
-        category = form.category.data
-        term = form.term.data
+    if request.method == "POST":
+        form = SearchForm()
 
-        if category == "title":
-            res = Song.query.filter(Song.title.ilike(f"%{term}%")).order_by(
-                Song.title.asc()
-            )
-            res_type = "songs"
-        elif category == "artist":
-            res = Song.query.filter(Song.artist.ilike(f"%{term}%")).order_by(
-                Song.artist.asc()
-            )
-            res_type = "songs"
-        elif category == "lyrics":
-            res = Song.query.filter(Song.lyrics.ilike(f"%{term}%")).order_by(
-                Song.title.asc()
-            )
-            res_type = "songs"
-        elif category == "setlist":
-            res = Setlist.query.filter(Setlist.name.ilike(f"%{term}%")).order_by(
-                Setlist.name.asc()
+        if form.validate_on_submit():
+            return redirect(
+                url_for("do_search", category=form.category.data, term=form.term.data)
             )
-            res_type = "setlists"
-        elif category == "user":
-            res = User.query.filter(User.username.ilike(f"%{term}%")).order_by(
-                User.username.asc()
-            )
-            res_type = "users"
-        else:
-            res = None
-            res_type = "nothing"
 
+        return render_template("search.html", form=form)
+
+    form = SearchForm(request.args, meta={"csrf": False})
+
+    if "term" not in request.args or not form.validate():
+        return render_template("search.html", form=form)
+
+    category = form.category.data
+    term = form.term.data
+    query, res_type = search_query(category, term)
+
+    if query is None:
         return render_template(
-            "search-results.html", res=res, form=form, res_type=res_type
+            "search-results.html", res=None, capped=False, form=form, res_type=res_type
         )
 
-    return render_template("search.html", form=form)
+    page = request.args.get("page", 1, type=int)
+    res, capped = paginate_search(query, page)
+
+    next_url = (
+        url_for("do_search", category=category, term=term, page=res.next_num)
+        if res.has_next
+        else None
+    )
+    prev_url = (
+        url_for("do_search", category=category, term=term, page=res.prev_num)
+        if res.has_prev
+        else None
+    )
+
+    return render_template(
+        "search-results.html",
+        res=res,
+        capped=capped,
+        form=form,
+        res_type=res_type,
+        next_url=next_url,
+        prev_url=prev_url,
+    )
+
+
+@app.route("/api/autocomplete")
+@reads_from_replica
+def autocomplete():
+    """Returns song titles and artists completing a prefix (?q=).
+
+    ?field=title or ?field=artist asks for just one of them, and ?limit= for
+    up to AUTOCOMPLETE_MAX_RESULTS of each. Answers are the same for everyone,
+    so browsers and shared caches may keep them for AUTOCOMPLETE_MAX_AGE."""
+
+    prefix = request.args.get("q", "")[:100]
+    fields = (
+        [request.args.get("field")]
+        if request.args.get("field")
+        else ["title", "artist"]
+    )
+    limit = min(
+        request.args.get("limit", 10, type=int), app.config["AUTOCOMPLETE_MAX_RESULTS"]
+    )
+
+    if not set(fields) <= {"title", "artist"} or limit < 1:
+        return jsonify(error="Complete a title or artist, with a positive limit."), 400
+
+    resp = jsonify(
+        {f"{field}s": CanonicalSong.complete(field, prefix, limit) for field in fields}
+    )
+    resp.cache_control.public = True
+    resp.cache_control.max_age = app.config["AUTOCOMPLETE_MAX_AGE"]
+    resp.add_etag()
+
+    return resp.make_conditional(request)
+
+
+@app.route("/stats")
+@reads_from_replica
+def show_stats():
+    """Shows the most-used songs and artists, and the largest catalogs."""
+
+    limit = app.config["STATS_TOP"]
+    refreshed = latest_refresh()
+
+    return render_template(
+        "stats.html",
+        refreshed=refreshed,
+        songs=top_songs(limit) if refreshed else [],
+        artists=top_artists(limit) if refreshed else [],
+        catalogs=largest_catalogs(limit) if refreshed else [],
+        own=UserStats.query.get(g.user.id) if g.user and refreshed else None,
+    )
 
 
 ############################################################
@@ -563,28 +966,37 @@ def do_search():
 
 
 @app.route("/api/setlists/<int:setlist_id>/get-songs")
+@reads_from_replica
 def get_songs_in_setlist(setlist_id):
     """Returns a list of the songs in and not in a setlist."""
 
     setlist = Setlist.query.get_or_404(setlist_id)
     setlist_songs = []
 
-    print(setlist.songs)
-
     for song in setlist.songs:
         setlist_songs.append(song.serialize())
 
     setlist_ids = [s.id for s in setlist.songs]
-    not_setlist_songs = Song.query.filter(~Song.id.in_(setlist_ids)).order_by(
-        Song.title.asc()
-    )
+    snapshot = current_snapshot()
+
+    if snapshot is not None:
+        not_setlist_songs = snapshot.by_title(exclude=set(setlist_ids))
+    else:
+        not_setlist_songs = in_catalog_order(
+            Song.query.filter(~Song.id.in_(setlist_ids))
+        )
 
     other_songs = []
 
     for song in not_setlist_songs:
         other_songs.append(song.serialize())
 
-    return jsonify(setlistSongs=setlist_songs, otherSongs=other_songs)
+    return jsonify(
+        setlistSongs=setlist_songs,
+        otherSongs=other_songs,
+        notes=setlist.notes or "",
+        version=setlist.version,
+    )
 
 
 @app.route("/api/setlists/<int:setlist_id>/update-songs", methods=["POST"])
@@ -594,29 +1006,769 @@ def update_setlist(setlist_id):
     setlist = Setlist.query.get_or_404(setlist_id)
     updated_song_ids = request.get_json(silent=True).get("songs")
 
-    for setlist_song in setlist.setlist_songs:
-        db.session.delete(setlist_song)
+    old_song_ids = [
+        setlist_song.song_id
+        for setlist_song in sorted(setlist.setlist_songs, key=lambda ss: ss.index)
+    ]
+    old_notes = setlist.notes
+
+    # Every song, in one query, before anything changes.
+    songs = {
+        song.id: song for song in Song.query.filter(Song.id.in_(updated_song_ids or []))
+    }
+
+    if any(song_id not in songs for song_id in updated_song_ids):
+        abort(404)
+
+    # The old songs are replaced in the same transaction as the new ones are
+    # added and the summaries refreshed, so no reader sees the setlist empty.
+    setlist.setlist_songs = []
+    db.session.flush()
+
+    new_song_list = [songs[song_id] for song_id in updated_song_ids]
+
+    if updated_song_ids:
+        db.session.execute(
+            SetlistSong.__table__.insert(),
+            [
+                {
+                    "setlist_id": setlist_id,
+                    "song_id": song_id,
+                    "index": number * ORDER_GAP,
+                }
+                for number, song_id in enumerate(updated_song_ids, 1)
+            ],
+        )
+
+    serialized_songs = []
+    for song in new_song_list:
+        serialized_songs.append(song.serialize())
+
+    setlist.notes = request.get_json(silent=True).get("notes")
+    setlist.version = Setlist.version + 1
 
+    db.session.add(setlist)
+    Setlist.refresh_summaries(Setlist.id == setlist_id)
     db.session.commit()
 
-    new_song_list = []
+    ops = song_list_ops(old_song_ids, [song["id"] for song in serialized_songs])
+    log_activity(
+        "setlist.update",
+        setlist_id=setlist_id,
+        songs=song_op_counts(ops),
+        fields=["notes"] if (setlist.notes or "") != (old_notes or "") else [],
+    )
 
-    index = 0
+    publish_setlist_event(
+        setlist_id,
+        "change",
+        {
+            "version": setlist.version,
+            "ops": ops,
+            "notes": text_delta(old_notes, setlist.notes),
+            "songs": {song["id"]: song for song in serialized_songs},
+        },
+    )
 
-    for song_id in updated_song_ids:
-        song = Song.query.get_or_404(song_id)
-        new_song_list.append(song)
-        setlist_song = SetlistSong(setlist_id=setlist_id, song_id=song_id, index=index)
-        index += 1
-        setlist.setlist_songs.append(setlist_song)
+    return jsonify(songs=serialized_songs, version=setlist.version)
 
-    serialized_songs = []
-    for song in new_song_list:
-        serialized_songs.append(song.serialize())
 
-    setlist.notes = request.get_json(silent=True).get("notes")
+@app.route("/api/setlists/<int:setlist_id>/patch", methods=["POST"])
+def patch_setlist(setlist_id):
+    """Applies a patch of song moves, inserts and removals and notes edits.
+
+    The patch names the setlist version it was made against; if the setlist
+    has changed since, nothing is applied and the current state is returned
+    with a 409 so the client can start again from it."""
+
+    setlist = Setlist.query.get_or_404(setlist_id)
+
+    if not g.user or g.user.id != setlist.user_id:
+        return jsonify(error="You are not authorized to edit this setlist."), 403
+
+    patch = request.get_json(silent=True) or {}
+    version = patch.get("version")
+
+    if not isinstance(version, int):
+        return jsonify(error="version must be the setlist version patched."), 400
+
+    if not Setlist.claim_version(setlist_id, version):
+        db.session.rollback()
+        db.session.refresh(setlist)
+        return (
+            jsonify(
+                error="This setlist has been changed elsewhere.",
+                version=setlist.version,
+                songs=[song.id for song in setlist.songs],
+                notes=setlist.notes or "",
+            ),
+            409,
+        )
+
+    ops = patch.get("ops", [])
+    notes_delta = patch.get("notes") or []
+
+    try:
+        setlist.apply_song_ops(ops)
+        if notes_delta:
+            setlist.notes = apply_text_delta(setlist.notes, notes_delta)
+    except (ValueError, KeyError, TypeError, AttributeError) as e:
+        db.session.rollback()
+        return jsonify(error=str(e)), 400
+
+    Setlist.refresh_summaries(Setlist.id == setlist_id)
+    db.session.commit()
+
+    log_activity(
+        "setlist.update",
+        setlist_id=setlist_id,
+        songs=song_op_counts(ops),
+        fields=["notes"] if notes_delta else [],
+    )
+    publish_setlist_change(setlist_id, version + 1, ops, notes_delta)
+
+    return jsonify(version=version + 1)
+
+
+def publish_setlist_change(setlist_id, version, ops, notes_delta):
+    """Tells live sync clients about a committed patch to a setlist."""
+
+    inserted_ids = [op["song_id"] for op in ops if op["op"] == "insert"]
+    inserted_songs = (
+        Song.query.filter(Song.id.in_(inserted_ids)).all() if inserted_ids else []
+    )
+
+    publish_setlist_event(
+        setlist_id,
+        "change",
+        {
+            "version": version,
+            "ops": ops,
+            "notes": notes_delta,
+            "songs": {song.id: song.serialize() for song in inserted_songs},
+        },
+    )
+
+
+@app.route("/api/setlists/<int:setlist_id>/events")
+def setlist_events(setlist_id):
+    """Streams changes to a setlist, and the band leader's song, as Server-Sent Events.
+
+    The stream starts with the setlist's current version, so a page can tell
+    whether it missed changes while disconnected."""
+
+    setlist = Setlist.query.get_or_404(setlist_id)
+
+    return setlist_event_response(setlist_id, [("sync", {"version": setlist.version})])
+
 
+@app.route("/api/setlists/<int:setlist_id>/position", methods=["POST"])
+def lead_setlist(setlist_id):
+    """Moves everyone following the band leader in perform mode to a song."""
+
+    setlist = Setlist.query.get_or_404(setlist_id)
+
+    if not g.user or g.user.id != setlist.user_id:
+        return jsonify(error="Only the setlist's owner can lead it."), 403
+
+    song_id = (request.get_json(silent=True) or {}).get("song_id")
+
+    if song_id not in [song.id for song in setlist.songs]:
+        return jsonify(error="That song isn't in this setlist."), 400
+
+    publish_setlist_event(setlist_id, "position", {"song_id": song_id}, retain=True)
+
+    return jsonify(song_id=song_id)
+
+
+############################################################
+# API v1
+#
+# A JSON API for songs, setlists and users. Reads are open to everyone; writes
+# need a logged-in session (POST /api/v1/login). Collections are fetched by
+# id (?ids=1,2,3) or by page (?page=2), and every read takes ?fields= to pick
+# fields and ?expand= to embed related records, with dotted fields picking
+# theirs: /api/v1/setlists/1?expand=songs&fields=name,songs.title,songs.lyrics
+# loads a gig in one request.
+
+API_MAX_IDS = 100
+
+API_RESOURCES = {
+    "songs": {
+        "model": Song,
+        "fields": ("id", "user_id", "title", "artist", "canonical_id", "lyrics"),
+        "default_fields": ("id", "user_id", "title", "artist"),
+        "expansions": {"user": "users"},
+    },
+    "setlists": {
+        "model": Setlist,
+        "fields": (
+            "id",
+            "user_id",
+            "name",
+            "notes",
+            "version",
+            "song_count",
+            "first_song_id",
+            "lyrics_length",
+            "updated_at",
+        ),
+        "default_fields": (
+            "id",
+            "user_id",
+            "name",
+            "notes",
+            "version",
+            "song_count",
+            "updated_at",
+        ),
+        "expansions": {"songs": "songs", "user": "users"},
+    },
+    "users": {
+        "model": User,
+        "fields": ("id", "username"),
+        "default_fields": ("id", "username"),
+        "expansions": {"songs": "songs", "setlists": "setlists"},
+    },
+}
+
+
+class APIError(Exception):
+    """An API request that can't be carried out, and the status to answer with."""
+
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.message = message
+        self.status = status
+
+
+@app.errorhandler(APIError)
+def show_api_error(e):
+    """Answers a failed API request with its error as JSON."""
+
+    return jsonify(error=e.message), e.status
+
+
+def api_list_arg(name):
+    """Returns a comma-separated query string argument as a list."""
+
+    return [item for item in request.args.get(name, "").split(",") if item]
+
+
+def api_ids():
+    """Returns the ids named by ?ids=1,2,3, or raises APIError."""
+
+    try:
+        ids = [int(record_id) for record_id in api_list_arg("ids")]
+    except ValueError:
+        raise APIError("ids must be a comma-separated list of integers.")
+
+    if len(ids) > API_MAX_IDS:
+        raise APIError(f"Name at most {API_MAX_IDS} ids at a time.")
+
+    return ids
+
+
+def api_fields(kind):
+    """Returns the fields and the expansions (with their fields) requested.
+
+    Raises APIError for an unknown field or expansion."""
+
+    resource = API_RESOURCES[kind]
+    requested = api_list_arg("fields")
+    expand = api_list_arg("expand")
+
+    for name in expand:
+        if name not in resource["expansions"]:
+            raise APIError(f"{kind} can't be expanded with {name!r}.")
+
+    for field in requested:
+        if "." in field and field.split(".", 1)[0] not in expand:
+            raise APIError(f"Field {field!r} needs ?expand={field.split('.')[0]}.")
+
+    fields = [field for field in requested if "." not in field]
+    fields = check_api_fields(kind, fields or resource["default_fields"])
+    expansions = {}
+
+    for name in expand:
+        prefix = f"{name}."
+        related = resource["expansions"][name]
+        chosen = [
+            field[len(prefix) :] for field in requested if field.startswith(prefix)
+        ]
+        expansions[name] = check_api_fields(
+            related, chosen or API_RESOURCES[related]["default_fields"]
+        )
+
+    return fields, expansions
+
+
+def check_api_fields(kind, fields):
+    """Returns fields as a list, if they're all fields of this kind of record."""
+
+    for field in fields:
+        if field not in API_RESOURCES[kind]["fields"]:
+            raise APIError(f"{kind} have no field {field!r}.")
+
+    return list(fields)
+
+
+def api_load_options(kind, fields, expansions):
+    """Returns loader options fetching the requested fields in a few queries."""
+
+    resource = API_RESOURCES[kind]
+    options = list(Song.with_lyrics) if kind == "songs" and "lyrics" in fields else []
+
+    for name, related_fields in expansions.items():
+        relationship = getattr(resource["model"], name)
+        options.append(selectinload(relationship))
+
+        if resource["expansions"][name] == "songs" and "lyrics" in related_fields:
+            options += [
+                selectinload(relationship).joinedload(Song.lyrics_row),
+                selectinload(relationship)
+                .joinedload(Song.canonical)
+                .joinedload(CanonicalSong.lyrics_row),
+            ]
+
+    return options
+
+
+def api_value(value):
+    """Returns a field's value in the form it's sent as JSON."""
+
+    return value.isoformat() + "Z" if isinstance(value, datetime) else value
+
+
+def api_record(record, fields, expansions=None):
+    """Returns the requested fields of a record, with any expanded records."""
+
+    result = {field: api_value(getattr(record, field)) for field in fields}
+
+    for name, related_fields in (expansions or {}).items():
+        related = getattr(record, name)
+
+        if isinstance(related, list):
+            result[name] = [api_record(item, related_fields) for item in related]
+        else:
+            result[name] = api_record(related, related_fields) if related else None
+
+    return result
+
+
+def api_get(kind, record_id, options=()):
+    """Returns a record by id, or raises a 404 APIError."""
+
+    record = (
+        API_RESOURCES[kind]["model"]
+        .query.options(*options)
+        .filter_by(id=record_id)
+        .first()
+    )
+
+    if record is None:
+        raise APIError(f"There's no {kind[:-1]} {record_id}.", 404)
+
+    return record
+
+
+def api_owned(kind, record_id):
+    """Returns a record the logged-in user owns, or raises APIError."""
+
+    if not g.user:
+        raise APIError("You must be logged in.", 401)
+
+    record = api_get(kind, record_id)
+
+    if record.user_id != g.user.id:
+        raise APIError(f"You can't change someone else's {kind[:-1]}.", 403)
+
+    return record
+
+
+def check_api_owner(kind, record_ids):
+    """Raises APIError unless the logged-in user owns all these records."""
+
+    model = API_RESOURCES[kind]["model"]
+    owners = dict(
+        db.session.query(model.id, model.user_id).filter(model.id.in_(record_ids))
+    )
+
+    for record_id in record_ids:
+        if record_id not in owners:
+            raise APIError(f"There's no {kind[:-1]} {record_id}.", 404)
+        if owners[record_id] != g.user.id:
+            raise APIError(f"You can't change someone else's {kind[:-1]}.", 403)
+
+
+def api_body():
+    """Returns the request's JSON object, or raises APIError."""
+
+    body = request.get_json(silent=True)
+
+    if not isinstance(body, dict):
+        raise APIError("Send a JSON object.")
+
+    return body
+
+
+def api_text(body, key, required=False, allow_empty=False):
+    """Returns a string from a request body, or None if it's absent and optional."""
+
+    value = body.get(key)
+
+    if value is None and not required:
+        return None
+
+    if not isinstance(value, str) or not (allow_empty or value.strip()):
+        raise APIError(f"{key} must be a {'' if allow_empty else 'non-empty '}string.")
+
+    return value
+
+
+@app.route("/api/v1/<any(songs, setlists, users):kind>")
+@reads_from_replica
+def api_list(kind):
+    """Returns the records named by ?ids=1,2,3 in that order, or a page of them."""
+
+    fields, expansions = api_fields(kind)
+    model = API_RESOURCES[kind]["model"]
+    query = model.query.options(*api_load_options(kind, fields, expansions))
+    ids = request.args.get("ids")
+
+    if ids is None:
+        page = query.order_by(model.id).paginate(
+            per_page=app.config["ITEMS_PER_PAGE"], error_out=False
+        )
+        return jsonify(
+            {
+                kind: [api_record(record, fields, expansions) for record in page.items],
+                "page": page.page,
+                "pages": page.pages,
+                "total": page.total,
+            }
+        )
+
+    ids = api_ids()
+
+    found = {record.id: record for record in query.filter(model.id.in_(ids))}
+
+    return jsonify(
+        {
+            kind: [
+                api_record(found[record_id], fields, expansions)
+                for record_id in ids
+                if record_id in found
+            ],
+            "missing": [record_id for record_id in ids if record_id not in found],
+        }
+    )
+
+
+@app.route("/api/v1/<any(songs, setlists):kind>", methods=["DELETE"])
+def api_delete(kind):
+    """Deletes the records named by ?ids=1,2,3, which must all be the user's."""
+
+    if not g.user:
+        raise APIError("You must be logged in.", 401)
+
+    ids = api_ids()
+
+    if not ids:
+        raise APIError("Name the records to delete with ?ids=.")
+
+    check_api_owner(kind, ids)
+    model = API_RESOURCES[kind]["model"]
+    model.delete_where(model.id.in_(ids))
+    db.session.commit()
+
+    return "", 204
+
+
+@app.route("/api/v1/<any(songs, setlists, users):kind>/<int:record_id>")
+@reads_from_replica
+def api_show(kind, record_id):
+    """Returns one record."""
+
+    fields, expansions = api_fields(kind)
+    record = api_get(kind, record_id, api_load_options(kind, fields, expansions))
+
+    return jsonify({kind[:-1]: api_record(record, fields, expansions)})
+
+
+STATS_FIELDS = {
+    "totals": (
+        "refreshed_at",
+        "user_count",
+        "song_count",
+        "canonical_song_count",
+        "setlist_count",
+        "setlist_song_count",
+    ),
+    "songs": ("canonical_id", "title", "artist", "use_count", "setlist_count"),
+    "artists": ("artist", "song_count", "use_count"),
+    "catalogs": ("user_id", "song_count", "setlist_count", "setlist_song_count"),
+}
+
+
+def api_stats_refresh():
+    """Returns the last statistics refresh, or answers 503 if there's none yet."""
+
+    refreshed = latest_refresh()
+
+    if refreshed is None:
+        raise APIError("Statistics are being computed; try again shortly.", 503)
+
+    return refreshed
+
+
+@app.route("/api/v1/stats")
+@reads_from_replica
+def api_stats():
+    """Returns the catalog's totals, most-used songs and artists, and largest catalogs.
+
+    ?limit= asks for up to API_MAX_IDS of each (STATS_TOP by default). They're
+    as of the last refresh, at totals.refreshed_at."""
+
+    limit = request.args.get("limit", app.config["STATS_TOP"], type=int)
+
+    if not 1 <= limit <= API_MAX_IDS:
+        raise APIError(f"Ask for 1 to {API_MAX_IDS} of each.")
+
+    refreshed = api_stats_refresh()
+
+    return jsonify(
+        totals=api_record(refreshed, STATS_FIELDS["totals"]),
+        songs=[api_record(row, STATS_FIELDS["songs"]) for row in top_songs(limit)],
+        artists=[
+            api_record(row, STATS_FIELDS["artists"]) for row in top_artists(limit)
+        ],
+        catalogs=[
+            api_record(row, STATS_FIELDS["catalogs"], {"user": ("id", "username")})
+            for row in largest_catalogs(limit)
+        ],
+    )
+
+
+@app.route("/api/v1/users/<int:user_id>/stats")
+@reads_from_replica
+def api_user_stats(user_id):
+    """Returns the size of a user's catalog and setlists, as of the last refresh."""
+
+    api_get("users", user_id)
+    refreshed = api_stats_refresh()
+    row = UserStats.query.get(user_id) or UserStats(
+        user_id=user_id, song_count=0, setlist_count=0, setlist_song_count=0
+    )
+
+    return jsonify(
+        stats=api_record(row, STATS_FIELDS["catalogs"]),
+        refreshed_at=api_value(refreshed.refreshed_at),
+    )
+
+
+@app.route("/api/v1/login", methods=["POST"])
+def api_login():
+    """Logs in with a username or email and password, for the API's writes."""
+
+    body = api_body()
+    credential = api_text(body, "credential", required=True)
+    password = api_text(body, "password", required=True)
+
+    user = User.authenticate_username(credential, password) or User.authenticate_email(
+        credential, password
+    )
+
+    if not user:
+        raise APIError("Those credentials are wrong.", 401)
+
+    do_login(user)
+
+    return jsonify(user=api_record(user, API_RESOURCES["users"]["default_fields"]))
+
+
+@app.route("/api/v1/songs", methods=["POST"])
+def api_add_song():
+    """Adds a song: {"title", "artist", "lyrics"?}."""
+
+    if not g.user:
+        raise APIError("You must be logged in.", 401)
+
+    body = api_body()
+    song = Song(
+        user_id=g.user.id,
+        title=api_text(body, "title", required=True),
+        artist=api_text(body, "artist", required=True),
+        lyrics=api_text(body, "lyrics", allow_empty=True),
+    )
+    db.session.add(song)
+    db.session.commit()
+
+    return jsonify(song=api_record(song, API_RESOURCES["songs"]["fields"])), 201
+
+
+@app.route("/api/v1/songs/<int:song_id>", methods=["PATCH"])
+def api_update_song(song_id):
+    """Changes any of a song's title, artist and lyrics."""
+
+    song = api_owned("songs", song_id)
+    body = api_body()
+    title = api_text(body, "title")
+    artist = api_text(body, "artist")
+    lyrics = api_text(body, "lyrics", allow_empty=True)
+    fields = changed_fields(song, title=title, artist=artist, lyrics=lyrics)
+
+    if title is not None or artist is not None:
+        song.rename(title or song.title, artist or song.artist)
+
+    if "lyrics" in body:
+        song.lyrics = lyrics
+
+    Setlist.refresh_summaries(Setlist.songs.any(Song.id == song.id), touch=False)
+    db.session.commit()
+
+    if fields:
+        log_activity("song.update", song_id=song_id, fields=fields)
+
+    return jsonify(song=api_record(song, API_RESOURCES["songs"]["fields"]))
+
+
+@app.route("/api/v1/songs/<int:song_id>", methods=["DELETE"])
+def api_delete_song(song_id):
+    """Deletes a song."""
+
+    api_owned("songs", song_id)
+    Song.delete_where(Song.id == song_id)
+    db.session.commit()
+
+    return "", 204
+
+
+@app.route("/api/v1/setlists", methods=["POST"])
+def api_add_setlist():
+    """Adds a setlist: {"name", "notes"?, "song_ids"?}."""
+
+    if not g.user:
+        raise APIError("You must be logged in.", 401)
+
+    body = api_body()
+    song_ids = body.get("song_ids") or []
+
+    if not isinstance(song_ids, list) or not all(
+        isinstance(song_id, int) for song_id in song_ids
+    ):
+        raise APIError("song_ids must be a list of song ids.")
+
+    if Song.query.filter(Song.id.in_(set(song_ids))).count() != len(set(song_ids)):
+        raise APIError("Can't add a song that doesn't exist.")
+
+    setlist = Setlist(
+        user_id=g.user.id,
+        name=api_text(body, "name", required=True),
+        notes=api_text(body, "notes", allow_empty=True),
+    )
+    setlist.setlist_songs = [
+        SetlistSong(song_id=song_id, index=(position + 1) * ORDER_GAP)
+        for position, song_id in enumerate(song_ids)
+    ]
     db.session.add(setlist)
+    db.session.flush()
+    Setlist.refresh_summaries(Setlist.id == setlist.id)
+    db.session.commit()
+
+    return (
+        jsonify(setlist=api_record(setlist, API_RESOURCES["setlists"]["fields"])),
+        201,
+    )
+
+
+@app.route("/api/v1/setlists/clone", methods=["POST"])
+def api_clone_setlists():
+    """Copies setlists, with their notes and songs: {"ids": [...]}."""
+
+    if not g.user:
+        raise APIError("You must be logged in.", 401)
+
+    setlist_ids = api_body().get("ids")
+
+    if (
+        not isinstance(setlist_ids, list)
+        or not setlist_ids
+        or not all(isinstance(setlist_id, int) for setlist_id in setlist_ids)
+    ):
+        raise APIError("ids must be a list of setlist ids.")
+
+    if len(setlist_ids) > API_MAX_IDS:
+        raise APIError(f"Copy at most {API_MAX_IDS} setlists at a time.")
+
+    check_api_owner("setlists", setlist_ids)
+    copies = Setlist.clone(setlist_ids, g.user.id)
+    db.session.commit()
+
+    fields = API_RESOURCES["setlists"]["fields"]
+    return jsonify(setlists=[api_record(copy, fields) for copy in copies]), 201
+
+
+@app.route("/api/v1/setlists/<int:setlist_id>", methods=["PATCH"])
+def api_update_setlist(setlist_id):
+    """Changes a setlist: {"version", "name"?, "notes"?, "ops"?}.
+
+    ops are the song moves, inserts and removals of the patch endpoint. As
+    there, a stale version changes nothing and is answered with a 409."""
+
+    setlist = api_owned("setlists", setlist_id)
+    body = api_body()
+    version = body.get("version")
+    name = api_text(body, "name")
+    notes = api_text(body, "notes", allow_empty=True)
+    ops = body.get("ops") or []
+
+    if not isinstance(version, int):
+        raise APIError("version must be the setlist version the change is for.")
+
+    if not Setlist.claim_version(setlist_id, version):
+        db.session.rollback()
+        raise APIError("This setlist has been changed elsewhere.", 409)
+
+    old_notes = setlist.notes
+    fields = changed_fields(setlist, name=name, notes=notes)
+
+    try:
+        setlist.apply_song_ops(ops)
+    except (ValueError, KeyError, TypeError, AttributeError) as e:
+        db.session.rollback()
+        raise APIError(str(e))
+
+    if name is not None:
+        setlist.name = name
+    if notes is not None:
+        setlist.notes = notes
+
+    Setlist.refresh_summaries(Setlist.id == setlist_id)
+    db.session.commit()
+
+    log_activity(
+        "setlist.update",
+        setlist_id=setlist_id,
+        songs=song_op_counts(ops),
+        fields=fields,
+    )
+
+    publish_setlist_change(
+        setlist_id, version + 1, ops, text_delta(old_notes, setlist.notes)
+    )
+
+    db.session.refresh(setlist)
+    return jsonify(setlist=api_record(setlist, API_RESOURCES["setlists"]["fields"]))
+
+
+@app.route("/api/v1/setlists/<int:setlist_id>", methods=["DELETE"])
+def api_delete_setlist(setlist_id):
+    """Deletes a setlist."""
+
+    setlist = api_owned("setlists", setlist_id)
+
+    db.session.delete(setlist)
     db.session.commit()
 
-    return jsonify(songs=serialized_songs)
+    return "", 204
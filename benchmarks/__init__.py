@@ -0,0 +1,6 @@
+"""Benchmarks for the Setlist Manager.
+
+Benchmarks seed their own synthetic data, so they must never be pointed at a
+real database: they only run against BENCH_DATABASE_URL, which is dropped and
+recreated by the seeding step.
+"""
@@ -0,0 +1,161 @@
+"""Measures what the activity log costs the requests it records.
+
+Seeds a catalog, then times PATCH /api/v1/songs/<id> (a lyrics change, which
+logs an event) through the Flask test client, first with events left to the
+background flusher and then with the buffer written straight after each
+request, as a synchronous audit write would be. Then it locks the database
+(SQLite only) so the flusher can't write, and records more events than the
+buffer holds, reporting how long recording took once the buffer was full and
+how many events were dropped, and that the rest were written once the lock
+was released.
+
+Usage: BENCH_DATABASE_URL=... python -m benchmarks.activity --scale 1k
+"""
+
+import argparse
+import sqlite3
+import time
+
+from benchmarks.common import (
+    Timer,
+    bench_app,
+    bench_database_url,
+    summarize,
+    write_results,
+)
+from benchmarks.seed import SCALES, load_manifest, save_manifest, seed
+
+
+def time_updates(client, song_ids, count, after=None):
+    """Changes the lyrics of songs count times, calling after each request."""
+
+    samples = []
+
+    with Timer() as total:
+        for number in range(count):
+            song_id = song_ids[number % len(song_ids)]
+
+            with Timer() as timer:
+                client.patch(
+                    f"/api/v1/songs/{song_id}", json={"lyrics": f"Take {number}"}
+                )
+
+                if after is not None:
+                    after()
+            samples.append(timer.elapsed)
+
+    return summarize(samples, total.elapsed)
+
+
+def wait_until(condition, timeout=30):
+    """Waits for condition() to be true, or timeout seconds."""
+
+    deadline = time.monotonic() + timeout
+
+    while not condition() and time.monotonic() < deadline:
+        time.sleep(0.05)
+
+
+def outcome_counts():
+    """Returns the activity log's event counts by outcome, for this process."""
+
+    from metrics import metrics
+
+    return {
+        outcome: value for (outcome,), value in metrics.activity_events.series.items()
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--scale", choices=SCALES, default="1k")
+    parser.add_argument("--requests", type=int, default=500)
+    parser.add_argument(
+        "--overflow", type=int, default=1000, help="Events recorded beyond the buffer."
+    )
+    parser.add_argument(
+        "--reuse", action="store_true", help="Reuse the last seeded catalog."
+    )
+    parser.add_argument("--out", help="Results file (default: benchmarks/results/).")
+    args = parser.parse_args()
+
+    app = bench_app()
+    results = {}
+
+    with app.app_context():
+        import activity
+        from app import CURR_USER_KEY
+        from models import ActivityEvent, Song
+
+        manifest = load_manifest() if args.reuse else None
+
+        if manifest is None or manifest.get("scale") != args.scale:
+            manifest = seed(SCALES[args.scale], lyrics_bytes=0)
+            manifest["scale"] = args.scale
+            save_manifest(manifest)
+
+        song_ids = [
+            song_id
+            for (song_id,) in Song.query.with_entities(Song.id)
+            .filter_by(user_id=manifest["owner_id"])
+            .limit(100)
+        ]
+        client = app.test_client()
+
+        with client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = manifest["owner_id"]
+
+        for key, after in (
+            ("PATCH /api/v1/songs/<id>, logged in the background", None),
+            ("PATCH /api/v1/songs/<id>, logged synchronously", activity.buffer.flush),
+        ):
+            written = ActivityEvent.query.count()
+            results[key] = time_updates(client, song_ids, args.requests, after)
+            wait_until(lambda: ActivityEvent.query.count() >= written + args.requests)
+            results[key]["events_written"] = ActivityEvent.query.count() - written
+            print(f"{key}: {results[key]}")
+
+        url = bench_database_url()
+
+        if url.startswith("sqlite:///"):
+            capacity = activity.settings["max_pending"]
+            before = outcome_counts()
+            lock = sqlite3.connect(url[len("sqlite:///") :], timeout=0)
+            lock.execute("BEGIN EXCLUSIVE")
+            samples = []
+
+            with app.test_request_context():
+                for number in range(capacity + args.overflow):
+                    with Timer() as timer:
+                        activity.log_activity(
+                            "song.update", song_id=song_ids[0], fields=["lyrics"]
+                        )
+
+                    if number >= capacity:
+                        samples.append(timer.elapsed)
+
+            lock.rollback()
+            lock.close()
+            wait_until(lambda: activity.buffer.pending() == 0)
+            after = outcome_counts()
+            results["recording into a full buffer"] = dict(
+                summarize(samples, sum(samples)),
+                **{
+                    outcome: after.get(outcome, 0) - before.get(outcome, 0)
+                    for outcome in ("queued", "written", "dropped", "failed")
+                },
+            )
+            print(
+                f"recording into a full buffer: "
+                f"{results['recording into a full buffer']}"
+            )
+
+    params = {
+        key: value for key, value in vars(args).items() if key not in ("out", "reuse")
+    }
+    path = write_results(f"activity-{args.scale}", params, results, args.out)
+    print(f"Results written to {path}")
+
+
+if __name__ == "__main__":
+    main()
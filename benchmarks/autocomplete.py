@@ -0,0 +1,92 @@
+"""Measures /api/autocomplete latency by prefix length.
+
+Seeds a catalog (without lyrics, which autocompletion never reads), then
+requests title and artist completions for random prefixes of 1 to 4
+characters through the Flask test client, and reports p50/p90/p99 latency per
+field and prefix length, along with the query plan of a title completion.
+
+Usage: BENCH_DATABASE_URL=... python -m benchmarks.autocomplete --scale 1m
+"""
+
+import argparse
+import random
+
+from benchmarks.common import Timer, bench_app, summarize, write_results
+from benchmarks.seed import SCALES, WORDS, load_manifest, save_manifest, seed
+
+PREFIX_LENGTHS = (1, 2, 3, 4)
+
+
+def query_plan(db, field, key):
+    """Returns the database's plan for completing a key, one line per step."""
+
+    from models import CanonicalSong
+
+    query = CanonicalSong.completion_query(field, key, 10)
+    sql = str(
+        query.statement.compile(db.engine, compile_kwargs={"literal_binds": True})
+    )
+
+    if db.engine.dialect.name == "postgresql":
+        return [row[0] for row in db.session.execute(f"EXPLAIN {sql}")]
+
+    return [row[-1] for row in db.session.execute(f"EXPLAIN QUERY PLAN {sql}")]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--scale", choices=SCALES, default="1k")
+    parser.add_argument("--requests", type=int, default=200)
+    parser.add_argument(
+        "--reuse", action="store_true", help="Reuse the last seeded catalog."
+    )
+    parser.add_argument("--out", help="Results file (default: benchmarks/results/).")
+    args = parser.parse_args()
+
+    app = bench_app()
+    rng = random.Random(7)
+    results = {}
+
+    with app.app_context():
+        from models import db
+
+        manifest = load_manifest() if args.reuse else None
+
+        if manifest is None or manifest.get("scale") != args.scale:
+            manifest = seed(SCALES[args.scale], lyrics_bytes=0)
+            manifest["scale"] = args.scale
+            save_manifest(manifest)
+
+        client = app.test_client()
+
+        for field in ("title", "artist"):
+            for length in PREFIX_LENGTHS:
+                samples = []
+
+                with Timer() as total:
+                    for _ in range(args.requests):
+                        prefix = rng.choice(WORDS)[:length]
+
+                        with Timer() as timer:
+                            resp = client.get(
+                                f"/api/autocomplete?q={prefix}&field={field}"
+                            )
+                        resp.get_data()
+                        samples.append(timer.elapsed)
+
+                key = f"{field}, {length}-character prefix"
+                results[key] = summarize(samples, total.elapsed)
+                print(f"{key}: {results[key]}")
+
+        results["plan"] = query_plan(db, "title", "lo")
+        print("\n".join(results["plan"]))
+
+    params = {
+        key: value for key, value in vars(args).items() if key not in ("out", "reuse")
+    }
+    path = write_results(f"autocomplete-{args.scale}", params, results, args.out)
+    print(f"Results written to {path}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,237 @@
+"""Compares the shared catalog snapshot with the ORM, for speed and memory.
+
+Seeds a catalog (without lyrics), builds the snapshot in full and then
+incrementally after a batch of song changes, and reports:
+
+- lookup latency from the snapshot and from the ORM, for a page of the song
+  listing (/songs), the song picker's list of every song (get-songs) and a
+  song by id;
+- the memory of --workers forked processes that each either map the snapshot
+  (and touch every page of it) or load every song into a dictionary of their
+  own, as a per-worker cache would: RSS, PSS (shared pages split between the
+  processes sharing them) and private memory per process, and the total PSS.
+
+Usage: BENCH_DATABASE_URL=... python -m benchmarks.catalog --scale 1m
+"""
+
+import argparse
+import gc
+import os
+import random
+import signal
+
+from benchmarks.common import Timer, bench_app, summarize, write_results
+from benchmarks.seed import SCALES, load_manifest, save_manifest, seed
+from benchmarks.worker_memory import average, process_memory
+
+PAGE_SIZE = 20
+PAGE_BYTES = 4096
+
+
+def time_lookups(lookups, repeat, reset):
+    """Times each lookup repeat times, calling reset before every run."""
+
+    results = {}
+
+    for key, lookup in lookups.items():
+        samples = []
+
+        with Timer() as total:
+            for _ in range(repeat):
+                reset()
+
+                with Timer() as timer:
+                    lookup()
+                samples.append(timer.elapsed)
+
+        results[key] = summarize(samples, total.elapsed)
+        print(f"{key}: {results[key]}")
+
+    return results
+
+
+def fork_workers(count, load):
+    """Forks processes that each run load and then wait, returning their pids."""
+
+    from models import db
+
+    pids = []
+
+    for _ in range(count):
+        ready_read, ready_write = os.pipe()
+        pid = os.fork()
+
+        if pid == 0:
+            os.close(ready_read)
+            # Like gunicorn's post_fork: never share the parent's connections.
+            db.engine.dispose()
+            loaded = load()  # noqa: F841, kept until the worker is stopped
+            os.write(ready_write, b"1")
+            signal.pause()
+            os._exit(0)
+
+        os.close(ready_write)
+        os.read(ready_read, 1)
+        os.close(ready_read)
+        pids.append(pid)
+
+    return pids
+
+
+def measure_workers(pids):
+    """Returns the workers' memory, then stops them."""
+
+    try:
+        samples = [process_memory(pid) for pid in pids]
+    finally:
+        for pid in pids:
+            os.kill(pid, signal.SIGTERM)
+            os.waitpid(pid, 0)
+
+    return {
+        "worker": average(samples),
+        "total_pss_mb": round(sum(sample["pss_mb"] for sample in samples), 1),
+    }
+
+
+def map_snapshot():
+    """Maps the snapshot and touches every page of it, as a busy worker would."""
+
+    import catalog
+
+    snapshot = catalog.load()
+
+    for offset in range(0, len(snapshot.map), PAGE_BYTES):
+        snapshot.map[offset]
+
+    return snapshot
+
+
+def load_dictionary():
+    """Loads every song into a dictionary held by this process alone."""
+
+    from models import db, Song
+
+    query = db.session.query(Song.id, Song.user_id, Song.title, Song.artist)
+    songs = {song.id: (song.user_id, song.title, song.artist) for song in query}
+    db.session.remove()
+
+    return songs
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--scale", choices=SCALES, default="1k")
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--repeat", type=int, default=100)
+    parser.add_argument(
+        "--changes", type=int, default=1000, help="Songs renamed before rebuilding."
+    )
+    parser.add_argument(
+        "--reuse", action="store_true", help="Reuse the last seeded catalog."
+    )
+    parser.add_argument("--out", help="Results file (default: benchmarks/results/).")
+    args = parser.parse_args()
+
+    os.environ["CATALOG_REBUILD"] = "inline"
+    app = bench_app()
+    rng = random.Random(7)
+    results = {}
+
+    with app.app_context():
+        import catalog
+        from models import db, Song
+
+        manifest = load_manifest() if args.reuse else None
+
+        if manifest is None or manifest.get("scale") != args.scale:
+            manifest = seed(SCALES[args.scale], lyrics_bytes=0)
+            manifest["scale"] = args.scale
+            save_manifest(manifest)
+
+        with Timer() as full_build:
+            catalog.build(full=True)
+
+        song_ids = catalog.load().ids.tolist()
+
+        for song_id in rng.sample(song_ids, min(args.changes, len(song_ids))):
+            Song.query.get(song_id).title += " (live)"
+        db.session.commit()
+
+        with Timer() as incremental_build:
+            catalog.build()
+
+        snapshot = catalog.current_snapshot()
+        results["snapshot"] = {
+            "songs": len(snapshot),
+            "file_mb": round(len(snapshot.map) / 2**20, 1),
+            "full_build_s": round(full_build.elapsed, 2),
+            f"incremental_build_s ({args.changes} changes)": round(
+                incremental_build.elapsed, 2
+            ),
+        }
+        print(f"snapshot: {results['snapshot']}")
+
+        pages = max(1, len(snapshot) // PAGE_SIZE)
+
+        def snapshot_page():
+            start = rng.randrange(pages) * PAGE_SIZE
+            return snapshot.by_title(start, start + PAGE_SIZE)
+
+        def orm_page():
+            return (
+                Song.query.order_by(Song.title.asc())
+                .paginate(rng.randrange(pages) + 1, PAGE_SIZE, False)
+                .items
+            )
+
+        lookups = {
+            "listing page, snapshot": snapshot_page,
+            "listing page, ORM": orm_page,
+            "every song by title, snapshot": lambda: [
+                song.serialize() for song in snapshot.by_title()
+            ],
+            "every song by title, ORM": lambda: [
+                song.serialize() for song in Song.query.order_by(Song.title.asc())
+            ],
+            "song by id, snapshot": lambda: snapshot.get(rng.choice(song_ids)),
+            "song by id, ORM": lambda: Song.query.get(rng.choice(song_ids)),
+        }
+        # Listing every song is slow at scale, so it's timed less often.
+        results.update(
+            time_lookups(
+                {key: lookup for key, lookup in lookups.items() if "every" not in key},
+                args.repeat,
+                db.session.expunge_all,
+            )
+        )
+        results.update(
+            time_lookups(
+                {key: lookup for key, lookup in lookups.items() if "every" in key},
+                max(1, args.repeat // 20),
+                db.session.expunge_all,
+            )
+        )
+
+        # Unmap the snapshot here, so only the workers share its pages.
+        db.session.remove()
+        del snapshot, lookups, snapshot_page
+        catalog.unload()
+        gc.collect()
+
+        for key, load in (
+            ("workers mapping the snapshot", map_snapshot),
+            ("workers each holding a dictionary", load_dictionary),
+        ):
+            results[key] = measure_workers(fork_workers(args.workers, load))
+            print(f"{key}: {results[key]}")
+
+    params = {
+        key: value for key, value in vars(args).items() if key not in ("out", "reuse")
+    }
+    path = write_results(f"catalog-{args.scale}", params, results, args.out)
+    print(f"Results written to {path}")
+
+
+if __name__ == "__main__":
+    main()
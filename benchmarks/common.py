@@ -0,0 +1,137 @@
+"""Shared helpers for the benchmarks: app setup, statistics and results."""
+
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+from datetime import datetime
+
+RESULTS_DIR = os.path.join(os.path.dirname(__file__), "results")
+
+
+def bench_database_url():
+    """Returns the benchmark database URL, refusing to run without one."""
+
+    url = os.environ.get("BENCH_DATABASE_URL")
+
+    if not url:
+        sys.exit(
+            "Set BENCH_DATABASE_URL to a scratch database; "
+            "the benchmarks drop and recreate every table in it."
+        )
+
+    return url
+
+
+def bench_app():
+    """Imports the Flask app, configured against the benchmark database."""
+
+    os.environ["DATABASE_URL"] = bench_database_url()
+    os.environ.setdefault("QUERY_LOG_ENABLED", "0")
+    os.environ.setdefault("RATE_LIMIT_ENABLED", "0")
+
+    from app import app
+
+    app.config["WTF_CSRF_ENABLED"] = False
+    app.config["DEBUG_TB_ENABLED"] = False
+
+    return app
+
+
+def session_cookie(app, user_id):
+    """Returns a signed session cookie value logging in the given user."""
+
+    from app import CURR_USER_KEY
+
+    serializer = app.session_interface.get_signing_serializer(app)
+    return serializer.dumps({CURR_USER_KEY: user_id})
+
+
+def percentile(sorted_samples, pct):
+    """Returns the pct-th percentile of already-sorted samples."""
+
+    if not sorted_samples:
+        return None
+
+    rank = (len(sorted_samples) - 1) * pct / 100
+    low = int(rank)
+    high = min(low + 1, len(sorted_samples) - 1)
+
+    return sorted_samples[low] + (sorted_samples[high] - sorted_samples[low]) * (
+        rank - low
+    )
+
+
+def summarize(samples, elapsed, errors=0):
+    """Summarizes latency samples (in seconds) taken over elapsed seconds."""
+
+    samples = sorted(samples)
+
+    def ms(value):
+        return None if value is None else round(value * 1000, 3)
+
+    return {
+        "requests": len(samples),
+        "errors": errors,
+        "throughput_rps": round(len(samples) / elapsed, 2) if elapsed else None,
+        "mean_ms": ms(sum(samples) / len(samples)) if samples else None,
+        "p50_ms": ms(percentile(samples, 50)),
+        "p90_ms": ms(percentile(samples, 90)),
+        "p99_ms": ms(percentile(samples, 99)),
+        "max_ms": ms(samples[-1]) if samples else None,
+    }
+
+
+def git_revision():
+    """Returns the current git commit, if the benchmarks run from a checkout."""
+
+    try:
+        return (
+            subprocess.check_output(
+                ["git", "rev-parse", "--short", "HEAD"], stderr=subprocess.DEVNULL
+            )
+            .decode()
+            .strip()
+        )
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def write_results(name, params, results, path=None):
+    """Writes benchmark results as JSON and returns the file path."""
+
+    if path is None:
+        os.makedirs(RESULTS_DIR, exist_ok=True)
+        stamp = datetime.utcnow().strftime("%Y%m%dT%H%M%S")
+        path = os.path.join(RESULTS_DIR, f"{name}-{stamp}.json")
+
+    document = {
+        "benchmark": name,
+        "params": params,
+        "meta": {
+            "timestamp": datetime.utcnow().isoformat() + "Z",
+            "revision": git_revision(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "database": bench_database_url().split(":", 1)[0],
+        },
+        "results": results,
+    }
+
+    with open(path, "w") as results_file:
+        json.dump(document, results_file, indent=2, sort_keys=True)
+
+    return path
+
+
+class Timer:
+    """Context manager measuring elapsed wall-clock time in seconds."""
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.elapsed = time.perf_counter() - self.start
@@ -0,0 +1,84 @@
+"""Compares two benchmark results files and reports regressions.
+
+Usage: python -m benchmarks.compare OLD.json NEW.json [--threshold 10]
+
+Exits with status 1 if any route's p50 or p99 latency grew, or its throughput
+fell, by more than the threshold percentage.
+"""
+
+import argparse
+import json
+import sys
+
+LATENCY_KEYS = ("p50_ms", "p99_ms")
+
+
+def change(old, new):
+    """Returns the percentage change from old to new, or None if unknown."""
+
+    if old in (None, 0) or new is None:
+        return None
+
+    return (new - old) / old * 100
+
+
+def compare(old_results, new_results, threshold):
+    """Returns (rows, regressions) comparing two sets of route results."""
+
+    rows = []
+    regressions = []
+
+    for name in sorted(set(old_results) & set(new_results)):
+        old, new = old_results[name], new_results[name]
+        row = {"route": name}
+
+        for key in LATENCY_KEYS + ("throughput_rps",):
+            row[key] = (old.get(key), new.get(key), change(old.get(key), new.get(key)))
+
+        regressed = [
+            key
+            for key in LATENCY_KEYS
+            if row[key][2] is not None and row[key][2] > threshold
+        ]
+        if (
+            row["throughput_rps"][2] is not None
+            and row["throughput_rps"][2] < -threshold
+        ):
+            regressed.append("throughput_rps")
+
+        if regressed:
+            regressions.append((name, regressed))
+
+        rows.append(row)
+
+    return rows, regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("old")
+    parser.add_argument("new")
+    parser.add_argument("--threshold", type=float, default=10.0)
+    args = parser.parse_args()
+
+    with open(args.old) as old_file, open(args.new) as new_file:
+        old, new = json.load(old_file), json.load(new_file)
+
+    rows, regressions = compare(old["results"], new["results"], args.threshold)
+
+    for row in rows:
+        print(row["route"])
+        for key in LATENCY_KEYS + ("throughput_rps",):
+            before, after, pct = row[key]
+            pct = "n/a" if pct is None else f"{pct:+.1f}%"
+            print(f"  {key:>15}: {before} -> {after} ({pct})")
+
+    if regressions:
+        print(f"\n{len(regressions)} regression(s) over {args.threshold}%:")
+        for name, keys in regressions:
+            print(f"  {name}: {', '.join(keys)}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,93 @@
+"""Measures what compressing each core route costs in CPU and saves in bytes.
+
+Fetches each route uncompressed through the Flask test client, then
+compresses its body with every available encoding at several levels, and
+reports the original and compressed sizes and the CPU time per compression.
+
+Usage: BENCH_DATABASE_URL=... python -m benchmarks.compression --scale 1k
+"""
+
+import argparse
+import time
+
+from benchmarks.common import bench_app, write_results
+from benchmarks.seed import SCALES, seed
+
+LEVELS = {"gzip": (1, 6, 9), "br": (1, 4, 11)}
+
+
+def route_paths(manifest, song_id):
+    """Returns (name, path) for every benchmarked route."""
+
+    setlist_id = manifest["setlist_ids"][max(manifest["setlist_ids"], key=int)]
+
+    return [
+        ("GET /songs/<id>", f"/songs/{song_id}"),
+        (
+            "GET /setlists/<id>/perform/<song_id>",
+            f"/setlists/{setlist_id}/perform/{song_id}",
+        ),
+        ("GET /setlists/<id>", f"/setlists/{setlist_id}"),
+        ("GET /api/setlists/<id>/get-songs", f"/api/setlists/{setlist_id}/get-songs"),
+        ("GET /songs", "/songs"),
+        ("GET /static/bootstrap.flatly.min.css", "/static/bootstrap.flatly.min.css"),
+    ]
+
+
+def cpu_ms(compress, body, encoding, levels, repeats):
+    """Returns the mean CPU time, in ms, of compressing a body."""
+
+    start = time.process_time()
+    for _ in range(repeats):
+        compressed = compress(body, encoding, levels)
+    elapsed = time.process_time() - start
+
+    return round(elapsed / repeats * 1000, 3), len(compressed)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--scale", choices=SCALES, default="1k")
+    parser.add_argument("--lyrics-bytes", type=int, default=1500)
+    parser.add_argument("--repeats", type=int, default=50)
+    parser.add_argument("--out", help="Results file (default: benchmarks/results/).")
+    args = parser.parse_args()
+
+    app = bench_app()
+    results = {}
+
+    with app.app_context():
+        from compression import available_encodings, compress
+        from models import Setlist
+
+        manifest = seed(SCALES[args.scale], lyrics_bytes=args.lyrics_bytes)
+        setlist_id = manifest["setlist_ids"][max(manifest["setlist_ids"], key=int)]
+        song_id = Setlist.query.get(setlist_id).first_song_id
+        client = app.test_client()
+
+        for name, path in route_paths(manifest, song_id):
+            resp = client.get(path)
+            body = resp.get_data()
+            resp.close()
+
+            for encoding in available_encodings():
+                for level in LEVELS[encoding]:
+                    ms, size = cpu_ms(
+                        compress, body, encoding, {encoding: level}, args.repeats
+                    )
+                    key = f"{name} [{encoding} {level}]"
+                    results[key] = {
+                        "original_bytes": len(body),
+                        "compressed_bytes": size,
+                        "saved_percent": round(100 - size / len(body) * 100, 1),
+                        "cpu_ms": ms,
+                    }
+                    print(f"{key}: {results[key]}")
+
+    params = {key: value for key, value in vars(args).items() if key not in ("out",)}
+    path = write_results(f"compression-{args.scale}", params, results, args.out)
+    print(f"Results written to {path}")
+
+
+if __name__ == "__main__":
+    main()
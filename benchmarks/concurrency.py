@@ -0,0 +1,198 @@
+"""Compares gunicorn worker classes under 10, 100 and 1,000 concurrent clients.
+
+Serves the app from a local gunicorn once per worker class, and for each
+level of concurrency, has that many clients request the I/O-heavy endpoints
+over and over for a fixed time: /songs/<id>/fetch-lyrics, which waits on the
+lyrics API (stubbed locally, with --api-delay seconds of latency), and
+/api/setlists/<id>/get-songs. Reports throughput, errors and p50/p90/p99
+latency per worker class, endpoint and concurrency.
+
+Usage:
+    BENCH_DATABASE_URL=... python -m benchmarks.concurrency --scale 1k
+    BENCH_DATABASE_URL=... python -m benchmarks.concurrency \\
+        --worker-classes sync gevent --clients 10 100 1000 --seconds 20
+"""
+
+import argparse
+import http.client
+import json
+import os
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from benchmarks.common import (
+    Timer,
+    bench_app,
+    session_cookie,
+    summarize,
+    write_results,
+)
+from benchmarks.routes import free_port, start_gunicorn
+from benchmarks.seed import SCALES, load_manifest, save_manifest, seed
+
+CLIENT_COUNTS = (10, 100, 1000)
+WORKER_CLASSES = ("sync", "gevent")
+
+
+class SlowLyricsAPI(BaseHTTPRequestHandler):
+    """Answers every request like the lyrics API, after a delay."""
+
+    delay = 0.2
+
+    def do_GET(self):
+        time.sleep(self.delay)
+        body = json.dumps({"result": {"track": {"text": "La la la\n" * 40}}})
+
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body.encode())
+
+    def log_message(self, *args):
+        pass
+
+
+def start_lyrics_api(delay):
+    """Starts the stub lyrics API in a thread, returning the server and its URL."""
+
+    SlowLyricsAPI.delay = delay
+    server = ThreadingHTTPServer(("127.0.0.1", free_port()), SlowLyricsAPI)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    return server, f"http://127.0.0.1:{server.server_port}/"
+
+
+def load(port, path, headers, clients, seconds, timeout):
+    """Has clients request a path back to back for a while, and summarizes it."""
+
+    samples = []
+    errors = [0]
+    lock = threading.Lock()
+    deadline = time.perf_counter() + seconds
+
+    def client():
+        conn = http.client.HTTPConnection("127.0.0.1", port, timeout=timeout)
+
+        while time.perf_counter() < deadline:
+            start = time.perf_counter()
+            try:
+                conn.request("GET", path, headers=headers)
+                resp = conn.getresponse()
+                resp.read()
+                failed = resp.status >= 400
+            except (OSError, http.client.HTTPException):
+                conn.close()
+                conn = http.client.HTTPConnection("127.0.0.1", port, timeout=timeout)
+                failed = True
+            elapsed = time.perf_counter() - start
+
+            with lock:
+                if failed:
+                    errors[0] += 1
+                else:
+                    samples.append(elapsed)
+
+        conn.close()
+
+    threads = [threading.Thread(target=client) for _ in range(clients)]
+
+    with Timer() as total:
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+    return summarize(samples, total.elapsed, errors[0])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--scale", choices=SCALES, default="1k")
+    parser.add_argument(
+        "--worker-classes", nargs="+", default=WORKER_CLASSES, help="Worker classes."
+    )
+    parser.add_argument("--workers", type=int, default=2)
+    parser.add_argument("--clients", type=int, nargs="+", default=CLIENT_COUNTS)
+    parser.add_argument(
+        "--seconds", type=float, default=10, help="Time per endpoint and level."
+    )
+    parser.add_argument(
+        "--api-delay", type=float, default=0.2, help="Lyrics API latency, in seconds."
+    )
+    parser.add_argument(
+        "--timeout", type=float, default=30, help="Client timeout, in seconds."
+    )
+    parser.add_argument(
+        "--reuse", action="store_true", help="Reuse the last seeded catalog."
+    )
+    parser.add_argument("--out", help="Results file (default: benchmarks/results/).")
+    args = parser.parse_args()
+
+    app = bench_app()
+    results = {}
+
+    with app.app_context():
+        from flask import current_app
+
+        from models import Song
+
+        manifest = load_manifest() if args.reuse else None
+
+        if manifest is None or manifest.get("scale") != args.scale:
+            manifest = seed(SCALES[args.scale], lyrics_bytes=0)
+            manifest["scale"] = args.scale
+            save_manifest(manifest)
+
+        owner_id = manifest["owner_id"]
+        song_id = Song.query.filter_by(user_id=owner_id).first().id
+        setlist_id = manifest["setlist_ids"][min(manifest["setlist_ids"], key=int)]
+        headers = {
+            "Cookie": f"{current_app.session_cookie_name}="
+            + session_cookie(app, owner_id)
+        }
+
+    endpoints = [
+        ("GET /songs/<id>/fetch-lyrics", f"/songs/{song_id}/fetch-lyrics"),
+        ("GET /api/setlists/<id>/get-songs", f"/api/setlists/{setlist_id}/get-songs"),
+    ]
+    lyrics_api, lyrics_api_url = start_lyrics_api(args.api_delay)
+    os.environ["LYRICS_API_URL"] = lyrics_api_url
+    port = free_port()
+
+    try:
+        for worker_class in args.worker_classes:
+            # Set through the environment, which gunicorn.conf.py reads to
+            # decide whether to patch for gevent before preloading the app.
+            os.environ["GUNICORN_WORKER_CLASS"] = worker_class
+            extra_args = ["--worker-connections", str(max(args.clients))]
+
+            for name, path in endpoints:
+                for clients in args.clients:
+                    # A fresh server for each run, so requests still queued
+                    # from the last run don't slow this one down.
+                    server = start_gunicorn(port, args.workers, extra_args)
+
+                    try:
+                        key = f"{name} [{worker_class}, {clients} clients]"
+                        results[key] = load(
+                            port, path, headers, clients, args.seconds, args.timeout
+                        )
+                        print(f"{key}: {results[key]}")
+                    finally:
+                        server.terminate()
+                        server.wait()
+    finally:
+        lyrics_api.shutdown()
+
+    params = {
+        key: value for key, value in vars(args).items() if key not in ("out", "reuse")
+    }
+    path = write_results(f"concurrency-{args.scale}", params, results, args.out)
+    print(f"Results written to {path}")
+
+
+if __name__ == "__main__":
+    main()
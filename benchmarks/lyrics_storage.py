@@ -0,0 +1,177 @@
+"""Measures what moving lyrics out of the songs table saves.
+
+Seeds a catalog, then copies it into songs_inline, a table laid out the way
+songs was before lyrics moved to song_lyrics (lyrics stored inline, as plain
+text). Reports the size of each table and p50/p90/p99 times of the song
+listing queries against both layouts, run the way the ORM runs them (every
+mapped column of the page fetched).
+
+Usage:
+    BENCH_DATABASE_URL=... python -m benchmarks.lyrics_storage --scale 100k
+    BENCH_DATABASE_URL=... python -m benchmarks.lyrics_storage --compress-over 1024
+    BENCH_DATABASE_URL=... python -m benchmarks.lyrics_storage --copies 10
+"""
+
+import argparse
+import time
+
+from benchmarks.common import Timer, bench_app, summarize, write_results
+from benchmarks.seed import SCALES, seed
+
+INLINE_TABLE = "songs_inline"
+PAGE_SIZE = 20
+
+
+def copy_inline(db):
+    """Creates songs_inline: every song with its lyrics in the same row."""
+
+    from models import Song
+
+    db.session.execute(f"DROP TABLE IF EXISTS {INLINE_TABLE}")
+    db.session.execute(
+        f"CREATE TABLE {INLINE_TABLE} (id INTEGER PRIMARY KEY, user_id INTEGER, "
+        "title TEXT NOT NULL, artist TEXT NOT NULL, lyrics TEXT)"
+    )
+
+    rows = []
+    insert = (
+        f"INSERT INTO {INLINE_TABLE} (id, user_id, title, artist, lyrics) "
+        "VALUES (:id, :user_id, :title, :artist, :lyrics)"
+    )
+
+    for song in Song.query.options(*Song.with_lyrics).yield_per(5_000):
+        rows.append(dict(song.serialize(), lyrics=song.lyrics))
+
+        if len(rows) == 5_000:
+            db.session.execute(insert, rows)
+            rows = []
+
+    if rows:
+        db.session.execute(insert, rows)
+
+    db.session.commit()
+
+
+def table_sizes(db, tables):
+    """Returns the on-disk size in bytes of each table, or None if unknown."""
+
+    dialect = db.engine.dialect.name
+
+    if dialect == "postgresql":
+        return {
+            table: db.session.execute(
+                "SELECT pg_total_relation_size(:table)", {"table": table}
+            ).scalar()
+            for table in tables
+        }
+
+    if dialect == "sqlite":
+        try:
+            sizes = dict(
+                db.session.execute(
+                    "SELECT name, SUM(pgsize) FROM dbstat GROUP BY name"
+                ).fetchall()
+            )
+        except Exception:
+            # SQLite built without SQLITE_ENABLE_DBSTAT_VTAB.
+            db.session.rollback()
+            return {table: None for table in tables}
+
+        return {table: sizes.get(table) for table in tables}
+
+    return {table: None for table in tables}
+
+
+def listing_queries(song_count, term):
+    """Returns (name, current SQL, inline SQL) for each benchmarked query."""
+
+    columns = "id, user_id, title, artist"
+    offset = max(song_count // 2 - PAGE_SIZE, 0)
+
+    queries = [
+        (
+            "GET /songs page",
+            f"ORDER BY title LIMIT {PAGE_SIZE} OFFSET {offset}",
+        ),
+        ("title search", f"WHERE title LIKE '%{term.title()}%' ORDER BY title"),
+        ("full scan", ""),
+    ]
+
+    return [
+        (
+            name,
+            f"SELECT {columns} FROM songs {clause}",
+            f"SELECT {columns}, lyrics FROM {INLINE_TABLE} {clause}",
+        )
+        for name, clause in queries
+    ]
+
+
+def time_query(db, sql, repeats):
+    """Runs a query repeatedly, fetching every row, and summarizes the timings."""
+
+    samples = []
+
+    with Timer() as total:
+        for _ in range(repeats):
+            start = time.perf_counter()
+            db.session.execute(sql).fetchall()
+            samples.append(time.perf_counter() - start)
+
+    return summarize(samples, total.elapsed)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--scale", choices=SCALES, default="1k")
+    parser.add_argument("--lyrics-bytes", type=int, default=1500)
+    parser.add_argument(
+        "--compress-over",
+        type=int,
+        help="Compress lyrics longer than this many characters.",
+    )
+    parser.add_argument(
+        "--copies", type=int, default=1, help="Users who add each canonical song."
+    )
+    parser.add_argument("--repeats", type=int, default=20)
+    parser.add_argument("--out", help="Results file (default: benchmarks/results/).")
+    args = parser.parse_args()
+
+    app = bench_app()
+    results = {}
+
+    with app.app_context():
+        from models import db, lyrics_settings
+
+        lyrics_settings["compress_over"] = args.compress_over
+        manifest = seed(
+            SCALES[args.scale], lyrics_bytes=args.lyrics_bytes, copies=args.copies
+        )
+        copy_inline(db)
+
+        sizes = table_sizes(
+            db, ["songs", "song_lyrics", "canonical_lyrics", INLINE_TABLE]
+        )
+        results["table_bytes"] = sizes
+        print(f"Table sizes (bytes): {sizes}")
+
+        for name, current, inline in listing_queries(
+            manifest["songs"], manifest["search_term"]
+        ):
+            results[f"{name} [inline lyrics]"] = time_query(db, inline, args.repeats)
+            results[f"{name} [song_lyrics]"] = time_query(db, current, args.repeats)
+            print(
+                f"{name}: inline p50 {results[f'{name} [inline lyrics]']['p50_ms']} ms, "
+                f"split p50 {results[f'{name} [song_lyrics]']['p50_ms']} ms"
+            )
+
+        db.session.execute(f"DROP TABLE {INLINE_TABLE}")
+        db.session.commit()
+
+    params = {key: value for key, value in vars(args).items() if key not in ("out",)}
+    path = write_results(f"lyrics-storage-{args.scale}", params, results, args.out)
+    print(f"Results written to {path}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,151 @@
+"""Benchmarks the cost of moving a song within setlists of different lengths.
+
+Compares the gapped ordering keys the app uses (see models.ORDER_GAP) with
+dense 0..n-1 positions, where a move renumbers every song between its old and
+new place. For each setlist length, reports the rows written per move and the
+p50/p90/p99 time of applying and committing a move.
+
+Usage: BENCH_DATABASE_URL=... python -m benchmarks.ordering --moves 200
+"""
+
+import argparse
+import random
+import time
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from benchmarks.common import Timer, bench_app, summarize, write_results
+from benchmarks.seed import seed
+
+SETLIST_LENGTHS = (10, 50, 100, 200, 500, 1000)
+WRITES = ("INSERT", "UPDATE", "DELETE")
+
+
+class RowCounter:
+    """Counts the setlists_songs rows written while it's listening."""
+
+    def __init__(self):
+        self.rows = 0
+
+    def record(self, conn, cursor, statement, parameters, context, executemany):
+        if statement.lstrip().startswith(WRITES) and "setlists_songs" in statement:
+            self.rows += max(cursor.rowcount, 0)
+
+    def __enter__(self):
+        event.listen(Engine, "after_cursor_execute", self.record)
+        return self
+
+    def __exit__(self, *exc_info):
+        event.remove(Engine, "after_cursor_execute", self.record)
+
+
+def entries_of(setlist_id):
+    """Returns a setlist's SetlistSong rows in order."""
+
+    from models import SetlistSong
+
+    return (
+        SetlistSong.query.filter_by(setlist_id=setlist_id)
+        .order_by(SetlistSong.index)
+        .all()
+    )
+
+
+def renumber(setlist_id, step, offset):
+    """Renumbers a setlist's songs as offset, offset + step, ..."""
+
+    from models import db
+
+    for position, entry in enumerate(entries_of(setlist_id)):
+        entry.index = offset + position * step
+    db.session.commit()
+
+
+def move_dense(setlist_id, source, target):
+    """Moves a song, renumbering every row whose dense position changes."""
+
+    from models import db
+
+    entries = entries_of(setlist_id)
+    entries.insert(target, entries.pop(source))
+
+    for position, entry in enumerate(entries):
+        if entry.index != position:
+            entry.index = position
+    db.session.commit()
+
+
+def move_gapped(setlist_id, source, target):
+    """Moves a song the way the patch API does."""
+
+    from models import db, Setlist
+
+    Setlist.query.get(setlist_id).apply_song_ops(
+        [{"op": "move", "from": source, "to": target}]
+    )
+    db.session.commit()
+
+
+def run(setlist_id, length, move, moves, rng):
+    """Applies random moves to a setlist, returning timing and rows written."""
+
+    samples = []
+
+    with RowCounter() as counter, Timer() as total:
+        for _ in range(moves):
+            source, target = rng.randrange(length), rng.randrange(length)
+            start = time.perf_counter()
+            move(setlist_id, source, target)
+            samples.append(time.perf_counter() - start)
+
+    result = summarize(samples, total.elapsed)
+    result["rows_written_per_move"] = round(counter.rows / moves, 2)
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        "--lengths",
+        type=int,
+        nargs="+",
+        default=SETLIST_LENGTHS,
+        help="Setlist lengths to benchmark.",
+    )
+    parser.add_argument("--moves", type=int, default=200)
+    parser.add_argument("--out", help="Results file (default: benchmarks/results/).")
+    args = parser.parse_args()
+
+    app = bench_app()
+    results = {}
+
+    with app.app_context():
+        from models import ORDER_GAP
+
+        manifest = seed(max(args.lengths), setlist_sizes=args.lengths, lyrics_bytes=0)
+
+        for length in args.lengths:
+            setlist_id = manifest["setlist_ids"][str(length)]
+
+            renumber(setlist_id, 1, 0)
+            dense = run(setlist_id, length, move_dense, args.moves, random.Random(1))
+            renumber(setlist_id, ORDER_GAP, ORDER_GAP)
+            gapped = run(setlist_id, length, move_gapped, args.moves, random.Random(1))
+
+            results[f"dense [{length}]"] = dense
+            results[f"gapped [{length}]"] = gapped
+            print(
+                f"{length:>5} songs: "
+                f"dense {dense['rows_written_per_move']} rows, {dense['p50_ms']} ms; "
+                f"gapped {gapped['rows_written_per_move']} rows, "
+                f"{gapped['p50_ms']} ms"
+            )
+
+    params = {"lengths": args.lengths, "moves": args.moves}
+    path = write_results("ordering", params, results, args.out)
+    print(f"Results written to {path}")
+
+
+if __name__ == "__main__":
+    main()
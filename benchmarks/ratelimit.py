@@ -0,0 +1,96 @@
+"""Measures what a rate limit check costs, with each kind of bucket storage.
+
+Times taking a token from buckets kept in memory and in the benchmark
+database (as RATE_LIMIT_STORAGE_URL would share them between processes),
+spread over a number of clients, then the same with several processes taking
+from the database at once, reporting p50/p90/p99 per check and throughput.
+
+Usage: BENCH_DATABASE_URL=sqlite:////tmp/ratelimit.db python -m benchmarks.ratelimit
+"""
+
+import argparse
+import multiprocessing
+import time
+
+from benchmarks.common import Timer, bench_database_url, summarize, write_results
+
+
+def time_checks(buckets, count, clients):
+    """Takes count tokens from buckets for clients, and summarizes the latency.
+
+    Checks the storage can't answer (which the app lets through) are errors."""
+
+    from sqlalchemy.exc import SQLAlchemyError
+
+    from ratelimit import Rate
+
+    # Big enough that no check is refused, so every one writes its bucket.
+    rate = Rate(f"{count}/second")
+    samples = []
+    errors = 0
+
+    with Timer() as total:
+        for number in range(count):
+            client = number % clients
+            key = f"do_search:user:ip:10.0.{client // 256}.{client % 256}"
+
+            with Timer() as timer:
+                try:
+                    buckets.take(key, rate, time.time())
+                except SQLAlchemyError:
+                    errors += 1
+            samples.append(timer.elapsed)
+
+    return summarize(samples, total.elapsed, errors)
+
+
+def run_worker(args):
+    """Times checks against the shared database in a process of its own."""
+
+    from ratelimit import DatabaseBuckets
+
+    url, count, clients = args
+    return time_checks(DatabaseBuckets(url), count, clients)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--checks", type=int, default=5000)
+    parser.add_argument("--clients", type=int, default=1000)
+    parser.add_argument("--processes", type=int, default=4)
+    parser.add_argument("--out", help="Results file (default: benchmarks/results/).")
+    args = parser.parse_args()
+
+    from ratelimit import DatabaseBuckets, MemoryBuckets
+
+    url = bench_database_url()
+    shared = DatabaseBuckets(url)
+    shared.reset()
+    results = {}
+
+    for key, buckets in (("memory", MemoryBuckets()), ("database", shared)):
+        results[key] = time_checks(buckets, args.checks, args.clients)
+        print(f"{key}: {results[key]}")
+
+    with multiprocessing.Pool(args.processes) as pool:
+        with Timer() as total:
+            workers = pool.map(
+                run_worker, [(url, args.checks, args.clients)] * args.processes
+            )
+
+    key = f"database, {args.processes} processes"
+    results[key] = {
+        "errors": sum(worker["errors"] for worker in workers),
+        "p50_ms": max(worker["p50_ms"] for worker in workers),
+        "p99_ms": max(worker["p99_ms"] for worker in workers),
+        "throughput_rps": round(args.checks * args.processes / total.elapsed, 1),
+    }
+    print(f"{key}: {results[key]}")
+
+    params = {key: value for key, value in vars(args).items() if key != "out"}
+    path = write_results("ratelimit", params, results, args.out)
+    print(f"Results written to {path}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,285 @@
+"""Throughput and latency benchmarks for the app's core routes.
+
+Runs each route either in-process through the Flask test client or over HTTP
+against a local gunicorn, and writes throughput and p50/p90/p99 latency per
+route to a JSON results file.
+
+Usage:
+    BENCH_DATABASE_URL=... python -m benchmarks.routes --scale 1k
+    BENCH_DATABASE_URL=... python -m benchmarks.routes --scale 100k \\
+        --mode gunicorn --workers 4 --concurrency 16
+"""
+
+import argparse
+import http.client
+import json
+import os
+import socket
+import subprocess
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
+
+from benchmarks.common import (
+    Timer,
+    bench_app,
+    bench_database_url,
+    session_cookie,
+    summarize,
+    write_results,
+)
+from benchmarks.seed import SCALES, load_manifest, save_manifest, seed
+
+GUNICORN_CONFIG = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "gunicorn.conf.py"
+)
+
+
+def route_specs(manifest, song_orders):
+    """Returns (name, method, path, json_body) for every benchmarked route."""
+
+    specs = [
+        ("GET /songs", "GET", "/songs?page=2", None),
+        (
+            "GET /search",
+            "GET",
+            f"/search?category=title&term={manifest['search_term']}",
+            None,
+        ),
+    ]
+
+    for size, setlist_id in sorted(
+        manifest["setlist_ids"].items(), key=lambda item: int(item[0])
+    ):
+        specs += [
+            (f"GET /setlists/<id> [{size}]", "GET", f"/setlists/{setlist_id}", None),
+            (
+                f"GET /api/setlists/<id>/get-songs [{size}]",
+                "GET",
+                f"/api/setlists/{setlist_id}/get-songs",
+                None,
+            ),
+            (
+                f"POST /api/setlists/<id>/update-songs [{size}]",
+                "POST",
+                f"/api/setlists/{setlist_id}/update-songs",
+                {"songs": song_orders[setlist_id], "notes": "Benchmark setlist"},
+            ),
+        ]
+
+    return specs
+
+
+def current_song_orders(manifest):
+    """Returns the current song id order of every benchmarked setlist."""
+
+    from models import Setlist
+
+    return {
+        setlist_id: [song.id for song in Setlist.query.get(setlist_id).songs]
+        for setlist_id in manifest["setlist_ids"].values()
+    }
+
+
+############################################################
+# Flask test client
+
+
+def run_client(app, manifest, specs, requests, max_seconds):
+    """Benchmarks each route sequentially through the Flask test client."""
+
+    from app import CURR_USER_KEY
+
+    results = {}
+    client = app.test_client()
+
+    with client.session_transaction() as sess:
+        sess[CURR_USER_KEY] = manifest["owner_id"]
+
+    for name, method, path, body in specs:
+        samples = []
+        errors = 0
+        deadline = time.perf_counter() + max_seconds
+
+        with Timer() as total:
+            for _ in range(requests):
+                start = time.perf_counter()
+                resp = client.open(path, method=method, json=body)
+                samples.append(time.perf_counter() - start)
+                errors += resp.status_code >= 400
+
+                if time.perf_counter() > deadline:
+                    break
+
+        results[name] = summarize(samples, total.elapsed, errors)
+        print(f"{name}: {results[name]}")
+
+    return results
+
+
+############################################################
+# Local gunicorn
+
+
+def free_port():
+    """Returns a free local TCP port."""
+
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def start_gunicorn(port, workers, extra_args):
+    """Starts gunicorn serving the app on a local port and waits until it's up.
+
+    Uses the production settings in gunicorn.conf.py, apart from the address,
+    the worker count and any extra arguments."""
+
+    env = dict(os.environ, DATABASE_URL=bench_database_url(), QUERY_LOG_ENABLED="0")
+    # gunicorn 20.0 can't be run with -m, so start it the way its script does.
+    process = subprocess.Popen(
+        [
+            sys.executable,
+            "-c",
+            "from gunicorn.app.wsgiapp import run; run()",
+            "app:app",
+            "--config",
+            GUNICORN_CONFIG,
+            "--bind",
+            f"127.0.0.1:{port}",
+            "--workers",
+            str(workers),
+        ]
+        + extra_args,
+        env=env,
+    )
+
+    deadline = time.time() + 60
+    while time.time() < deadline:
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=1).close()
+            return process
+        except OSError:
+            time.sleep(0.2)
+
+    process.terminate()
+    sys.exit("gunicorn didn't start within 60 seconds.")
+
+
+def run_http(app, manifest, specs, requests, max_seconds, port, concurrency):
+    """Benchmarks each route over HTTP with concurrent keep-alive clients."""
+
+    from flask import current_app
+
+    headers = {
+        "Cookie": f"{current_app.session_cookie_name}="
+        + session_cookie(app, manifest["owner_id"]),
+        "Content-Type": "application/json",
+    }
+    results = {}
+
+    for name, method, path, body in specs:
+        samples = []
+        errors = [0]
+        lock = Lock()
+        remaining = [requests]
+        deadline = time.perf_counter() + max_seconds
+        payload = json.dumps(body) if body is not None else None
+
+        def worker():
+            conn = http.client.HTTPConnection("127.0.0.1", port, timeout=120)
+
+            while time.perf_counter() < deadline:
+                with lock:
+                    if remaining[0] <= 0:
+                        break
+                    remaining[0] -= 1
+
+                start = time.perf_counter()
+                try:
+                    conn.request(method, path, body=payload, headers=headers)
+                    resp = conn.getresponse()
+                    resp.read()
+                    failed = resp.status >= 400
+                except (OSError, http.client.HTTPException):
+                    conn.close()
+                    conn = http.client.HTTPConnection("127.0.0.1", port, timeout=120)
+                    failed = True
+                elapsed = time.perf_counter() - start
+
+                with lock:
+                    samples.append(elapsed)
+                    errors[0] += failed
+
+            conn.close()
+
+        with Timer() as total, ThreadPoolExecutor(concurrency) as pool:
+            for _ in range(concurrency):
+                pool.submit(worker)
+
+        results[name] = summarize(samples, total.elapsed, errors[0])
+        print(f"{name}: {results[name]}")
+
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--scale", choices=SCALES, default="1k")
+    parser.add_argument("--mode", choices=("client", "gunicorn"), default="client")
+    parser.add_argument("--requests", type=int, default=200)
+    parser.add_argument(
+        "--max-seconds", type=float, default=30, help="Time budget per route."
+    )
+    parser.add_argument("--workers", type=int, default=2)
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument(
+        "--gunicorn-arg", action="append", default=[], help="Extra gunicorn argument."
+    )
+    parser.add_argument(
+        "--reuse", action="store_true", help="Reuse the last seeded catalog."
+    )
+    parser.add_argument("--out", help="Results file (default: benchmarks/results/).")
+    args = parser.parse_args()
+
+    app = bench_app()
+
+    with app.app_context():
+        manifest = load_manifest() if args.reuse else None
+
+        if manifest is None or manifest.get("scale") != args.scale:
+            manifest = seed(SCALES[args.scale])
+            manifest["scale"] = args.scale
+            save_manifest(manifest)
+
+        specs = route_specs(manifest, current_song_orders(manifest))
+
+        if args.mode == "client":
+            results = run_client(app, manifest, specs, args.requests, args.max_seconds)
+        else:
+            port = free_port()
+            server = start_gunicorn(port, args.workers, args.gunicorn_arg)
+            try:
+                results = run_http(
+                    app,
+                    manifest,
+                    specs,
+                    args.requests,
+                    args.max_seconds,
+                    port,
+                    args.concurrency,
+                )
+            finally:
+                server.terminate()
+                server.wait()
+
+    params = {
+        key: value for key, value in vars(args).items() if key not in ("out", "reuse")
+    }
+    path = write_results(f"routes-{args.scale}-{args.mode}", params, results, args.out)
+    print(f"Results written to {path}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,259 @@
+"""Seeds the benchmark database with a synthetic catalog.
+
+Usage: BENCH_DATABASE_URL=... python -m benchmarks.seed --scale 100k
+"""
+
+import argparse
+import json
+import os
+import random
+
+from benchmarks.common import RESULTS_DIR, Timer, bench_app
+
+SCALES = {"1k": 1_000, "100k": 100_000, "1m": 1_000_000}
+SETLIST_SIZES = (10, 50, 100, 200)
+CHUNK_SIZE = 5_000
+MANIFEST_PATH = os.path.join(RESULTS_DIR, "seed-manifest.json")
+
+WORDS = (
+    "love night heart fire river road home rain blue dream light summer "
+    "city girl boy dance baby time world moon star gold wild running "
+    "broken little hold away tonight forever ocean highway ghost shadow "
+    "morning whiskey angel devil sweet bitter lonely electric paper"
+).split()
+
+
+def make_title(rng):
+    """Returns a random song title."""
+
+    return " ".join(rng.choice(WORDS) for _ in range(rng.randint(1, 4))).title()
+
+
+def make_lyrics(rng, size):
+    """Returns roughly size bytes of random lyrics."""
+
+    lines = []
+    length = 0
+
+    while length < size:
+        line = " ".join(rng.choice(WORDS) for _ in range(rng.randint(4, 9)))
+        lines.append(line.capitalize())
+        length += len(line) + 1
+
+    return "\n".join(lines)
+
+
+def insert_chunked(db, table, rows):
+    """Inserts rows into a table in chunks, committing after each one."""
+
+    for start in range(0, len(rows), CHUNK_SIZE):
+        db.session.execute(table.insert(), rows[start : start + CHUNK_SIZE])
+        db.session.commit()
+
+
+def seed(
+    song_count, setlist_sizes=SETLIST_SIZES, lyrics_bytes=800, copies=1, rng_seed=42
+):
+    """Recreates the schema and fills it with synthetic users, songs and setlists.
+
+    Every canonical song is added by `copies` different users. Returns a
+    manifest of the ids the route benchmarks need."""
+
+    import catalog
+    from models import (
+        db,
+        User,
+        Song,
+        CanonicalSong,
+        CanonicalLyrics,
+        Setlist,
+        SetlistSong,
+        ORDER_GAP,
+        lyrics_columns,
+        normalize_key,
+    )
+
+    rng = random.Random(rng_seed)
+
+    db.drop_all()
+    db.create_all()
+
+    # bcrypt is deliberately slow, so every synthetic user shares one hash.
+    password = User.hash_password("benchmark")
+    user_count = max(10, song_count // 100)
+    insert_chunked(
+        db,
+        User.__table__,
+        [
+            {
+                "id": user_id,
+                "username": f"bench{user_id}",
+                "email": f"bench{user_id}@example.com",
+                "password": password,
+                "darkmode": False,
+            }
+            for user_id in range(1, user_count + 1)
+        ],
+    )
+
+    canonicals = []
+    lyrics = []
+    songs = []
+    keys = set()
+    for song_id in range(1, song_count + 1):
+        if (song_id - 1) % copies == 0:
+            title, artist = make_title(rng), make_title(rng)
+            while (normalize_key(title), normalize_key(artist)) in keys:
+                title = make_title(rng)
+            keys.add((normalize_key(title), normalize_key(artist)))
+
+            canonical_id = len(keys)
+            canonicals.append(
+                {
+                    "id": canonical_id,
+                    "title": title,
+                    "artist": artist,
+                    "title_key": normalize_key(title),
+                    "artist_key": normalize_key(artist),
+                }
+            )
+            lyrics.append(
+                dict(
+                    lyrics_columns(make_lyrics(rng, lyrics_bytes)),
+                    canonical_id=canonical_id,
+                )
+            )
+
+        songs.append(
+            {
+                "id": song_id,
+                "user_id": song_id % user_count + 1,
+                "title": title,
+                "artist": artist,
+                "canonical_id": canonical_id,
+                "shares_lyrics": True,
+            }
+        )
+
+        if len(songs) == CHUNK_SIZE:
+            insert_chunked(db, CanonicalSong.__table__, canonicals)
+            insert_chunked(db, CanonicalLyrics.__table__, lyrics)
+            insert_chunked(db, Song.__table__, songs)
+            canonicals = []
+            lyrics = []
+            songs = []
+
+    insert_chunked(db, CanonicalSong.__table__, canonicals)
+    insert_chunked(db, CanonicalLyrics.__table__, lyrics)
+    insert_chunked(db, Song.__table__, songs)
+
+    # The benchmarked setlists belong to user 1; filler setlists spread the
+    # rest of setlists_songs across every user so listings have realistic size.
+    setlists = []
+    setlist_songs = []
+    setlist_ids = {}
+    filler_count = max(10, song_count // 100)
+
+    for setlist_id, size in enumerate(
+        list(setlist_sizes) + [20] * filler_count, start=1
+    ):
+        is_benchmarked = setlist_id <= len(setlist_sizes)
+        setlists.append(
+            {
+                "id": setlist_id,
+                "user_id": 1 if is_benchmarked else setlist_id % user_count + 1,
+                "name": f"{make_title(rng)} Tour {setlist_id}",
+                "notes": "Benchmark setlist",
+            }
+        )
+
+        if is_benchmarked:
+            setlist_ids[str(size)] = setlist_id
+
+        for index, song_id in enumerate(
+            rng.sample(range(1, song_count + 1), min(size, song_count))
+        ):
+            setlist_songs.append(
+                {
+                    "setlist_id": setlist_id,
+                    "song_id": song_id,
+                    "index": (index + 1) * ORDER_GAP,
+                }
+            )
+
+    insert_chunked(db, Setlist.__table__, setlists)
+    insert_chunked(db, SetlistSong.__table__, setlist_songs)
+    Setlist.refresh_summaries()
+    db.session.commit()
+
+    reset_sequences(db)
+
+    # The songs were inserted behind catalog_changes' back.
+    catalog.invalidate()
+
+    return {
+        "songs": song_count,
+        "users": user_count,
+        "owner_id": 1,
+        "setlist_ids": setlist_ids,
+        "search_term": rng.choice(WORDS),
+    }
+
+
+def reset_sequences(db):
+    """Moves Postgres id sequences past the explicitly inserted ids."""
+
+    if db.engine.dialect.name != "postgresql":
+        return
+
+    for table in ("users", "canonical_songs", "songs", "setlists", "setlists_songs"):
+        db.session.execute(
+            f"SELECT setval(pg_get_serial_sequence('{table}', 'id'), "
+            f"(SELECT COALESCE(MAX(id), 1) FROM {table}))"
+        )
+
+    db.session.commit()
+
+
+def load_manifest():
+    """Returns the manifest of the last seeding run, if there is one."""
+
+    if not os.path.exists(MANIFEST_PATH):
+        return None
+
+    with open(MANIFEST_PATH) as manifest_file:
+        return json.load(manifest_file)
+
+
+def save_manifest(manifest):
+    """Saves the manifest of a seeding run for later benchmark runs."""
+
+    os.makedirs(RESULTS_DIR, exist_ok=True)
+
+    with open(MANIFEST_PATH, "w") as manifest_file:
+        json.dump(manifest, manifest_file, indent=2)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--scale", choices=SCALES, default="1k")
+    parser.add_argument("--lyrics-bytes", type=int, default=800)
+    parser.add_argument(
+        "--copies", type=int, default=1, help="Users who add each canonical song."
+    )
+    args = parser.parse_args()
+
+    app = bench_app()
+
+    with app.app_context(), Timer() as timer:
+        manifest = seed(
+            SCALES[args.scale], lyrics_bytes=args.lyrics_bytes, copies=args.copies
+        )
+
+    manifest["scale"] = args.scale
+    save_manifest(manifest)
+    print(f"Seeded {args.scale} catalog in {timer.elapsed:.1f}s: {manifest}")
+
+
+if __name__ == "__main__":
+    main()
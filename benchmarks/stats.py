@@ -0,0 +1,88 @@
+"""Measures the statistics page against computing its aggregates per request.
+
+Seeds a catalog (without lyrics), refreshes the statistics summary tables,
+then reports p50/p90/p99 latency for /stats and /api/v1/stats through the
+Flask test client, alongside the time a refresh takes and the time the
+page's GROUP BY queries take when run directly against the live tables, as
+they would without the summary tables.
+
+Usage: BENCH_DATABASE_URL=... python -m benchmarks.stats --scale 1m
+"""
+
+import argparse
+
+from benchmarks.common import Timer, bench_app, summarize, write_results
+from benchmarks.seed import SCALES, load_manifest, save_manifest, seed
+
+
+def time_requests(client, path, count):
+    """Requests a path count times, and summarizes the latency."""
+
+    samples = []
+
+    with Timer() as total:
+        for _ in range(count):
+            with Timer() as timer:
+                client.get(path).get_data()
+            samples.append(timer.elapsed)
+
+    return summarize(samples, total.elapsed)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--scale", choices=SCALES, default="1k")
+    parser.add_argument("--requests", type=int, default=200)
+    parser.add_argument(
+        "--reuse", action="store_true", help="Reuse the last seeded catalog."
+    )
+    parser.add_argument("--out", help="Results file (default: benchmarks/results/).")
+    args = parser.parse_args()
+
+    app = bench_app()
+    results = {}
+
+    with app.app_context():
+        import stats
+        from models import db
+
+        manifest = load_manifest() if args.reuse else None
+
+        if manifest is None or manifest.get("scale") != args.scale:
+            manifest = seed(SCALES[args.scale], lyrics_bytes=0)
+            manifest["scale"] = args.scale
+            save_manifest(manifest)
+
+        with Timer() as refresh:
+            stats.refresh()
+
+        live = {}
+
+        for name, query in (
+            ("song usage", stats.song_usage()),
+            ("user catalogs", stats.user_usage()),
+        ):
+            with Timer() as timer:
+                db.session.execute(query).fetchall()
+            live[name] = round(timer.elapsed * 1000, 1)
+
+        results["refresh_ms"] = round(refresh.elapsed * 1000, 1)
+        results["live aggregate ms"] = live
+        print(f"refresh: {results['refresh_ms']} ms, live aggregates: {live}")
+
+        client = app.test_client()
+
+        for path in ("/stats", "/api/v1/stats"):
+            client.get(path)
+            results[f"GET {path}"] = time_requests(client, path, args.requests)
+            print(f"GET {path}: {results[f'GET {path}']}")
+
+    params = {
+        key: value for key, value in vars(args).items() if key not in ("out", "reuse")
+    }
+    path = write_results(f"stats-{args.scale}", params, results, args.out)
+    print(f"Results written to {path}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,153 @@
+"""Measures gunicorn's memory use per worker, with and without preloading.
+
+Starts gunicorn with the production settings (gunicorn.conf.py) once with
+GUNICORN_PRELOAD=0 and once with GUNICORN_PRELOAD=1, warms every worker up
+with requests to the core routes, then reads each process's memory from
+/proc/<pid>/smaps_rollup (Linux only). Reports RSS, PSS (resident memory with
+shared pages split between the processes sharing them) and private memory for
+the master and the average worker, and the total PSS of the whole server.
+
+Usage: BENCH_DATABASE_URL=... python -m benchmarks.worker_memory --workers 4
+"""
+
+import argparse
+import http.client
+import os
+import time
+
+from benchmarks.common import bench_app, session_cookie, write_results
+from benchmarks.routes import free_port, start_gunicorn
+from benchmarks.seed import SCALES, load_manifest, save_manifest, seed
+
+MEMORY_FIELDS = {"Rss": "rss_mb", "Pss": "pss_mb"}
+PRIVATE_FIELDS = ("Private_Clean", "Private_Dirty")
+
+
+def process_memory(pid):
+    """Returns a process's RSS, PSS and private memory in megabytes."""
+
+    kilobytes = {}
+
+    with open(f"/proc/{pid}/smaps_rollup") as rollup:
+        for line in rollup:
+            parts = line.split()
+            if len(parts) == 3 and parts[2] == "kB":
+                kilobytes[parts[0].rstrip(":")] = int(parts[1])
+
+    memory = {key: kilobytes[field] / 1024 for field, key in MEMORY_FIELDS.items()}
+    memory["private_mb"] = sum(kilobytes[field] for field in PRIVATE_FIELDS) / 1024
+    return memory
+
+
+def child_pids(pid):
+    """Returns the ids of a process's child processes."""
+
+    children = []
+
+    for entry in os.listdir("/proc"):
+        if not entry.isdigit():
+            continue
+
+        try:
+            with open(f"/proc/{entry}/stat") as stat:
+                # The parent id follows the parenthesized command name.
+                fields = stat.read().rsplit(")", 1)[1].split()
+        except OSError:
+            continue
+
+        if int(fields[1]) == pid:
+            children.append(int(entry))
+
+    return children
+
+
+def warm_up(port, paths, headers, rounds):
+    """Requests each path repeatedly on fresh connections, to warm up every worker."""
+
+    for _ in range(rounds):
+        for path in paths:
+            conn = http.client.HTTPConnection("127.0.0.1", port, timeout=60)
+            conn.request("GET", path, headers=headers)
+            conn.getresponse().read()
+            conn.close()
+
+
+def average(samples):
+    """Returns the per-key average of a list of memory dictionaries."""
+
+    return {
+        key: round(sum(sample[key] for sample in samples) / len(samples), 1)
+        for key in samples[0]
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--scale", choices=SCALES, default="1k")
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--rounds", type=int, default=50)
+    parser.add_argument(
+        "--reuse", action="store_true", help="Reuse the last seeded catalog."
+    )
+    parser.add_argument("--out", help="Results file (default: benchmarks/results/).")
+    args = parser.parse_args()
+
+    app = bench_app()
+    results = {}
+
+    with app.app_context():
+        from flask import current_app
+
+        manifest = load_manifest() if args.reuse else None
+
+        if manifest is None or manifest.get("scale") != args.scale:
+            manifest = seed(SCALES[args.scale])
+            manifest["scale"] = args.scale
+            save_manifest(manifest)
+
+        headers = {
+            "Cookie": f"{current_app.session_cookie_name}="
+            + session_cookie(app, manifest["owner_id"])
+        }
+
+    paths = [
+        "/songs",
+        "/setlists",
+        f"/search?category=title&term={manifest['search_term']}",
+    ] + [f"/setlists/{setlist_id}" for setlist_id in manifest["setlist_ids"].values()]
+
+    for preload in ("0", "1"):
+        os.environ["GUNICORN_PRELOAD"] = preload
+        port = free_port()
+        server = start_gunicorn(port, args.workers, [])
+
+        try:
+            warm_up(port, paths, headers, args.rounds)
+            time.sleep(1)
+
+            master = process_memory(server.pid)
+            workers = [process_memory(pid) for pid in child_pids(server.pid)]
+        finally:
+            server.terminate()
+            server.wait()
+
+        key = "preload" if preload == "1" else "no preload"
+        results[key] = {
+            "master": {name: round(value, 1) for name, value in master.items()},
+            "worker": average(workers),
+            "workers": len(workers),
+            "total_pss_mb": round(
+                master["pss_mb"] + sum(worker["pss_mb"] for worker in workers), 1
+            ),
+        }
+        print(f"{key}: {results[key]}")
+
+    params = {
+        key: value for key, value in vars(args).items() if key not in ("out", "reuse")
+    }
+    path = write_results("worker-memory", params, results, args.out)
+    print(f"Results written to {path}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,495 @@
+"""A shared, memory-mapped snapshot of the song catalog.
+
+The song listing and the setlist editor's song picker read every song's id,
+owner, title and artist, in title order. Rather than have each gunicorn worker
+query them (or hold its own copy), one snapshot of them is written to a file
+that every worker maps read-only, so they share a single copy in the page
+cache, and reading a song or a page of songs copies nothing but the strings
+returned.
+
+The file is a header followed by flat arrays of 32-bit integers and one blob
+of strings:
+
+    ids           song ids, ascending
+    user_ids      owners' ids, or 0 for none
+    offsets       where each title and artist starts in the blob; song i's
+                  title is blob[offsets[2i]:offsets[2i + 1] - 1], its artist
+                  blob[offsets[2i + 1]:offsets[2i + 2] - 1]
+    title_order   row numbers of the songs sorted by normalized title (see
+                  models.normalize_key), then id
+    blob          the titles and artists, UTF-8, each followed by a NUL
+
+Every write to a song's catalog fields also adds a row to catalog_changes (see
+models.CatalogChange). The snapshot records the (max id, count) of that table
+it was built against, and is only used while the table still matches; when it
+doesn't, views fall back to the ORM and a rebuild is started. A rebuild
+re-reads just the songs named in catalog_changes and merges them into the old
+snapshot, unless the old snapshot is too old to trust, in which case it reads
+the whole catalog. It then prunes changes older than CATALOG_CHANGE_WINDOW
+seconds, which every up-to-date snapshot has applied. By default rebuilds run
+in a separate process (python -m catalog), so a worker never spends its
+request time on one. Only one process builds at a time, holding a lock on the
+snapshot's .lock file; a worker takes the lock before starting a builder and
+hands it over, so while one is running no other is started.
+"""
+
+import fcntl
+import hashlib
+import mmap
+import os
+import struct
+import subprocess
+import sys
+import threading
+import time
+from array import array
+from bisect import bisect_left
+from collections import namedtuple
+from datetime import datetime, timedelta
+from heapq import merge
+from itertools import accumulate
+
+from sqlalchemy import func, select
+
+from models import db, CatalogChange, Song, normalize_key
+
+MAGIC = b"SLMCAT02"
+# Magic, build time, token (max change id or -1, change count), song count,
+# blob size, and the database the snapshot was built from.
+HEADER = struct.Struct("<8sdqIII8s4x")
+ROW_CHUNK = 5_000
+
+settings = {
+    "path": None,
+    "database": b"",
+    "rebuild": "background",
+    "change_window": 600,
+    "spawn_interval": 1.0,
+}
+
+# The snapshot this process has mapped, and when it last started a rebuild.
+_state = {"snapshot": None, "spawned_at": 0.0}
+_lock = threading.Lock()
+
+
+class CatalogSong(namedtuple("CatalogSong", "id user_id title artist")):
+    """A song as the catalog snapshot holds it."""
+
+    __slots__ = ()
+
+    def serialize(self):
+        """Returns a dictionary with the fields of the song, like Song.serialize."""
+
+        return {
+            "id": self.id,
+            "user_id": self.user_id,
+            "title": self.title,
+            "artist": self.artist,
+        }
+
+
+class CatalogSnapshot:
+    """A read-only view of one snapshot file."""
+
+    def __init__(self, path):
+        with open_file(path, os.O_RDONLY, "rb") as snapshot_file:
+            self.file_id = os.fstat(snapshot_file.fileno()).st_ino
+            self.map = mmap.mmap(snapshot_file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        (
+            magic,
+            self.built_at,
+            max_change_id,
+            change_count,
+            count,
+            blob_size,
+            self.database,
+        ) = HEADER.unpack_from(self.map)
+
+        if magic != MAGIC:
+            raise ValueError(f"{path} isn't a catalog snapshot.")
+
+        self.token = (None if max_change_id < 0 else max_change_id, change_count)
+        view = memoryview(self.map)
+        position = HEADER.size
+
+        def take(length):
+            nonlocal position
+            part = view[position : position + 4 * length].cast("I")
+            position += 4 * length
+            return part
+
+        self.ids = take(count)
+        self.user_ids = take(count)
+        self.offsets = take(2 * count + 1)
+        self.title_order = take(count)
+        self.blob = view[position : position + blob_size]
+
+    def __len__(self):
+        return len(self.ids)
+
+    def string(self, number):
+        """Returns the blob's numberth string."""
+
+        start, end = self.offsets[number], self.offsets[number + 1] - 1
+        return str(self.blob[start:end], "utf-8")
+
+    def row(self, row):
+        """Returns the song in a row."""
+
+        return CatalogSong(
+            self.ids[row],
+            self.user_ids[row] or None,
+            self.string(2 * row),
+            self.string(2 * row + 1),
+        )
+
+    def get(self, song_id):
+        """Returns a song by id, or None."""
+
+        row = bisect_left(self.ids, song_id)
+
+        if row < len(self.ids) and self.ids[row] == song_id:
+            return self.row(row)
+
+        return None
+
+    def by_title(self, start=0, stop=None, exclude=()):
+        """Returns songs in title order, from position start to stop.
+
+        Songs whose ids are in exclude are skipped (and not counted)."""
+
+        if not exclude:
+            return [self.row(row) for row in self.title_order[start:stop]]
+
+        ids = self.ids
+        rows = [row for row in self.title_order if ids[row] not in exclude]
+        return [self.row(row) for row in rows[start:stop]]
+
+    def rows(self):
+        """Returns every song, as lists of ids, user ids, titles and artists."""
+
+        strings = str(self.blob[:-1], "utf-8").split("\0") if len(self) else []
+        return self.ids.tolist(), self.user_ids.tolist(), strings[0::2], strings[1::2]
+
+
+def write_snapshot(path, rows, token, database):
+    """Writes songs (id, user_id, title, artist), sorted by id, to a snapshot file.
+
+    The file is written beside path and moved into place, so readers see the
+    old snapshot or the new one, never half of one."""
+
+    ids, user_ids, titles, artists = rows
+    strings = [None] * (2 * len(ids))
+    strings[0::2] = titles
+    strings[1::2] = artists
+    encoded = [text.replace("\0", "").encode() for text in strings]
+    offsets = array("I", accumulate([0] + [len(text) + 1 for text in encoded]))
+    blob = b"\0".join(encoded) + b"\0" if encoded else b""
+    title_keys = [normalize_key(title) for title in titles]
+    title_order = array("I", sorted(range(len(ids)), key=title_keys.__getitem__))
+    max_change_id, change_count = token
+
+    partial = f"{path}.{os.getpid()}.tmp"
+
+    # Left over from a process that had this pid, or planted.
+    if os.path.lexists(partial):
+        os.remove(partial)
+
+    with open_file(
+        partial, os.O_WRONLY | os.O_CREAT | os.O_EXCL, "wb"
+    ) as snapshot_file:
+        snapshot_file.write(
+            HEADER.pack(
+                MAGIC,
+                time.time(),
+                -1 if max_change_id is None else max_change_id,
+                change_count,
+                len(ids),
+                len(blob),
+                database,
+            )
+        )
+        for part in (
+            array("I", ids),
+            array("I", [user_id or 0 for user_id in user_ids]),
+            offsets,
+            title_order,
+        ):
+            snapshot_file.write(part.tobytes())
+        snapshot_file.write(blob)
+
+    os.replace(partial, path)
+
+
+def change_token(session_or_connection, **options):
+    """Returns the (max id, count) of catalog_changes, as snapshots record it."""
+
+    return tuple(
+        session_or_connection.execute(
+            select([func.max(CatalogChange.id), func.count(CatalogChange.id)]),
+            **options,
+        ).first()
+    )
+
+
+def load():
+    """Returns the snapshot file mapped into this process, remapping a newer one."""
+
+    path = settings["path"]
+
+    try:
+        file_id = os.stat(path).st_ino
+    except OSError:
+        return None
+
+    with _lock:
+        snapshot = _state["snapshot"]
+
+        if snapshot is None or snapshot.file_id != file_id:
+            try:
+                snapshot = CatalogSnapshot(path)
+            except (OSError, ValueError, struct.error):
+                return None
+
+            # The old mapping is unmapped once no view of it is left.
+            _state["snapshot"] = snapshot
+
+        return snapshot
+
+
+def current_snapshot():
+    """Returns the catalog snapshot if it's up to date, or None.
+
+    When it isn't, rebuilds it (CATALOG_REBUILD=inline) or starts a builder
+    process to, and in the meantime the caller should use the database."""
+
+    if not settings["path"]:
+        return None
+
+    snapshot = load()
+    # The snapshot is built from the primary, so compare it with the primary,
+    # even in views that read from a replica.
+    token = change_token(db.session, bind=db.engine)
+
+    if is_fresh(snapshot, token):
+        return snapshot
+
+    if settings["rebuild"] == "inline":
+        build()
+        snapshot = load()
+        return snapshot if is_fresh(snapshot, token) else None
+
+    start_builder()
+    return None
+
+
+def is_fresh(snapshot, token):
+    """Returns whether a snapshot was built from this database at this change token."""
+
+    return (
+        snapshot is not None
+        and snapshot.database == settings["database"]
+        and snapshot.token == token
+    )
+
+
+def start_builder():
+    """Starts a builder process, unless one is running or this process started
+    one just now.
+
+    The builder inherits the build lock taken here, so other workers see it
+    as building from the moment it's started."""
+
+    now = time.monotonic()
+
+    with _lock:
+        if now - _state["spawned_at"] < settings["spawn_interval"]:
+            return
+        _state["spawned_at"] = now
+
+    lock_file = lock_builds()
+
+    if lock_file is None:
+        return
+
+    with lock_file:
+        fd = lock_file.fileno()
+        subprocess.Popen(
+            [sys.executable, "-m", "catalog"],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            env=dict(os.environ, CATALOG_LOCK_FD=str(fd)),
+            pass_fds=(fd,),
+            stdin=subprocess.DEVNULL,
+        )
+
+
+def lock_builds():
+    """Returns the build lock's file, locked, or None if another process holds it."""
+
+    lock_file = open_file(f"{settings['path']}.lock", os.O_RDWR | os.O_CREAT, "w")
+
+    try:
+        fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        lock_file.close()
+        return None
+
+    return lock_file
+
+
+def build(full=False):
+    """Brings the snapshot up to date with the database, or rebuilds it in full.
+
+    Returns False without doing anything if another process is building it."""
+
+    lock_file = lock_builds()
+
+    if lock_file is None:
+        return False
+
+    with lock_file, db.engine.begin() as connection:
+        rebuild(connection, full)
+
+    return True
+
+
+def rebuild(connection, full):
+    """Writes a new snapshot from the old one and the songs changed since."""
+
+    old = load()
+
+    if not full and is_fresh(old, change_token(connection)):
+        return
+
+    window = timedelta(seconds=settings["change_window"])
+    now = datetime.utcnow()
+    changes = connection.execute(
+        select(
+            [CatalogChange.id, CatalogChange.song_id, CatalogChange.created_at]
+        ).order_by(CatalogChange.id)
+    ).fetchall()
+
+    # A snapshot older than half the window may have missed changes that
+    # have since been pruned, and one ahead of the table's latest change was
+    # built before the table was emptied (the database reset, say).
+    full = (
+        full
+        or old is None
+        or old.database != settings["database"]
+        or time.time() - old.built_at > window.total_seconds() / 2
+        or (old.token[0] or 0) > (changes[-1].id if changes else 0)
+    )
+    columns = [Song.id, Song.user_id, Song.title, Song.artist]
+
+    if full:
+        fetched = connection.execute(select(columns).order_by(Song.id)).fetchall()
+        rows = [list(column) for column in zip(*fetched)] or [[], [], [], []]
+    else:
+        changed = sorted({change.song_id for change in changes})
+        fetched = []
+
+        for start in range(0, len(changed), ROW_CHUNK):
+            fetched += connection.execute(
+                select(columns).where(Song.id.in_(changed[start : start + ROW_CHUNK]))
+            ).fetchall()
+
+        changed = set(changed)
+        kept = [song for song in zip(*old.rows()) if song[0] not in changed]
+        merged = merge(kept, sorted(tuple(song) for song in fetched))
+        rows = [list(column) for column in zip(*merged)] or [[], [], [], []]
+
+    # Keep the latest change, so the table's max id never goes backwards.
+    pruned = [change.id for change in changes[:-1] if change.created_at < now - window]
+
+    for start in range(0, len(pruned), ROW_CHUNK):
+        connection.execute(
+            CatalogChange.__table__.delete().where(
+                CatalogChange.id.in_(pruned[start : start + ROW_CHUNK])
+            )
+        )
+
+    token = (changes[-1].id if changes else None, len(changes) - len(pruned))
+    write_snapshot(settings["path"], rows, token, settings["database"])
+
+
+def build_until_fresh(lock_file):
+    """Rebuilds until the snapshot matches the database, holding the build lock."""
+
+    with lock_file:
+        while True:
+            with db.engine.begin() as connection:
+                rebuild(connection, False)
+
+            with db.engine.connect() as connection:
+                if is_fresh(load(), change_token(connection)):
+                    return
+
+
+def unload():
+    """Drops this process's mapping of the snapshot, once nothing else uses it."""
+
+    with _lock:
+        _state["snapshot"] = None
+
+
+def invalidate():
+    """Deletes the snapshot, so the next read rebuilds it in full."""
+
+    unload()
+
+    if settings["path"] and os.path.exists(settings["path"]):
+        os.remove(settings["path"])
+
+
+def open_file(path, flags, mode):
+    """Opens one of the snapshot's files, readable only by this user.
+
+    Symlinks aren't followed, so one planted where a file is expected can't
+    redirect what's read or written."""
+
+    return os.fdopen(os.open(path, flags | os.O_NOFOLLOW, 0o600), mode)
+
+
+def default_path(database_url, directory):
+    """Returns where to keep the snapshot of a database, or None for in-memory ones."""
+
+    if database_url in ("sqlite://", "sqlite:///:memory:"):
+        return None
+
+    digest = hashlib.sha1(database_url.encode()).hexdigest()[:12]
+    return os.path.join(directory, f"catalog-{digest}.bin")
+
+
+def init_catalog(app):
+    """Sets up the catalog snapshot for the Flask app, unless CATALOG_PATH is off."""
+
+    database_url = app.config["SQLALCHEMY_DATABASE_URI"]
+    path = app.config.get("CATALOG_PATH")
+
+    if path is None:
+        # The app's instance folder, rather than the shared temp directory.
+        path = default_path(database_url, app.instance_path)
+        if path is not None:
+            os.makedirs(app.instance_path, mode=0o700, exist_ok=True)
+
+    settings["path"] = path or None
+    settings["database"] = hashlib.sha1(database_url.encode()).digest()[:8]
+    settings["rebuild"] = app.config.get("CATALOG_REBUILD", "background")
+    settings["change_window"] = app.config.get("CATALOG_CHANGE_WINDOW", 600)
+
+
+if __name__ == "__main__":
+    # A builder process, started by start_builder with the build lock already
+    # taken, or by hand. This file runs as __main__, so use the catalog module
+    # the app has set up.
+    inherited = os.environ.pop("CATALOG_LOCK_FD", None)
+
+    from app import app
+    from catalog import build_until_fresh, lock_builds
+
+    with app.app_context():
+        lock_file = os.fdopen(int(inherited), "w") if inherited else lock_builds()
+
+        if lock_file is not None:
+            build_until_fresh(lock_file)
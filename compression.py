@@ -0,0 +1,189 @@
+"""Response compression for the Setlist Manager.
+
+CompressionMiddleware wraps the app's WSGI callable, so it sees responses
+after every after_request hook (the debug toolbar's included), and compresses
+text responses (HTML, JSON, CSS, JavaScript and the like) with brotli or gzip,
+whichever the client prefers. Brotli is only offered if the brotli package is
+installed. Responses under COMPRESS_MIN_SIZE bytes, responses that are already
+encoded or marked no-transform, and other types (live sync's event streams
+among them, which must never be buffered) are passed through as they are.
+
+Compressed bodies of cacheable responses, those with an ETag (such as static
+files), are kept in a small LRU cache, so each is compressed once per
+encoding rather than on every request.
+"""
+
+import gzip
+import threading
+from collections import OrderedDict
+
+from werkzeug.datastructures import Headers
+from werkzeug.http import parse_accept_header, parse_options_header
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+COMPRESSIBLE_TYPES = {
+    "application/javascript",
+    "application/json",
+    "image/svg+xml",
+    "text/css",
+    "text/html",
+    "text/javascript",
+    "text/plain",
+}
+UNCOMPRESSIBLE_STATUSES = ("1", "204", "206", "304")
+
+
+def available_encodings():
+    """Returns the encodings this process can produce, most preferred first."""
+
+    return ["br", "gzip"] if brotli is not None else ["gzip"]
+
+
+def compress(body, encoding, levels):
+    """Returns a body compressed with an encoding, at the configured level."""
+
+    if encoding == "br":
+        return brotli.compress(body, quality=levels["br"])
+
+    return gzip.compress(body, compresslevel=levels["gzip"], mtime=0)
+
+
+class CompressedBodyCache:
+    """A thread-safe LRU cache of compressed response bodies."""
+
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+
+    def get(self, key):
+        with self.lock:
+            body = self.entries.get(key)
+
+            if body is not None:
+                self.entries.move_to_end(key)
+
+            return body
+
+    def put(self, key, body):
+        if self.max_entries <= 0:
+            return
+
+        with self.lock:
+            self.entries[key] = body
+            self.entries.move_to_end(key)
+
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+
+class CompressionMiddleware:
+    """WSGI middleware compressing responses the client can decode."""
+
+    def __init__(self, app, min_size=500, levels=None, cache_size=256):
+        self.app = app
+        self.min_size = min_size
+        self.levels = {"gzip": 6, "br": 4, **(levels or {})}
+        self.cache = CompressedBodyCache(cache_size)
+
+    def __call__(self, environ, start_response):
+        accept = parse_accept_header(environ.get("HTTP_ACCEPT_ENCODING", ""))
+        encoding = accept.best_match(available_encodings())
+
+        if encoding is None or environ["REQUEST_METHOD"] == "HEAD":
+            return self.app(environ, start_response)
+
+        captured = []
+
+        def capture_start_response(status, headers, exc_info=None):
+            captured[:] = [status, Headers(headers), exc_info]
+            return lambda data: None
+
+        app_iter = self.app(environ, capture_start_response)
+        status, headers, exc_info = captured
+
+        if not self.should_compress(status, headers):
+            start_response(status, headers.to_wsgi_list(), exc_info)
+            return app_iter
+
+        headers.add("Vary", "Accept-Encoding")
+
+        cache_key = self.cache_key(environ, headers, encoding)
+        body = self.cache.get(cache_key) if cache_key else None
+
+        if body is None:
+            try:
+                original = b"".join(app_iter)
+            finally:
+                if hasattr(app_iter, "close"):
+                    app_iter.close()
+
+            if len(original) < self.min_size:
+                start_response(status, headers.to_wsgi_list(), exc_info)
+                return [original]
+
+            body = compress(original, encoding, self.levels)
+
+            if cache_key:
+                self.cache.put(cache_key, body)
+        elif hasattr(app_iter, "close"):
+            app_iter.close()
+
+        headers["Content-Encoding"] = encoding
+        headers["Content-Length"] = str(len(body))
+
+        # The compressed body isn't byte-for-byte the one the ETag names.
+        if "ETag" in headers and not headers["ETag"].startswith("W/"):
+            headers["ETag"] = "W/" + headers["ETag"]
+
+        start_response(status, headers.to_wsgi_list(), exc_info)
+        return [body]
+
+    def should_compress(self, status, headers):
+        """Returns whether a response is worth trying to compress."""
+
+        mimetype = parse_options_header(headers.get("Content-Type", ""))[0]
+        length = headers.get("Content-Length")
+
+        return (
+            not status.startswith(UNCOMPRESSIBLE_STATUSES)
+            and mimetype in COMPRESSIBLE_TYPES
+            and "Content-Encoding" not in headers
+            and "no-transform" not in headers.get("Cache-Control", "")
+            and not (length is not None and int(length) < self.min_size)
+        )
+
+    def cache_key(self, environ, headers, encoding):
+        """Returns the cache key for a cacheable response, or None."""
+
+        cache_control = headers.get("Cache-Control", "")
+
+        if (
+            "ETag" not in headers
+            or "private" in cache_control
+            or ("no-store" in cache_control)
+        ):
+            return None
+
+        return (environ.get("PATH_INFO"), headers["ETag"], encoding)
+
+
+def init_compression(app):
+    """Compresses the Flask app's responses, unless COMPRESS_ENABLED is off."""
+
+    if not app.config.get("COMPRESS_ENABLED", True):
+        return
+
+    app.wsgi_app = CompressionMiddleware(
+        app.wsgi_app,
+        min_size=app.config.get("COMPRESS_MIN_SIZE", 500),
+        levels={
+            "gzip": app.config.get("COMPRESS_GZIP_LEVEL", 6),
+            "br": app.config.get("COMPRESS_BROTLI_LEVEL", 4),
+        },
+        cache_size=app.config.get("COMPRESS_CACHE_SIZE", 256),
+    )
@@ -0,0 +1,308 @@
+"""Offline export of a user's setlists, with lyrics, as a streamed ZIP archive.
+
+The archive holds every setlist in each of the chosen formats: a standalone
+HTML page (html/), Markdown (markdown/) and JSON (json/), plus an index.html
+linking the HTML pages. It's written as it's sent: each format is one pass
+over a server-side cursor (Query.yield_per) of the user's setlist songs and
+their lyrics, in setlist and song order, and each song is rendered, deflated
+and handed to the client before the next row is fetched. So memory stays
+bounded however many setlists or songs the account has, and the archive's
+size never needs to be known up front (entries carry their sizes after their
+data, as ZIP allows for streamed archives).
+
+The same archive is served at /your-setlists/export and written by
+`flask export-setlists <username>`.
+"""
+
+import json
+import time
+import zipfile
+from itertools import chain, groupby
+
+import click
+from flask import Response, get_template_attribute, stream_with_context
+from flask.cli import with_appcontext
+from sqlalchemy import and_, case
+from werkzeug.utils import secure_filename
+
+from models import (
+    db,
+    CanonicalLyrics,
+    Setlist,
+    SetlistSong,
+    Song,
+    SongLyrics,
+    StoredLyrics,
+    User,
+)
+
+FORMATS = {"html": "html", "md": "markdown", "json": "json"}
+CURSOR_BATCH = 200
+
+
+class StreamedArchiveFile:
+    """A write-only file for ZipFile, whose contents are taken as they're written.
+
+    It can tell but not seek, which makes ZipFile write a streamable archive."""
+
+    def __init__(self):
+        self.chunks = []
+        self.position = 0
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        self.position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.position
+
+    def flush(self):
+        pass
+
+    def take(self):
+        """Returns what's been written since the last call."""
+
+        data = b"".join(self.chunks)
+        self.chunks.clear()
+        return data
+
+
+def stream_zip(entries):
+    """Yields a ZIP archive of entries, (name, text chunks) pairs, as it's written."""
+
+    output = StreamedArchiveFile()
+    date_time = time.localtime()[:6]
+
+    with zipfile.ZipFile(output, "w") as archive:
+        for name, chunks in entries:
+            info = zipfile.ZipInfo(name, date_time)
+            info.compress_type = zipfile.ZIP_DEFLATED
+
+            with archive.open(info, "w") as entry:
+                for chunk in chunks:
+                    entry.write(chunk.encode())
+                    data = output.take()
+
+                    if data:
+                        yield data
+
+            yield output.take()
+
+    yield output.take()
+
+
+def setlist_rows(user_id):
+    """Returns a streamed query of a user's setlists' songs, with their lyrics.
+
+    Rows come in setlist and song order; a setlist without songs has one row,
+    with None for the song's columns."""
+
+    has_own = SongLyrics.song_id.isnot(None)
+
+    return (
+        db.session.query(
+            Setlist.id.label("setlist_id"),
+            Setlist.name,
+            Setlist.notes,
+            Song.id.label("song_id"),
+            Song.title,
+            Song.artist,
+            case([(has_own, SongLyrics.text)], else_=CanonicalLyrics.text).label(
+                "text"
+            ),
+            case(
+                [(has_own, SongLyrics.compressed)], else_=CanonicalLyrics.compressed
+            ).label("compressed"),
+        )
+        .outerjoin(SetlistSong, SetlistSong.setlist_id == Setlist.id)
+        .outerjoin(Song, Song.id == SetlistSong.song_id)
+        .outerjoin(SongLyrics, SongLyrics.song_id == Song.id)
+        .outerjoin(
+            CanonicalLyrics,
+            and_(CanonicalLyrics.canonical_id == Song.canonical_id, Song.shares_lyrics),
+        )
+        .filter(Setlist.user_id == user_id)
+        .order_by(Setlist.id, SetlistSong.index)
+        .yield_per(CURSOR_BATCH)
+    )
+
+
+def entry_name(setlist_id, name, extension):
+    """Returns the archive file name of a setlist in one format."""
+
+    return f"{setlist_id}-{secure_filename(name) or 'setlist'}.{extension}"
+
+
+def render_html(setlist, songs):
+    """Yields a setlist's standalone HTML page, song by song."""
+
+    render_song = get_template_attribute("export-setlist.html", "song")
+
+    yield get_template_attribute("export-setlist.html", "header")(setlist)
+
+    for number, song in enumerate(songs, start=1):
+        yield render_song(number, song)
+
+    yield get_template_attribute("export-setlist.html", "footer")()
+
+
+def render_markdown(setlist, songs):
+    """Yields a setlist as Markdown, song by song."""
+
+    yield f"# {setlist.name}\n\n"
+
+    if setlist.notes:
+        yield f"{setlist.notes}\n\n"
+
+    for number, song in enumerate(songs, start=1):
+        yield (
+            f"## {number}. {song['title']}\n\n"
+            f"*{song['artist']}*\n\n"
+            f"{song['lyrics'] or '_No lyrics._'}\n\n"
+        )
+
+
+def render_json(setlist, songs):
+    """Yields a setlist as JSON, song by song."""
+
+    head = {"id": setlist.setlist_id, "name": setlist.name, "notes": setlist.notes}
+    yield json.dumps(head)[:-1] + ', "songs": ['
+
+    for number, song in enumerate(songs):
+        yield (", " if number else "") + json.dumps(song)
+
+    yield "]}\n"
+
+
+RENDERERS = {"html": render_html, "md": render_markdown, "json": render_json}
+
+
+def song_record(row):
+    """Returns the song in a setlist row, with its lyrics."""
+
+    return {
+        "id": row.song_id,
+        "title": row.title,
+        "artist": row.artist,
+        "lyrics": StoredLyrics.decode(row.text, row.compressed),
+    }
+
+
+def setlist_entries(user_id, extension):
+    """Yields an archive entry for each of a user's setlists, in one format."""
+
+    for _, rows in groupby(setlist_rows(user_id), key=lambda row: row.setlist_id):
+        first = next(rows)
+        song_rows = chain([first], rows) if first.song_id is not None else ()
+        name = entry_name(first.setlist_id, first.name, extension)
+
+        yield f"{FORMATS[extension]}/{name}", RENDERERS[extension](
+            first, (song_record(row) for row in song_rows)
+        )
+
+
+def index_entry(user):
+    """Returns the archive's index page, linking each setlist's HTML page."""
+
+    setlists = (
+        db.session.query(Setlist.id, Setlist.name)
+        .filter(Setlist.user_id == user.id)
+        .order_by(Setlist.id)
+        .yield_per(CURSOR_BATCH)
+    )
+    links = (
+        get_template_attribute("export-setlist.html", "index_link")(
+            f"html/{entry_name(setlist_id, name, 'html')}", name
+        )
+        for setlist_id, name in setlists
+    )
+
+    def chunks():
+        yield get_template_attribute("export-setlist.html", "index_header")(user)
+        yield from links
+        yield get_template_attribute("export-setlist.html", "index_footer")()
+
+    return "index.html", chunks()
+
+
+def export_archive(user, formats=tuple(FORMATS)):
+    """Yields a ZIP archive of a user's setlists in some formats, as it's written."""
+
+    def entries():
+        if "html" in formats:
+            yield index_entry(user)
+
+        for extension in formats:
+            yield from setlist_entries(user.id, extension)
+
+    return stream_zip(entries())
+
+
+def archive_name(user):
+    """Returns the file name to save a user's archive as."""
+
+    return f"{secure_filename(user.username) or 'user'}-setlists.zip"
+
+
+def export_response(user, formats=tuple(FORMATS)):
+    """Returns a response streaming a user's archive as a download."""
+
+    return Response(
+        stream_with_context(export_archive(user, formats)),
+        mimetype="application/zip",
+        headers={"Content-Disposition": f'attachment; filename="{archive_name(user)}"'},
+    )
+
+
+def parse_formats(text):
+    """Returns the formats named in a comma-separated list, or raises ValueError."""
+
+    formats = [name.strip() for name in (text or "").split(",") if name.strip()]
+
+    if not formats:
+        return tuple(FORMATS)
+
+    unknown = [name for name in formats if name not in FORMATS]
+
+    if unknown:
+        raise ValueError(
+            f"Unknown format {unknown[0]!r}; use any of {', '.join(FORMATS)}."
+        )
+
+    return tuple(dict.fromkeys(formats))
+
+
+@click.command("export-setlists")
+@click.argument("username")
+@click.option("--output", "-o", help="Archive path (default: <username>-setlists.zip).")
+@click.option(
+    "--formats", help="Comma-separated formats: html, md, json (default: all)."
+)
+@with_appcontext
+def export_command(username, output, formats):
+    """Writes a user's setlists, with lyrics, to a ZIP archive for offline use."""
+
+    user = User.query.filter_by(username=username).first()
+
+    if user is None:
+        raise click.UsageError(f"No user named {username!r}.")
+
+    try:
+        formats = parse_formats(formats)
+    except ValueError as error:
+        raise click.UsageError(str(error))
+
+    output = output or archive_name(user)
+
+    with open(output, "wb") as archive_file:
+        for chunk in export_archive(user, formats):
+            archive_file.write(chunk)
+
+    click.echo(f"Exported {username}'s setlists to {output}")
+
+
+def init_export(app):
+    """Adds the export-setlists command to the Flask app."""
+
+    app.cli.add_command(export_command)
@@ -0,0 +1,50 @@
+"""Gunicorn settings for serving the Setlist Manager (see the Procfile).
+
+Every setting can be overridden from the environment. By default the app is
+preloaded in the master, so workers share its imported code, and served by
+gevent workers, which hold live sync streams and slow requests in greenlets.
+Workers are recycled after GUNICORN_MAX_REQUESTS requests (with some jitter,
+so they don't all restart at once) to bound their memory; live sync streams on
+a recycled worker reconnect by themselves.
+"""
+
+import os
+
+bind = f"0.0.0.0:{os.environ.get('PORT', '8000')}"
+workers = int(os.environ.get("WEB_CONCURRENCY", 2))
+worker_class = os.environ.get("GUNICORN_WORKER_CLASS", "gevent")
+worker_connections = int(os.environ.get("GUNICORN_WORKER_CONNECTIONS", 1000))
+preload_app = os.environ.get("GUNICORN_PRELOAD", "1") == "1"
+max_requests = int(os.environ.get("GUNICORN_MAX_REQUESTS", 1000))
+max_requests_jitter = int(os.environ.get("GUNICORN_MAX_REQUESTS_JITTER", 100))
+keepalive = int(os.environ.get("GUNICORN_KEEPALIVE", 5))
+timeout = int(os.environ.get("GUNICORN_TIMEOUT", 30))
+graceful_timeout = int(os.environ.get("GUNICORN_GRACEFUL_TIMEOUT", 30))
+
+if preload_app and worker_class == "gevent":
+    # gevent workers patch the standard library as they start, which is too
+    # late for modules the preloaded app has already imported (requests,
+    # threading, psycopg2), so patch before the app is loaded.
+    from gevent import monkey
+
+    monkey.patch_all()
+
+
+def post_fork(server, worker):
+    """Drops the database connections a worker inherits from the master.
+
+    Preloading opens connections in the master (creating the schema, for
+    one), and a connection used by two processes at once corrupts both."""
+
+    if not server.cfg.preload_app:
+        return
+
+    import ratelimit
+    from models import db
+    from replicas import settings
+
+    for bind in [None] + settings["binds"]:
+        db.get_engine(bind=bind).dispose()
+
+    if isinstance(ratelimit.buckets, ratelimit.DatabaseBuckets):
+        ratelimit.buckets.engine.dispose()
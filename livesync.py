@@ -0,0 +1,311 @@
+"""Live setlist sync over Server-Sent Events.
+
+Pages showing a setlist subscribe to /api/setlists/<id>/events and are sent
+each change to it as a small diff, along with the song the band leader is on
+in perform mode. Event streams sit idle nearly all the time, so the app is
+served by gevent workers (see the Procfile): each stream is a greenlet rather
+than a thread, and holds no database connection while it waits. Eventlet
+workers work too.
+
+Events are fanned out by a broker. MemoryBroker delivers them within one
+process, which is all a single worker or the tests need; PostgresBroker relays
+them between workers and dynos with LISTEN/NOTIFY.
+"""
+
+import json
+import logging
+import queue
+import select
+import threading
+import time
+from collections import defaultdict
+
+from flask import Response
+from sqlalchemy.engine.url import make_url
+
+from models import db
+
+logger = logging.getLogger("setlist.livesync")
+
+NOTIFY_CHANNEL = "setlist_events"
+# Postgres refuses NOTIFY payloads of 8000 bytes or more; bigger events are
+# replaced by a reload event.
+MAX_NOTIFY_BYTES = 7900
+
+
+class Subscription:
+    """The queue of events waiting to be sent to one open event stream."""
+
+    def __init__(self, channel, max_pending):
+        self.channel = channel
+        self.events = queue.Queue(max_pending)
+        self.overflowed = False
+
+    def put(self, message):
+        """Queues an (event, data) message, noting if the stream has fallen behind."""
+
+        try:
+            self.events.put_nowait(message)
+        except queue.Full:
+            self.overflowed = True
+
+    def get(self, timeout):
+        """Returns the next message, or None if none arrives within timeout seconds."""
+
+        try:
+            return self.events.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+
+class MemoryBroker:
+    """Publishes setlist events to the subscribers in this process.
+
+    A retained event (like the leader's current song) is also kept and sent
+    to anyone subscribing later, for as long as the channel has subscribers."""
+
+    def __init__(self, max_pending=100):
+        self.max_pending = max_pending
+        self.lock = threading.Lock()
+        self.subscriptions = defaultdict(set)
+        self.retained = {}
+
+    def subscribe(self, channel):
+        """Returns a new Subscription to a channel's events."""
+
+        subscription = Subscription(channel, self.max_pending)
+
+        with self.lock:
+            self.subscriptions[channel].add(subscription)
+            retained = self.retained.get(channel)
+
+        if retained is not None:
+            subscription.put(retained)
+
+        return subscription
+
+    def unsubscribe(self, subscription):
+        """Stops delivering events to a Subscription."""
+
+        with self.lock:
+            subscriptions = self.subscriptions.get(subscription.channel)
+
+            if subscriptions is not None:
+                subscriptions.discard(subscription)
+
+                if not subscriptions:
+                    del self.subscriptions[subscription.channel]
+                    self.retained.pop(subscription.channel, None)
+
+    def subscriber_count(self, channel):
+        """Returns the number of open subscriptions to a channel."""
+
+        with self.lock:
+            return len(self.subscriptions.get(channel, ()))
+
+    def publish(self, channel, event, data, retain=False):
+        """Sends an event to every subscriber to a channel."""
+
+        self.deliver(channel, event, data, retain)
+
+    def deliver(self, channel, event, data, retain=False):
+        """Queues an event for this process's subscribers to a channel."""
+
+        message = (event, data)
+
+        with self.lock:
+            subscriptions = list(self.subscriptions.get(channel, ()))
+
+            if retain and subscriptions:
+                self.retained[channel] = message
+
+        for subscription in subscriptions:
+            subscription.put(message)
+
+
+class PostgresBroker(MemoryBroker):
+    """Publishes setlist events to subscribers in every process, via NOTIFY.
+
+    Each process LISTENs on one connection, opened when its first stream
+    subscribes, and hands the notifications on to its own subscribers."""
+
+    def __init__(self, url, max_pending=100):
+        super().__init__(max_pending)
+        self.url = make_url(url)
+        self.listener = None
+
+    def connect_args(self):
+        """Returns psycopg2.connect()'s arguments for the database URL.
+
+        The URL is parsed by SQLAlchemy's dialect, as for the app's own
+        connections, so driver names and query parameters mean the same."""
+
+        return self.url.get_dialect()().create_connect_args(self.url)
+
+    def publish(self, channel, event, data, retain=False):
+        payload = json.dumps(
+            {"channel": channel, "event": event, "data": data, "retain": retain}
+        )
+
+        if len(payload.encode()) > MAX_NOTIFY_BYTES:
+            payload = json.dumps(
+                {"channel": channel, "event": "reload", "data": {}, "retain": False}
+            )
+
+        db.session.execute(
+            "SELECT pg_notify(:channel, :payload)",
+            {"channel": NOTIFY_CHANNEL, "payload": payload},
+        )
+        db.session.commit()
+
+    def subscribe(self, channel):
+        with self.lock:
+            if self.listener is None or not self.listener.is_alive():
+                self.listener = threading.Thread(
+                    target=self.listen, name="livesync-listener", daemon=True
+                )
+                self.listener.start()
+
+        return super().subscribe(channel)
+
+    def listen(self):
+        """Relays notifications to this process's subscribers, reconnecting on error."""
+
+        import psycopg2
+
+        while True:
+            conn = None
+
+            try:
+                args, kwargs = self.connect_args()
+                conn = psycopg2.connect(*args, **kwargs)
+                conn.autocommit = True
+
+                with conn.cursor() as cursor:
+                    cursor.execute(f"LISTEN {NOTIFY_CHANNEL}")
+
+                while True:
+                    if select.select([conn], [], [], 60) == ([], [], []):
+                        continue
+
+                    conn.poll()
+
+                    while conn.notifies:
+                        message = json.loads(conn.notifies.pop(0).payload)
+                        self.deliver(
+                            message["channel"],
+                            message["event"],
+                            message["data"],
+                            message["retain"],
+                        )
+            except (psycopg2.Error, OSError, ValueError):
+                logger.exception("Live sync listener failed; reconnecting")
+                time.sleep(1)
+            finally:
+                if conn is not None:
+                    conn.close()
+
+
+broker = MemoryBroker()
+settings = {"keepalive": 15.0}
+
+
+def setlist_channel(setlist_id):
+    """Returns the broker channel for a setlist's events."""
+
+    return f"setlist:{setlist_id}"
+
+
+def publish_setlist_event(setlist_id, event, data, retain=False):
+    """Sends an event to everyone watching a setlist."""
+
+    broker.publish(setlist_channel(setlist_id), event, data, retain)
+
+
+def format_event(event, data):
+    """Returns an event in Server-Sent Events wire format."""
+
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+def event_stream(subscription, first_events, keepalive):
+    """Yields a subscription's events, with comments to keep the connection open."""
+
+    try:
+        yield "retry: 3000\n\n"
+
+        for event, data in first_events:
+            yield format_event(event, data)
+
+        while True:
+            message = subscription.get(keepalive)
+
+            if subscription.overflowed:
+                # The client missed events, so it has to start over.
+                yield format_event("reload", {})
+                return
+
+            if message is None:
+                yield ": keepalive\n\n"
+            else:
+                yield format_event(*message)
+    finally:
+        broker.unsubscribe(subscription)
+
+
+def setlist_event_response(setlist_id, first_events=()):
+    """Returns a streaming response of a setlist's events.
+
+    Subscribes straight away, so no event published after this returns is
+    missed. The stream runs outside the request context, so it holds no
+    database session."""
+
+    subscription = broker.subscribe(setlist_channel(setlist_id))
+
+    return Response(
+        event_stream(subscription, list(first_events), settings["keepalive"]),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+def make_psycopg_cooperative():
+    """Lets other greenlets run while psycopg2 waits, under gevent or eventlet."""
+
+    try:
+        from gevent import monkey
+    except ImportError:
+        pass
+    else:
+        if monkey.is_module_patched("socket"):
+            from psycogreen.gevent import patch_psycopg
+
+            patch_psycopg()
+            return
+
+    try:
+        from eventlet import patcher
+    except ImportError:
+        return
+
+    if patcher.is_monkey_patched("socket"):
+        from psycogreen.eventlet import patch_psycopg
+
+        patch_psycopg()
+
+
+def init_livesync(app):
+    """Sets up the live sync broker for the Flask app."""
+
+    global broker
+
+    settings["keepalive"] = app.config.get("LIVE_SYNC_KEEPALIVE", 15.0)
+    max_pending = app.config.get("LIVE_SYNC_MAX_PENDING", 100)
+
+    if app.config.get("LIVE_SYNC_BROKER") == "postgres":
+        broker = PostgresBroker(app.config["SQLALCHEMY_DATABASE_URI"], max_pending)
+    else:
+        broker = MemoryBroker(max_pending)
+
+    if app.config["SQLALCHEMY_DATABASE_URI"].startswith("postgres"):
+        make_psycopg_cooperative()
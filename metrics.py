@@ -0,0 +1,354 @@
+"""Request-level performance metrics for the Setlist Manager.
+
+Records per-endpoint request latency, SQL statement counts and durations (via
+SQLAlchemy cursor events) and template render times. Each statement is timed
+here once; other instrumentation, like the slow-query log, subscribes to the
+durations with observe_statements() rather than timing statements again.
+Metrics are exposed in Prometheus text format at /metrics, and each response
+carries a Server-Timing header summarizing its own request.
+
+Metrics are kept per process; under gunicorn each worker reports its own.
+"""
+
+import time
+from bisect import bisect_left
+from threading import Lock
+
+from flask import (
+    Response,
+    before_render_template,
+    g,
+    has_request_context,
+    request,
+    template_rendered,
+)
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+SQL_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1.0)
+COUNT_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)
+
+
+class Histogram:
+    """A cumulative histogram with fixed bucket bounds, per label value."""
+
+    def __init__(self, name, description, label, buckets):
+        self.name = name
+        self.description = description
+        self.label = label
+        self.buckets = buckets
+        self.series = {}
+
+    def observe(self, label_value, value):
+        """Records one observation for the given label value."""
+
+        counts, total = self.series.get(
+            label_value, ([0] * (len(self.buckets) + 1), 0.0)
+        )
+        counts[bisect_left(self.buckets, value)] += 1
+        self.series[label_value] = (counts, total + value)
+
+    def render(self):
+        """Returns the histogram in Prometheus text format, as a list of lines."""
+
+        lines = [
+            f"# HELP {self.name} {self.description}",
+            f"# TYPE {self.name} histogram",
+        ]
+
+        for label_value, (counts, total) in sorted(self.series.items()):
+            label = f'{self.label}="{escape_label(label_value)}"'
+            cumulative = 0
+
+            for bound, count in zip(self.buckets, counts):
+                cumulative += count
+                lines.append(f'{self.name}_bucket{{{label},le="{bound}"}} {cumulative}')
+
+            cumulative += counts[-1]
+            lines.append(f'{self.name}_bucket{{{label},le="+Inf"}} {cumulative}')
+            lines.append(f"{self.name}_sum{{{label}}} {total}")
+            lines.append(f"{self.name}_count{{{label}}} {cumulative}")
+
+        return lines
+
+
+class Counter:
+    """A monotonically increasing counter, keyed by a tuple of label values."""
+
+    def __init__(self, name, description, labels):
+        self.name = name
+        self.description = description
+        self.labels = labels
+        self.series = {}
+
+    def inc(self, label_values, amount=1):
+        """Increments the counter for the given label values."""
+
+        self.series[label_values] = self.series.get(label_values, 0) + amount
+
+    def render(self):
+        """Returns the counter in Prometheus text format, as a list of lines."""
+
+        lines = [
+            f"# HELP {self.name} {self.description}",
+            f"# TYPE {self.name} counter",
+        ]
+
+        for label_values, value in sorted(self.series.items()):
+            label = ",".join(
+                f'{name}="{escape_label(value)}"'
+                for name, value in zip(self.labels, label_values)
+            )
+            lines.append(f"{self.name}{{{label}}} {value}")
+
+        return lines
+
+
+class MetricsRegistry:
+    """The set of metrics recorded by the app."""
+
+    def __init__(self):
+        self.lock = Lock()
+        self.requests = Counter(
+            "setlist_requests_total",
+            "Requests served, by endpoint, method and status.",
+            ("endpoint", "method", "status"),
+        )
+        self.latency = Histogram(
+            "setlist_request_duration_seconds",
+            "Request latency by endpoint.",
+            "endpoint",
+            LATENCY_BUCKETS,
+        )
+        self.sql_statements = Histogram(
+            "setlist_request_sql_statements",
+            "SQL statements issued per request, by endpoint.",
+            "endpoint",
+            COUNT_BUCKETS,
+        )
+        self.sql_duration = Histogram(
+            "setlist_sql_duration_seconds",
+            "SQL statement duration by endpoint.",
+            "endpoint",
+            SQL_BUCKETS,
+        )
+        self.template_duration = Histogram(
+            "setlist_template_render_seconds",
+            "Template render time by template.",
+            "template",
+            LATENCY_BUCKETS,
+        )
+        self.activity_events = Counter(
+            "setlist_activity_events_total",
+            "Activity log events by outcome: queued, then written, dropped "
+            "(the buffer was full) or failed (the database refused them).",
+            ("outcome",),
+        )
+        self.rate_limited = Counter(
+            "setlist_rate_limited_total",
+            "Requests refused for being over a rate limit, by endpoint and scope.",
+            ("endpoint", "scope"),
+        )
+
+    def record_request(self, endpoint, method, status, duration, sql_count):
+        """Records a finished request."""
+
+        with self.lock:
+            self.requests.inc((endpoint, method, str(status)))
+            self.latency.observe(endpoint, duration)
+            self.sql_statements.observe(endpoint, sql_count)
+
+    def record_statement(self, endpoint, duration):
+        """Records one SQL statement."""
+
+        with self.lock:
+            self.sql_duration.observe(endpoint, duration)
+
+    def record_template(self, template, duration):
+        """Records one template render."""
+
+        with self.lock:
+            self.template_duration.observe(template, duration)
+
+    def record_activity(self, outcome, count=1):
+        """Records activity log events reaching an outcome."""
+
+        with self.lock:
+            self.activity_events.inc((outcome,), count)
+
+    def record_rate_limited(self, endpoint, scope):
+        """Records a request refused by a rate limit."""
+
+        with self.lock:
+            self.rate_limited.inc((endpoint, scope))
+
+    def render(self):
+        """Returns every metric in Prometheus text format."""
+
+        with self.lock:
+            lines = (
+                self.requests.render()
+                + self.latency.render()
+                + self.sql_statements.render()
+                + self.sql_duration.render()
+                + self.template_duration.render()
+                + self.activity_events.render()
+                + self.rate_limited.render()
+            )
+
+        return "\n".join(lines) + "\n"
+
+
+metrics = MetricsRegistry()
+
+
+def escape_label(value):
+    """Escapes a label value for the Prometheus text format."""
+
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def current_endpoint():
+    """Returns the name of the view handling the current request."""
+
+    return request.endpoint or "unmatched"
+
+
+############################################################
+# SQLAlchemy and template hooks
+
+
+# Called with each statement and its duration in seconds, once it's run.
+statement_observers = []
+
+
+def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    """Notes the start time of a statement."""
+
+    conn.info.setdefault("metrics_query_start", []).append(time.perf_counter())
+
+
+def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    """Records the duration of a statement against the current request."""
+
+    start = conn.info["metrics_query_start"].pop()
+    duration = time.perf_counter() - start
+
+    for observer in statement_observers:
+        observer(statement, duration)
+
+    if not has_request_context() or "metrics_start" not in g:
+        return
+
+    g.metrics_sql_count += 1
+    g.metrics_sql_time += duration
+    metrics.record_statement(current_endpoint(), duration)
+
+
+def handle_error(exception_context):
+    """Discards the start time of a statement that failed."""
+
+    if exception_context.connection is not None:
+        starts = exception_context.connection.info.get("metrics_query_start")
+        if starts:
+            starts.pop()
+
+
+def time_statements():
+    """Starts timing every SQL statement, unless already started."""
+
+    if not event.contains(Engine, "before_cursor_execute", before_cursor_execute):
+        event.listen(Engine, "before_cursor_execute", before_cursor_execute)
+        event.listen(Engine, "after_cursor_execute", after_cursor_execute)
+        event.listen(Engine, "handle_error", handle_error)
+
+
+def observe_statements(observer):
+    """Calls observer(statement, duration) after every SQL statement."""
+
+    time_statements()
+
+    if observer not in statement_observers:
+        statement_observers.append(observer)
+
+
+def before_template(sender, template, context, **extra):
+    """Notes the start time of a template render."""
+
+    if has_request_context():
+        g.setdefault("metrics_template_starts", []).append(time.perf_counter())
+
+
+def after_template(sender, template, context, **extra):
+    """Records the duration of a template render."""
+
+    if not has_request_context() or not g.get("metrics_template_starts"):
+        return
+
+    duration = time.perf_counter() - g.metrics_template_starts.pop()
+    metrics.record_template(template.name, duration)
+
+    # Nested renders are already counted in their parent's time.
+    if not g.metrics_template_starts:
+        g.metrics_template_time += duration
+
+
+############################################################
+# Request hooks
+
+
+def start_request_timer():
+    """Starts the per-request timers."""
+
+    g.metrics_start = time.perf_counter()
+    g.metrics_sql_count = 0
+    g.metrics_sql_time = 0.0
+    g.metrics_template_time = 0.0
+
+
+def record_request(response):
+    """Records the request and adds a Server-Timing header to the response."""
+
+    if "metrics_start" not in g:
+        return response
+
+    duration = time.perf_counter() - g.metrics_start
+    metrics.record_request(
+        current_endpoint(),
+        request.method,
+        response.status_code,
+        duration,
+        g.metrics_sql_count,
+    )
+
+    response.headers["Server-Timing"] = ", ".join(
+        [
+            f"app;dur={duration * 1000:.2f}",
+            f'db;dur={g.metrics_sql_time * 1000:.2f};desc="{g.metrics_sql_count} queries"',
+            f"tpl;dur={g.metrics_template_time * 1000:.2f}",
+        ]
+    )
+
+    return response
+
+
+def show_metrics():
+    """Returns the app's metrics in Prometheus text format."""
+
+    return Response(metrics.render(), mimetype="text/plain; version=0.0.4")
+
+
+def init_metrics(app):
+    """Connects request, SQL and template instrumentation to the Flask app."""
+
+    time_statements()
+
+    before_render_template.connect(before_template, app)
+    template_rendered.connect(after_template, app)
+
+    app.before_request(start_request_timer)
+    app.after_request(record_request)
+
+    if app.config.get("METRICS_ENABLED", True):
+        app.add_url_rule("/metrics", "show_metrics", show_metrics)
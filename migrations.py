@@ -0,0 +1,388 @@
+"""Schema migrations for the Setlist Manager.
+
+New databases get their whole schema from db.create_all() and are marked as
+fully migrated. Existing databases are brought up to date with `flask migrate`
+(run on release), which applies each pending migration below once, in order,
+recording it in the schema_migrations table.
+
+A migration runs against the schema as the migrations before it left it, not
+as the models describe it now, so data migrations are written in SQL of their
+own rather than calling model methods that will change with the schema.
+"""
+
+import zlib
+from collections import Counter
+from itertools import groupby
+
+import click
+from flask.cli import with_appcontext
+from sqlalchemy import inspect
+
+from models import (
+    db,
+    ActivityEvent,
+    ArtistUsageStats,
+    CatalogChange,
+    SongLyrics,
+    SongUsageStats,
+    StatsRefresh,
+    UserStats,
+    CanonicalSong,
+    CanonicalLyrics,
+    ORDER_GAP,
+    create_prefix_indexes,
+    lyrics_settings,
+    normalize_key,
+)
+
+MIGRATIONS_TABLE = "schema_migrations"
+
+
+def column_names(table):
+    """Returns the names of the columns currently in a table."""
+
+    return {column["name"] for column in inspect(db.engine).get_columns(table)}
+
+
+def add_column(table, column, ddl):
+    """Adds a column to a table unless it's already there."""
+
+    if column not in column_names(table):
+        db.session.execute(f"ALTER TABLE {table} ADD COLUMN {column} {ddl}")
+
+
+def drop_column(table, column):
+    """Drops a column from a table if it's there."""
+
+    if column in column_names(table):
+        db.session.execute(f"ALTER TABLE {table} DROP COLUMN {column}")
+
+
+############################################################
+# Migrations, oldest first
+
+
+def add_setlist_version():
+    """Adds the optimistic-concurrency version number to setlists."""
+
+    add_column("setlists", "version", "INTEGER NOT NULL DEFAULT 0")
+
+
+def gap_setlist_song_order():
+    """Spaces out setlist song order keys, and indexes setlist songs by order."""
+
+    db.session.execute(
+        f'UPDATE setlists_songs SET "index" = ("index" + 1) * {ORDER_GAP}'
+    )
+    db.session.execute(
+        "CREATE INDEX IF NOT EXISTS ix_setlists_songs_setlist_id_index "
+        'ON setlists_songs (setlist_id, "index")'
+    )
+
+
+def add_setlist_summaries():
+    """Adds song count, first song, lyrics length and last-modified to setlists."""
+
+    add_column("setlists", "song_count", "INTEGER NOT NULL DEFAULT 0")
+    add_column(
+        "setlists",
+        "first_song_id",
+        "INTEGER REFERENCES songs (id) ON DELETE SET NULL",
+    )
+    add_column("setlists", "lyrics_length", "INTEGER NOT NULL DEFAULT 0")
+    add_column("setlists", "updated_at", "TIMESTAMP")
+
+    # Lyrics are still a column of songs here.
+    db.session.execute(
+        "UPDATE setlists SET "
+        "song_count = (SELECT count(*) FROM setlists_songs "
+        "WHERE setlists_songs.setlist_id = setlists.id), "
+        "first_song_id = (SELECT song_id FROM setlists_songs "
+        'WHERE setlists_songs.setlist_id = setlists.id ORDER BY "index" LIMIT 1), '
+        "lyrics_length = (SELECT coalesce(sum(length(songs.lyrics)), 0) "
+        "FROM setlists_songs JOIN songs ON songs.id = setlists_songs.song_id "
+        "WHERE setlists_songs.setlist_id = setlists.id)"
+    )
+
+
+def move_lyrics_to_side_table():
+    """Moves song lyrics out of the songs table, into song_lyrics."""
+
+    SongLyrics.__table__.create(db.session.connection(), checkfirst=True)
+
+    if "lyrics" in column_names("songs"):
+        db.session.execute(
+            "INSERT INTO song_lyrics (song_id, text, length) "
+            "SELECT id, lyrics, length(lyrics) FROM songs WHERE lyrics IS NOT NULL"
+        )
+        drop_column("songs", "lyrics")
+
+    db.session.execute(
+        "UPDATE setlists SET lyrics_length = ("
+        "SELECT coalesce(sum(song_lyrics.length), 0) FROM setlists_songs "
+        "JOIN song_lyrics ON song_lyrics.song_id = setlists_songs.song_id "
+        "WHERE setlists_songs.setlist_id = setlists.id)"
+    )
+
+
+def link_canonical_songs():
+    """Points each song at a canonical song, adding canonical songs as needed."""
+
+    canonical_ids = {
+        (title_key, artist_key): canonical_id
+        for canonical_id, title_key, artist_key in db.session.execute(
+            "SELECT id, title_key, artist_key FROM canonical_songs"
+        )
+    }
+    songs = db.session.execute(
+        "SELECT id, title, artist FROM songs WHERE canonical_id IS NULL ORDER BY id"
+    ).fetchall()
+
+    new = {}
+    for song_id, title, artist in songs:
+        keys = (normalize_key(title), normalize_key(artist))
+        if keys not in canonical_ids and keys not in new:
+            new[keys] = {
+                "title": title,
+                "artist": artist,
+                "title_key": keys[0],
+                "artist_key": keys[1],
+            }
+
+    if new:
+        db.session.execute(CanonicalSong.__table__.insert(), list(new.values()))
+        canonical_ids.update(
+            ((title_key, artist_key), canonical_id)
+            for canonical_id, title_key, artist_key in db.session.execute(
+                "SELECT id, title_key, artist_key FROM canonical_songs"
+            )
+        )
+
+    links = [
+        {
+            "song_id": song_id,
+            "canonical_id": canonical_ids[normalize_key(title), normalize_key(artist)],
+        }
+        for song_id, title, artist in songs
+    ]
+    if links:
+        db.session.execute(
+            "UPDATE songs SET canonical_id = :canonical_id WHERE id = :song_id", links
+        )
+
+
+def share_duplicate_lyrics():
+    """Stores the lyrics of each canonical song once, in canonical_lyrics.
+
+    A canonical song's lyrics are the ones most of its songs have (the
+    earliest song's, in a tie). Songs with exactly those lyrics share them and
+    lose their own copy; songs with other lyrics keep theirs, and songs
+    without lyrics keep none, so every song reads the same lyrics as before.
+    Shared lyrics are compressed past LYRICS_COMPRESS_OVER, like the app's."""
+
+    threshold = lyrics_settings["compress_over"]
+
+    lyrics = (
+        db.session.connection()
+        .execution_options(stream_results=True)
+        .execute(
+            "SELECT songs.canonical_id, song_lyrics.song_id, song_lyrics.text, "
+            "song_lyrics.compressed "
+            "FROM song_lyrics JOIN songs ON songs.id = song_lyrics.song_id "
+            "WHERE songs.canonical_id NOT IN "
+            "(SELECT canonical_id FROM canonical_lyrics) "
+            "ORDER BY songs.canonical_id, song_lyrics.song_id"
+        )
+    )
+    shared, redundant = [], []
+
+    for canonical_id, rows in groupby(lyrics, key=lambda row: row[0]):
+        texts = [
+            (
+                song_id,
+                text if compressed is None else zlib.decompress(compressed).decode(),
+            )
+            for _, song_id, text, compressed in rows
+        ]
+        counts = Counter(text for _, text in texts if text)
+
+        if not counts:
+            continue
+
+        text = counts.most_common(1)[0][0]
+        compress = threshold is not None and len(text) > threshold
+        shared.append(
+            {
+                "canonical_id": canonical_id,
+                "text": None if compress else text,
+                "compressed": zlib.compress(text.encode(), 9) if compress else None,
+                "length": len(text),
+            }
+        )
+        redundant.extend(
+            {"song_id": song_id} for song_id, song_text in texts if song_text == text
+        )
+
+    if shared:
+        db.session.execute(
+            "INSERT INTO canonical_lyrics (canonical_id, text, compressed, length) "
+            "VALUES (:canonical_id, :text, :compressed, :length)",
+            shared,
+        )
+    if redundant:
+        db.session.execute(
+            "UPDATE songs SET shares_lyrics = :shares WHERE id = :song_id",
+            [dict(row, shares=True) for row in redundant],
+        )
+        db.session.execute(
+            "DELETE FROM song_lyrics WHERE song_id = :song_id", redundant
+        )
+
+
+def add_canonical_songs():
+    """Merges duplicate songs into canonical songs, which store their lyrics once."""
+
+    CanonicalSong.__table__.create(db.session.connection(), checkfirst=True)
+    CanonicalLyrics.__table__.create(db.session.connection(), checkfirst=True)
+    add_column("songs", "canonical_id", "INTEGER REFERENCES canonical_songs (id)")
+    add_column("songs", "shares_lyrics", "BOOLEAN NOT NULL DEFAULT FALSE")
+    db.session.execute(
+        "CREATE INDEX IF NOT EXISTS ix_songs_canonical_id ON songs (canonical_id)"
+    )
+
+    link_canonical_songs()
+    share_duplicate_lyrics()
+
+    db.session.execute(
+        "UPDATE setlists SET lyrics_length = ("
+        "SELECT coalesce(sum(coalesce(song_lyrics.length, "
+        "canonical_lyrics.length)), 0) "
+        "FROM setlists_songs JOIN songs ON songs.id = setlists_songs.song_id "
+        "LEFT JOIN song_lyrics ON song_lyrics.song_id = songs.id "
+        "LEFT JOIN canonical_lyrics "
+        "ON canonical_lyrics.canonical_id = songs.canonical_id "
+        "AND songs.shares_lyrics "
+        "WHERE setlists_songs.setlist_id = setlists.id)"
+    )
+
+
+def add_prefix_indexes():
+    """Adds the title and artist prefix indexes autocompletion reads from."""
+
+    create_prefix_indexes(CanonicalSong.__table__, db.session.connection())
+
+
+def add_catalog_changes():
+    """Adds the table of song changes the catalog snapshot is kept up to date from."""
+
+    CatalogChange.__table__.create(db.session.connection(), checkfirst=True)
+
+
+def add_stats_tables():
+    """Adds the summary tables the statistics page reads from."""
+
+    for model in (SongUsageStats, ArtistUsageStats, UserStats, StatsRefresh):
+        model.__table__.create(db.session.connection(), checkfirst=True)
+
+
+def add_activity_events():
+    """Adds the activity log of changes to songs and setlists."""
+
+    ActivityEvent.__table__.create(db.session.connection(), checkfirst=True)
+
+
+MIGRATIONS = [
+    ("0001_add_setlist_version", add_setlist_version),
+    ("0002_gap_setlist_song_order", gap_setlist_song_order),
+    ("0003_add_setlist_summaries", add_setlist_summaries),
+    ("0004_move_lyrics_to_side_table", move_lyrics_to_side_table),
+    ("0005_add_canonical_songs", add_canonical_songs),
+    ("0006_add_prefix_indexes", add_prefix_indexes),
+    ("0007_add_catalog_changes", add_catalog_changes),
+    ("0008_add_stats_tables", add_stats_tables),
+    ("0009_add_activity_events", add_activity_events),
+]
+
+
+############################################################
+# Runner
+
+
+def ensure_migrations_table():
+    """Creates the table recording applied migrations, if it's missing."""
+
+    db.session.execute(
+        f"CREATE TABLE IF NOT EXISTS {MIGRATIONS_TABLE} "
+        "(name VARCHAR(255) PRIMARY KEY)"
+    )
+
+
+def applied_migrations():
+    """Returns the names of the migrations already applied."""
+
+    ensure_migrations_table()
+    return {
+        row[0] for row in db.session.execute(f"SELECT name FROM {MIGRATIONS_TABLE}")
+    }
+
+
+def mark_applied(name):
+    """Records a migration as applied."""
+
+    db.session.execute(
+        f"INSERT INTO {MIGRATIONS_TABLE} (name) VALUES (:name)", {"name": name}
+    )
+
+
+def init_schema():
+    """Creates any missing tables; a brand-new database is marked as migrated."""
+
+    is_new = "users" not in inspect(db.engine).get_table_names()
+    db.create_all()
+
+    if is_new:
+        ensure_migrations_table()
+        for name, migration in MIGRATIONS:
+            mark_applied(name)
+        db.session.commit()
+
+
+def run_migrations():
+    """Applies every pending migration, each in its own transaction.
+
+    Returns the names of the migrations applied."""
+
+    done = applied_migrations()
+    db.session.commit()
+    applied = []
+
+    for name, migration in MIGRATIONS:
+        if name in done:
+            continue
+
+        migration()
+        mark_applied(name)
+        db.session.commit()
+        applied.append(name)
+
+    return applied
+
+
+@click.command("migrate")
+@with_appcontext
+def migrate_command():
+    """Applies pending schema migrations."""
+
+    applied = run_migrations()
+
+    for name in applied:
+        click.echo(f"Applied {name}")
+
+    if not applied:
+        click.echo("Database is up to date.")
+
+
+def init_migrations(app):
+    """Adds the migrate command to the Flask app."""
+
+    app.cli.add_command(migrate_command)
@@ -1,11 +1,33 @@
 """Models for the Setlist Manager."""
 
-from flask_sqlalchemy import SQLAlchemy
+import json
+import re
+import sqlite3
+import unicodedata
+import zlib
+
 from flask_bcrypt import Bcrypt
 from datetime import datetime
+from sqlalchemy import and_, case, event, false, func, inspect, literal, select
+from sqlalchemy.engine import Engine
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import joinedload
+
+from replicas import RoutingSession, RoutingSQLAlchemy
 
 bcrypt = Bcrypt()
-db = SQLAlchemy()
+db = RoutingSQLAlchemy()
+
+# SetlistSong.index values are spaced ORDER_GAP apart, so a song can be moved
+# or inserted between two others by giving it the key halfway between theirs,
+# without renumbering the rest of the setlist.
+ORDER_GAP = 1 << 16
+MIN_ORDER_KEY = -(1 << 31)
+MAX_ORDER_KEY = (1 << 31) - 1
+
+# Lyrics longer than compress_over characters are stored zlib-compressed; None
+# stores everything as plain text. Set from LYRICS_COMPRESS_OVER by connect_db.
+lyrics_settings = {"compress_over": None}
 
 
 class User(db.Model):
@@ -19,8 +41,13 @@ class User(db.Model):
     password = db.Column(db.Text, nullable=False)
     darkmode = db.Column(db.Boolean, nullable=False, default=False)
 
-    songs = db.relationship("Song", backref="user")
-    setlists = db.relationship("Setlist", backref="user", cascade="all, delete-orphan")
+    # Deleting a user leaves their songs' user_id to the database (SET NULL),
+    # and their setlists, with those setlists' songs, to its cascades, rather
+    # than loading every row to update or delete it.
+    songs = db.relationship("Song", backref="user", passive_deletes=True)
+    setlists = db.relationship(
+        "Setlist", backref="user", cascade="all, delete-orphan", passive_deletes=True
+    )
 
     def __repr__(self):
         """Returns a representation of the user."""
@@ -73,6 +100,154 @@ class User(db.Model):
                 return user
 
 
+def normalize_key(text):
+    """Returns the form of a title or artist that duplicates are matched on.
+
+    Ignores case, accents, punctuation and spacing, so "Don't Stop" and
+    "dont  stop" are the same song."""
+
+    text = unicodedata.normalize("NFKD", text or "").casefold()
+    text = "".join(char for char in text if not unicodedata.combining(char))
+    return " ".join(re.sub(r"[^\w\s]", "", text).split())
+
+
+class CanonicalSong(db.Model):
+    """A song, as distinct from the users' entries for it.
+
+    Every user's Song for the same title and artist points to one
+    CanonicalSong, which holds the lyrics they share."""
+
+    __tablename__ = "canonical_songs"
+    __table_args__ = (
+        db.Index(
+            "ix_canonical_songs_title_key_artist_key",
+            "title_key",
+            "artist_key",
+            unique=True,
+        ),
+    )
+
+    id = db.Column(db.Integer, primary_key=True, autoincrement=True)
+    title = db.Column(db.Text, nullable=False)
+    artist = db.Column(db.Text, nullable=False)
+    title_key = db.Column(db.Text, nullable=False)
+    artist_key = db.Column(db.Text, nullable=False)
+
+    lyrics_row = db.relationship(
+        "CanonicalLyrics",
+        uselist=False,
+        cascade="all, delete-orphan",
+        passive_deletes=True,
+    )
+    songs = db.relationship("Song", back_populates="canonical")
+
+    @property
+    def lyrics(self):
+        """The song's shared lyrics, or None."""
+
+        return self.lyrics_row.read() if self.lyrics_row else None
+
+    @lyrics.setter
+    def lyrics(self, text):
+        if text is None:
+            self.lyrics_row = None
+        elif self.lyrics_row is None:
+            self.lyrics_row = CanonicalLyrics(**lyrics_columns(text))
+        else:
+            self.lyrics_row.write(text)
+
+    @classmethod
+    def find_or_create(cls, title, artist):
+        """Returns the canonical song for a title and artist, adding it if it's new.
+
+        The lookup is served by the unique index on the normalized keys, which
+        also settles races: if another request adds the song first, the
+        insert fails and that request's row is used instead."""
+
+        keys = {"title_key": normalize_key(title), "artist_key": normalize_key(artist)}
+        canonical = cls.query.filter_by(**keys).first()
+
+        if canonical is not None:
+            return canonical
+
+        canonical = cls(title=title, artist=artist, **keys)
+
+        try:
+            with db.session.begin_nested():
+                db.session.add(canonical)
+        except IntegrityError:
+            canonical = cls.query.filter_by(**keys).one()
+
+        return canonical
+
+    @classmethod
+    def prune(cls, ids):
+        """Deletes whichever of these canonical songs no song refers to any more."""
+
+        ids = [canonical_id for canonical_id in ids if canonical_id is not None]
+
+        if ids:
+            cls.query.filter(cls.id.in_(ids), ~cls.songs.any()).delete(
+                synchronize_session=False
+            )
+
+    @classmethod
+    def complete(cls, field, prefix, limit):
+        """Returns up to limit distinct titles or artists starting with prefix.
+
+        field is "title" or "artist". Prefixes are matched against the
+        normalized keys, so case, accents and punctuation don't matter, and
+        completions come in key order."""
+
+        key = normalize_key(prefix)
+
+        if not key:
+            return []
+        if prefix[-1].isspace():
+            key += " "
+
+        return [value for (value,) in cls.completion_query(field, key, limit)]
+
+    @classmethod
+    def completion_query(cls, field, key, limit):
+        """Returns the query completing a normalized key, read off a prefix index."""
+
+        column = binary_collation(getattr(cls, f"{field}_key"))
+
+        return (
+            db.session.query(func.min(getattr(cls, field)))
+            .filter(column >= key, column < key + "\U0010ffff")
+            .group_by(column)
+            .order_by(column)
+            .limit(limit)
+        )
+
+
+def binary_collation(column):
+    """Returns a text column compared by code point, as prefix indexes order it."""
+
+    return column.collate("C") if db.engine.dialect.name == "postgresql" else column
+
+
+@event.listens_for(CanonicalSong.__table__, "after_create")
+def create_prefix_indexes(table, connection, **kw):
+    """Creates the indexes autocompletion reads title and artist prefixes from.
+
+    Prefix ranges need keys ordered by code point, which on Postgres takes the
+    "C" collation; SQLite has no such collation but orders by code point
+    anyway, so the indexes are created here rather than in __table_args__.
+    Each also holds the displayed name, so the many songs sharing a popular
+    title or artist are grouped from the index alone."""
+
+    collation = ' COLLATE "C"' if connection.dialect.name == "postgresql" else ""
+
+    for field in ("title", "artist"):
+        connection.execute(
+            f"CREATE INDEX IF NOT EXISTS ix_canonical_songs_{field}_key_prefix "
+            f"ON canonical_songs ({field}_key{collation}, {field})"
+        )
+
+
 class Song(db.Model):
     """A song within the Setlist Manager app."""
 
@@ -84,7 +259,129 @@ class Song(db.Model):
     )
     title = db.Column(db.Text, nullable=False)
     artist = db.Column(db.Text, nullable=False)
-    lyrics = db.Column(db.Text, nullable=True)
+    canonical_id = db.Column(
+        db.Integer, db.ForeignKey("canonical_songs.id"), nullable=True, index=True
+    )
+
+    # Whether the song's lyrics are its canonical song's; see Song.lyrics.
+    shares_lyrics = db.Column(
+        db.Boolean, nullable=False, default=False, server_default=false()
+    )
+
+    canonical = db.relationship("CanonicalSong", back_populates="songs")
+
+    # A song's lyrics are its canonical song's if it shares_lyrics, or else
+    # its own copy in song_lyrics, if it has any. Only songs whose owners
+    # gave the same lyrics share them, so no user's lyrics show up in
+    # another's copy of a song. Neither is loaded with the song; views that
+    # show lyrics should use Song.query.options(*Song.with_lyrics).
+    lyrics_row = db.relationship(
+        "SongLyrics", uselist=False, cascade="all, delete-orphan", passive_deletes=True
+    )
+
+    with_lyrics = (
+        joinedload("lyrics_row"),
+        joinedload("canonical").joinedload("lyrics_row"),
+    )
+
+    def __init__(self, lyrics=None, **kwargs):
+        super().__init__(**kwargs)
+
+        if self.canonical is None and self.title and self.artist:
+            self.canonical = CanonicalSong.find_or_create(self.title, self.artist)
+
+        if lyrics:
+            self.lyrics = lyrics
+
+    @classmethod
+    def delete_where(cls, *criteria):
+        """Deletes the songs matching criteria, in a handful of statements.
+
+        The database deletes their lyrics and setlist entries and clears them
+        as setlists' first songs; this then refreshes the summaries of the
+        setlists they were in and prunes canonical songs left unused. Like any
+        bulk delete, this leaves matching songs already in the session as
+        they were; commit after."""
+
+        matching = db.session.query(cls.id).filter(*criteria)
+        setlist_ids = [
+            setlist_id
+            for (setlist_id,) in db.session.query(SetlistSong.setlist_id)
+            .filter(SetlistSong.song_id.in_(matching.subquery()))
+            .distinct()
+        ]
+        canonical_ids = [
+            canonical_id
+            for (canonical_id,) in db.session.query(cls.canonical_id)
+            .filter(*criteria)
+            .distinct()
+        ]
+
+        CatalogChange.record(db.session.connection(), matching.subquery())
+        deleted = cls.query.filter(*criteria).delete(synchronize_session=False)
+
+        if setlist_ids:
+            Setlist.refresh_summaries(Setlist.id.in_(setlist_ids))
+        CanonicalSong.prune(canonical_ids)
+
+        return deleted
+
+    def rename(self, title, artist):
+        """Changes the song's title and artist, and so maybe its canonical song.
+
+        The canonical song it leaves is deleted if no other song refers to it."""
+
+        old_canonical_id = self.canonical_id
+        canonical = CanonicalSong.find_or_create(title, artist)
+
+        self.title = title
+        self.artist = artist
+
+        if canonical.id != old_canonical_id:
+            # Keep the song's lyrics, not the new canonical song's.
+            lyrics = self.lyrics
+            self.canonical = canonical
+            self.lyrics = lyrics
+            CanonicalSong.prune([old_canonical_id])
+
+    @property
+    def lyrics(self):
+        """The song's lyrics, or None."""
+
+        if self.lyrics_row is not None:
+            return self.lyrics_row.read()
+
+        if self.shares_lyrics and self.canonical:
+            return self.canonical.lyrics
+
+        return None
+
+    @lyrics.setter
+    def lyrics(self, text):
+        if not text or self.canonical is None:
+            self.shares_lyrics = False
+            self.set_own_lyrics(text or None)
+            return
+
+        shared = self.canonical.lyrics
+
+        if shared is None:
+            # The first lyrics given for a song are stored as its canonical
+            # song's, to be shared by any copy given the same lyrics later.
+            self.canonical.lyrics = shared = text
+
+        self.shares_lyrics = text == shared
+        self.set_own_lyrics(None if self.shares_lyrics else text)
+
+    def set_own_lyrics(self, text):
+        """Stores lyrics for this song alone, or with None, removes them."""
+
+        if text is None:
+            self.lyrics_row = None
+        elif self.lyrics_row is None:
+            self.lyrics_row = SongLyrics(**lyrics_columns(text))
+        else:
+            self.lyrics_row.write(text)
 
     def serialize(self):
         """Returns a dictionary with the fields of the song, except the lyrics."""
@@ -101,6 +398,72 @@ class Song(db.Model):
         return f"<Song {self.id}: {self.title} by {self.artist}>"
 
 
+class StoredLyrics:
+    """Columns and methods for storing lyrics, compressed if they're long."""
+
+    # Exactly one of text and compressed is set.
+    text = db.Column(db.Text, nullable=True)
+    compressed = db.Column(db.LargeBinary, nullable=True)
+    length = db.Column(db.Integer, nullable=False, default=0)
+
+    def read(self):
+        """Returns the lyrics, decompressing them if need be."""
+
+        return self.decode(self.text, self.compressed)
+
+    @staticmethod
+    def decode(text, compressed):
+        """Returns the lyrics stored in a row's text and compressed columns."""
+
+        if compressed is not None:
+            return zlib.decompress(compressed).decode()
+
+        return text
+
+    def write(self, text):
+        """Stores new lyrics, compressing them if they're long enough."""
+
+        for column, value in lyrics_columns(text).items():
+            setattr(self, column, value)
+
+
+class CanonicalLyrics(StoredLyrics, db.Model):
+    """The lyrics shared by every user's copy of a song."""
+
+    __tablename__ = "canonical_lyrics"
+
+    canonical_id = db.Column(
+        db.Integer,
+        db.ForeignKey("canonical_songs.id", ondelete="CASCADE"),
+        primary_key=True,
+    )
+
+
+class SongLyrics(StoredLyrics, db.Model):
+    """A user's own lyrics for a song, where they differ from the shared ones."""
+
+    __tablename__ = "song_lyrics"
+
+    song_id = db.Column(
+        db.Integer, db.ForeignKey("songs.id", ondelete="CASCADE"), primary_key=True
+    )
+
+
+def lyrics_columns(text):
+    """Returns the StoredLyrics column values storing some lyrics."""
+
+    threshold = lyrics_settings["compress_over"]
+
+    if threshold is not None and len(text) > threshold:
+        return {
+            "text": None,
+            "compressed": zlib.compress(text.encode(), 9),
+            "length": len(text),
+        }
+
+    return {"text": text, "compressed": None, "length": len(text)}
+
+
 class Setlist(db.Model):
     """A setlist within the Setlist Manager app."""
 
@@ -113,22 +476,373 @@ class Setlist(db.Model):
     name = db.Column(db.Text, nullable=False)
 
     notes = db.Column(db.Text, nullable=True)
+    version = db.Column(db.Integer, nullable=False, default=0, server_default="0")
+
+    # Summary of the setlist's songs, kept up to date by refresh_summaries so
+    # listings needn't load setlists_songs.
+    song_count = db.Column(db.Integer, nullable=False, default=0, server_default="0")
+    first_song_id = db.Column(
+        db.Integer, db.ForeignKey("songs.id", ondelete="SET NULL"), nullable=True
+    )
+    lyrics_length = db.Column(db.Integer, nullable=False, default=0, server_default="0")
+    updated_at = db.Column(db.DateTime, nullable=True, default=datetime.utcnow)
 
     songs = db.relationship(
         "Song",
         order_by="SetlistSong.index",
         secondary="setlists_songs",
-        backref="setlists",
+        backref=db.backref("setlists", passive_deletes=True),
+        passive_deletes=True,
     )
     setlist_songs = db.relationship(
-        "SetlistSong", backref="setlist", cascade="all, delete-orphan"
+        "SetlistSong",
+        backref="setlist",
+        cascade="all, delete-orphan",
+        passive_deletes=True,
     )
 
+    @classmethod
+    def delete_where(cls, *criteria):
+        """Deletes the setlists matching criteria with a single DELETE.
+
+        The database deletes their songs. Like any bulk delete, this leaves
+        matching setlists already in the session as they were; commit after."""
+
+        return cls.query.filter(*criteria).delete(synchronize_session=False)
+
+    @classmethod
+    def claim_version(cls, setlist_id, version):
+        """Bumps a setlist's version if it's still at the given version.
+
+        Returns False if someone else has changed the setlist since. On Postgres
+        the UPDATE also locks the row until the end of the transaction, so
+        concurrent edits are applied one at a time."""
+
+        claimed = cls.query.filter_by(id=setlist_id, version=version).update(
+            {"version": cls.version + 1}, synchronize_session=False
+        )
+
+        return claimed == 1
+
+    @classmethod
+    def refresh_summaries(cls, *criteria, touch=True):
+        """Recomputes the summary columns of the setlists matching criteria.
+
+        Call this in the same transaction as any change to setlists' songs, or
+        to the lyrics of songs in them, once the change is made. With touch,
+        the setlists' updated_at is also set to now."""
+
+        db.session.flush()
+
+        in_setlist = SetlistSong.setlist_id == cls.id
+        values = {
+            "song_count": select([func.count()]).where(in_setlist).as_scalar(),
+            "first_song_id": select([SetlistSong.song_id])
+            .where(in_setlist)
+            .order_by(SetlistSong.index)
+            .limit(1)
+            .as_scalar(),
+            "lyrics_length": select(
+                [
+                    func.coalesce(
+                        func.sum(
+                            func.coalesce(SongLyrics.length, CanonicalLyrics.length)
+                        ),
+                        0,
+                    )
+                ]
+            )
+            .select_from(
+                SetlistSong.__table__.join(Song.__table__)
+                .outerjoin(SongLyrics.__table__)
+                .outerjoin(
+                    CanonicalLyrics.__table__,
+                    and_(
+                        CanonicalLyrics.canonical_id == Song.canonical_id,
+                        Song.shares_lyrics,
+                    ),
+                )
+            )
+            .where(in_setlist)
+            .as_scalar(),
+        }
+
+        if touch:
+            values["updated_at"] = datetime.utcnow()
+
+        cls.query.filter(*criteria).update(values, synchronize_session=False)
+
+    @classmethod
+    def clone(cls, setlist_ids, user_id, name="{name} (copy)"):
+        """Copies setlists, with their notes and songs, for a user.
+
+        Returns the copies, in the order of setlist_ids, named by formatting
+        name with each original's. The copies' rows are inserted one by one,
+        for their ids, and then the songs of all of them with a single
+        INSERT ... SELECT, so cloning a whole tour costs one statement per
+        setlist plus one. Raises ValueError if a setlist doesn't exist."""
+
+        setlist_ids = list(dict.fromkeys(setlist_ids))
+        originals = {
+            setlist.id: setlist for setlist in cls.query.filter(cls.id.in_(setlist_ids))
+        }
+
+        if len(originals) != len(setlist_ids):
+            raise ValueError("Can't copy a setlist that doesn't exist.")
+
+        copies = {
+            setlist_id: cls(
+                user_id=user_id,
+                name=name.format(name=originals[setlist_id].name),
+                notes=originals[setlist_id].notes,
+                song_count=originals[setlist_id].song_count,
+                first_song_id=originals[setlist_id].first_song_id,
+                lyrics_length=originals[setlist_id].lyrics_length,
+            )
+            for setlist_id in setlist_ids
+        }
+
+        db.session.add_all(copies.values())
+        db.session.flush()
+
+        copy_id = case(
+            {setlist_id: copy.id for setlist_id, copy in copies.items()},
+            value=SetlistSong.setlist_id,
+        )
+        db.session.execute(
+            SetlistSong.__table__.insert().from_select(
+                ["setlist_id", "song_id", "index"],
+                select([copy_id, SetlistSong.song_id, SetlistSong.index]).where(
+                    SetlistSong.setlist_id.in_(setlist_ids)
+                ),
+            )
+        )
+
+        return list(copies.values())
+
+    def apply_song_ops(self, ops):
+        """Applies a list of move, insert and remove operations to the songs.
+
+        Positions are 0-based indexes into the setlist as it stands after the
+        previous operation. A move or insert writes only the row concerned,
+        barring an occasional renumbering (see place_entry). Raises ValueError
+        for an invalid operation."""
+
+        entries = (
+            SetlistSong.query.filter_by(setlist_id=self.id)
+            .order_by(SetlistSong.index)
+            .all()
+        )
+
+        inserted_ids = {op.get("song_id") for op in ops if op.get("op") == "insert"}
+        if not all(isinstance(song_id, int) for song_id in inserted_ids):
+            raise ValueError("Song ids must be integers.")
+        if inserted_ids:
+            found = Song.query.filter(Song.id.in_(inserted_ids)).count()
+            if found != len(inserted_ids):
+                raise ValueError("Can't insert a song that doesn't exist.")
+
+        for op in ops:
+            kind = op.get("op")
+
+            if kind == "move":
+                entry = entries.pop(check_position(op.get("from"), len(entries)))
+                position = check_position(op.get("to"), len(entries) + 1)
+                entries.insert(position, entry)
+                place_entry(entries, position)
+            elif kind == "insert":
+                entry = SetlistSong(setlist_id=self.id, song_id=op["song_id"])
+                position = check_position(op.get("index"), len(entries) + 1)
+                entries.insert(position, entry)
+                place_entry(entries, position)
+                db.session.add(entry)
+            elif kind == "remove":
+                entry = entries.pop(check_position(op.get("index"), len(entries)))
+                if entry in db.session.new:
+                    db.session.expunge(entry)
+                else:
+                    db.session.delete(entry)
+            else:
+                raise ValueError(f"Unknown operation: {kind!r}")
+
+        return entries
+
+
+def key_between(before, after):
+    """Returns an ordering key strictly between two keys (None meaning an end).
+
+    Returns None if there's no room, in which case the setlist needs
+    renumbering."""
+
+    if before is None and after is None:
+        return ORDER_GAP
+    elif before is None:
+        key = after - ORDER_GAP
+    elif after is None:
+        key = before + ORDER_GAP
+    elif after - before > 1:
+        return (before + after) // 2
+    else:
+        return None
+
+    return key if MIN_ORDER_KEY <= key <= MAX_ORDER_KEY else None
+
+
+def place_entry(entries, position):
+    """Gives entries[position] an ordering key between its neighbours' keys.
+
+    Usually only that one entry changes; when its neighbours' keys are
+    adjacent, every entry is renumbered with ORDER_GAP between them."""
+
+    before = entries[position - 1].index if position > 0 else None
+    after = entries[position + 1].index if position + 1 < len(entries) else None
+    key = key_between(before, after)
+
+    if key is not None:
+        entries[position].index = key
+        return
+
+    for number, entry in enumerate(entries, start=1):
+        if entry.index != number * ORDER_GAP:
+            entry.index = number * ORDER_GAP
+
+
+def check_position(position, length):
+    """Returns position if it's a valid index below length; else raises ValueError."""
+
+    if not isinstance(position, int) or not 0 <= position < length:
+        raise ValueError(f"Invalid position: {position!r}")
+
+    return position
+
+
+def apply_text_delta(text, delta):
+    """Applies a list of {start, end, text} splices to a string.
+
+    Each splice replaces text[start:end], as it stands after the previous
+    splice. Raises ValueError for an out-of-range splice."""
+
+    text = text or ""
+
+    for splice in delta:
+        start, end = splice.get("start"), splice.get("end")
+
+        if not (
+            isinstance(start, int)
+            and isinstance(end, int)
+            and 0 <= start <= end <= len(text)
+        ):
+            raise ValueError(f"Invalid splice: {start!r}-{end!r}")
+
+        text = text[:start] + str(splice.get("text", "")) + text[end:]
+
+    return text
+
+
+def text_delta(old, new):
+    """Returns the splices turning old into new, for apply_text_delta.
+
+    The inverse of apply_text_delta: one splice covering everything between
+    the common prefix and suffix, or none if the texts are equal."""
+
+    old, new = old or "", new or ""
+    start = 0
+
+    while start < min(len(old), len(new)) and old[start] == new[start]:
+        start += 1
+
+    old_end, new_end = len(old), len(new)
+
+    while old_end > start and new_end > start and old[old_end - 1] == new[new_end - 1]:
+        old_end -= 1
+        new_end -= 1
+
+    if start == old_end == new_end:
+        return []
+
+    return [{"start": start, "end": old_end, "text": new[start:new_end]}]
+
+
+def song_list_ops(old_ids, new_ids):
+    """Returns move, insert and remove operations turning one song order into another.
+
+    The operations are in the form Setlist.apply_song_ops takes, so a full
+    rewrite of a setlist can be described to clients as a small diff: the
+    longest run of songs already in the right relative order stays put, and
+    every other song is moved or inserted once."""
+
+    if len(set(old_ids)) != len(old_ids) or len(set(new_ids)) != len(new_ids):
+        return [{"op": "remove", "index": 0} for _ in old_ids] + [
+            {"op": "insert", "song_id": song_id, "index": index}
+            for index, song_id in enumerate(new_ids)
+        ]
+
+    current = list(old_ids)
+    ops = []
+    new_index = {song_id: index for index, song_id in enumerate(new_ids)}
+
+    for index in reversed(range(len(current))):
+        if current[index] not in new_index:
+            ops.append({"op": "remove", "index": index})
+            del current[index]
+
+    stable = longest_increasing_run(current, key=new_index.__getitem__)
+
+    for index, song_id in enumerate(new_ids):
+        if song_id in stable:
+            continue
+
+        target = current.index(new_ids[index - 1]) + 1 if index else 0
+
+        if song_id in current:
+            source = current.index(song_id)
+            if source < target:
+                target -= 1
+            ops.append({"op": "move", "from": source, "to": target})
+            current.insert(target, current.pop(source))
+        else:
+            ops.append({"op": "insert", "song_id": song_id, "index": target})
+            current.insert(target, song_id)
+
+    return ops
+
+
+def longest_increasing_run(items, key):
+    """Returns the set of items in a longest subsequence with increasing keys."""
+
+    tails = []  # tails[n]: index of the smallest last item of a run of n + 1
+    previous = [None] * len(items)
+
+    for index, item in enumerate(items):
+        low, high = 0, len(tails)
+        while low < high:
+            mid = (low + high) // 2
+            if key(items[tails[mid]]) < key(item):
+                low = mid + 1
+            else:
+                high = mid
+        previous[index] = tails[low - 1] if low else None
+        if low == len(tails):
+            tails.append(index)
+        else:
+            tails[low] = index
+
+    run = set()
+    index = tails[-1] if tails else None
+    while index is not None:
+        run.add(items[index])
+        index = previous[index]
+
+    return run
+
 
 class SetlistSong(db.Model):
     """Connection between a Setlist and a Song."""
 
     __tablename__ = "setlists_songs"
+    __table_args__ = (
+        db.Index("ix_setlists_songs_setlist_id_index", "setlist_id", "index"),
+    )
 
     id = db.Column(db.Integer, primary_key=True, autoincrement=True)
     setlist_id = db.Column(
@@ -137,12 +851,218 @@ class SetlistSong(db.Model):
     song_id = db.Column(
         db.Integer, db.ForeignKey("songs.id", ondelete="CASCADE"), nullable=False
     )
+    # Gapped ordering key; see ORDER_GAP.
     index = db.Column(db.Integer, nullable=False)
     unique = db.UniqueConstraint("song_id", "index")
 
 
+class CatalogChange(db.Model):
+    """A note that a song's catalog fields (title, artist, owner) changed.
+
+    Written in the same transaction as the change, so the shared catalog
+    snapshot (see catalog.py) can tell it's out of date and re-read just the
+    songs concerned. Changes are pruned once every snapshot has applied them."""
+
+    __tablename__ = "catalog_changes"
+    # Ids are never reused, so a snapshot can't mistake new changes for old.
+    __table_args__ = {"sqlite_autoincrement": True}
+
+    id = db.Column(db.Integer, primary_key=True, autoincrement=True)
+    song_id = db.Column(db.Integer, nullable=False)
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+
+    @classmethod
+    def record(cls, connection, song_ids):
+        """Notes changes to these songs (ids, or a SELECT of them)."""
+
+        if isinstance(song_ids, (list, set)):
+            song_ids = [song_id for song_id in song_ids if song_id is not None]
+
+            if song_ids:
+                connection.execute(
+                    cls.__table__.insert(),
+                    [
+                        {"song_id": song_id, "created_at": datetime.utcnow()}
+                        for song_id in song_ids
+                    ],
+                )
+            return
+
+        connection.execute(
+            cls.__table__.insert().from_select(
+                ["song_id", "created_at"],
+                select([list(song_ids.c)[0], literal(datetime.utcnow())]),
+            )
+        )
+
+
+CATALOG_FIELDS = ("title", "artist", "user_id")
+
+
+@event.listens_for(RoutingSession, "before_flush")
+def record_owner_deletions(session, flush_context, instances):
+    """Notes changes to the songs of users about to be deleted.
+
+    The database clears their user_id (ON DELETE SET NULL), out of sight of
+    the after_flush hook below."""
+
+    user_ids = [user.id for user in session.deleted if isinstance(user, User)]
+
+    if user_ids:
+        CatalogChange.record(
+            session.connection(),
+            select([Song.id]).where(Song.user_id.in_(user_ids)).alias(),
+        )
+
+
+@event.listens_for(RoutingSession, "after_flush")
+def record_catalog_changes(session, flush_context):
+    """Notes the songs a flush added, deleted, or changed the catalog fields of."""
+
+    song_ids = {song.id for song in session.new if isinstance(song, Song)}
+    song_ids |= {song.id for song in session.deleted if isinstance(song, Song)}
+    song_ids |= {
+        song.id
+        for song in session.dirty
+        if isinstance(song, Song)
+        and any(
+            inspect(song).attrs[field].history.has_changes() for field in CATALOG_FIELDS
+        )
+    }
+
+    CatalogChange.record(session.connection(), song_ids)
+
+
+class SongUsageStats(db.Model):
+    """How often a song (all users' copies of it) is used in setlists.
+
+    Like the other *Stats tables, a summary recomputed from the live tables
+    by stats.refresh(), and read as it was at the last refresh."""
+
+    __tablename__ = "song_usage_stats"
+
+    canonical_id = db.Column(db.Integer, primary_key=True)
+    title = db.Column(db.Text, nullable=False)
+    artist = db.Column(db.Text, nullable=False)
+    artist_key = db.Column(db.Text, nullable=False)
+    use_count = db.Column(db.Integer, nullable=False)
+    setlist_count = db.Column(db.Integer, nullable=False)
+
+
+class ArtistUsageStats(db.Model):
+    """How often an artist's songs are used in setlists."""
+
+    __tablename__ = "artist_usage_stats"
+
+    artist_key = db.Column(db.Text, primary_key=True)
+    artist = db.Column(db.Text, nullable=False)
+    song_count = db.Column(db.Integer, nullable=False)
+    use_count = db.Column(db.Integer, nullable=False)
+
+
+class UserStats(db.Model):
+    """The size of a user's catalog and setlists."""
+
+    __tablename__ = "user_stats"
+
+    user_id = db.Column(db.Integer, primary_key=True)
+    song_count = db.Column(db.Integer, nullable=False)
+    setlist_count = db.Column(db.Integer, nullable=False)
+    setlist_song_count = db.Column(db.Integer, nullable=False)
+
+    user = db.relationship(
+        "User", primaryjoin="UserStats.user_id == User.id", foreign_keys=[user_id]
+    )
+
+
+# The rankings the statistics page reads, top first, ties in id order, so
+# reading the top few never sorts the whole table.
+db.Index(
+    "ix_song_usage_stats_rank",
+    SongUsageStats.use_count.desc(),
+    SongUsageStats.canonical_id,
+)
+db.Index(
+    "ix_artist_usage_stats_rank",
+    ArtistUsageStats.use_count.desc(),
+    ArtistUsageStats.artist_key,
+)
+db.Index("ix_user_stats_rank", UserStats.song_count.desc(), UserStats.user_id)
+
+
+class StatsRefresh(db.Model):
+    """When the *Stats tables were last refreshed, and the catalog's totals then."""
+
+    __tablename__ = "stats_refreshes"
+
+    id = db.Column(db.Integer, primary_key=True, autoincrement=True)
+    refreshed_at = db.Column(db.DateTime, nullable=False)
+    duration_ms = db.Column(db.Float, nullable=False)
+    user_count = db.Column(db.Integer, nullable=False)
+    song_count = db.Column(db.Integer, nullable=False)
+    canonical_song_count = db.Column(db.Integer, nullable=False)
+    setlist_count = db.Column(db.Integer, nullable=False)
+    setlist_song_count = db.Column(db.Integer, nullable=False)
+
+
+class ActivityEvent(db.Model):
+    """A change someone made to a song or setlist, shown in its history.
+
+    Events are written in batches by activity.py, after the changes they
+    record have committed. They keep their ids rather than foreign keys, so
+    a song's or setlist's history outlives the user who changed it."""
+
+    __tablename__ = "activity_events"
+
+    id = db.Column(db.Integer, primary_key=True, autoincrement=True)
+    created_at = db.Column(db.DateTime, nullable=False)
+    user_id = db.Column(db.Integer, nullable=True)
+    song_id = db.Column(db.Integer, nullable=True)
+    setlist_id = db.Column(db.Integer, nullable=True)
+    action = db.Column(db.Text, nullable=False)
+    # JSON, such as the fields changed.
+    details = db.Column(db.Text, nullable=True)
+
+    user = db.relationship(
+        "User", primaryjoin="ActivityEvent.user_id == User.id", foreign_keys=[user_id]
+    )
+
+    @property
+    def changes(self):
+        """The event's details, as a dictionary."""
+
+        return json.loads(self.details) if self.details else {}
+
+
+# A song's or setlist's history, newest first.
+db.Index(
+    "ix_activity_events_song",
+    ActivityEvent.song_id,
+    ActivityEvent.created_at,
+    ActivityEvent.id,
+)
+db.Index(
+    "ix_activity_events_setlist",
+    ActivityEvent.setlist_id,
+    ActivityEvent.created_at,
+    ActivityEvent.id,
+)
+
+
+@event.listens_for(Engine, "connect")
+def enable_sqlite_foreign_keys(dbapi_connection, connection_record):
+    """Makes SQLite enforce foreign keys (and their ON DELETE actions)."""
+
+    if isinstance(dbapi_connection, sqlite3.Connection):
+        cursor = dbapi_connection.cursor()
+        cursor.execute("PRAGMA foreign_keys=ON")
+        cursor.close()
+
+
 def connect_db(app):
     """Connects this database to the Flask app."""
 
     db.app = app
-    db.init_app(app)
\ No newline at end of file
+    db.init_app(app)
+    bcrypt.init_app(app)
+    lyrics_settings["compress_over"] = app.config.get("LYRICS_COMPRESS_OVER")
@@ -0,0 +1,243 @@
+"""Slow-query log and N+1 detector for the Setlist Manager.
+
+Reads each statement's duration from the timing in metrics.py. Any statement
+slower than SLOW_QUERY_THRESHOLD_MS is logged along with the view
+that issued it, and any statement shape repeated N_PLUS_ONE_THRESHOLD or more
+times within a single request is flagged as a likely N+1 pattern.
+
+Entries are logged as one JSON object per line to the "setlist.queries" logger
+(and appended to QUERY_LOG_PATH, if set). Only statement shapes are logged,
+never parameter values, so the log is safe to leave on in production.
+`flask query-report` summarizes a QUERY_LOG_PATH file.
+"""
+
+import json
+import logging
+import re
+from collections import Counter, defaultdict
+from contextlib import contextmanager
+
+import click
+from flask.cli import with_appcontext
+from flask import g, has_request_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from metrics import observe_statements
+
+logger = logging.getLogger("setlist.queries")
+
+PLACEHOLDER_RE = re.compile(r"%\(\w+\)s|:\w+|\?|%s")
+PLACEHOLDER_LIST_RE = re.compile(r"\(\s*\?(?:\s*,\s*\?)*\s*\)")
+NUMBER_RE = re.compile(r"\b\d+\b")
+WHITESPACE_RE = re.compile(r"\s+")
+
+MAX_CACHED_SHAPES = 2048
+shape_cache = {}
+
+settings = {"slow_ms": 100.0, "n_plus_one": 5}
+
+
+def statement_shape(statement):
+    """Returns a statement with literals and placeholder lists normalized.
+
+    Two statements with the same shape differ only in their parameters, e.g.
+    the repeated per-song SELECTs of an N+1 loop."""
+
+    shape = shape_cache.get(statement)
+
+    if shape is None:
+        shape = PLACEHOLDER_RE.sub("?", statement)
+        shape = PLACEHOLDER_LIST_RE.sub("(...)", shape)
+        shape = NUMBER_RE.sub("N", shape)
+        shape = WHITESPACE_RE.sub(" ", shape).strip()
+
+        if len(shape_cache) >= MAX_CACHED_SHAPES:
+            shape_cache.clear()
+        shape_cache[statement] = shape
+
+    return shape
+
+
+def current_view():
+    """Returns the view issuing queries, or "-" outside of a request."""
+
+    if has_request_context():
+        return request.endpoint or "unmatched"
+
+    return "-"
+
+
+def log_entry(**entry):
+    """Logs one structured query-log entry as JSON."""
+
+    logger.warning(json.dumps(entry, sort_keys=True))
+
+
+############################################################
+# Statement and request hooks
+
+
+def record_statement(statement, duration):
+    """Logs a slow statement and tallies its shape for the request."""
+
+    duration_ms = duration * 1000
+    shape = statement_shape(statement)
+
+    if duration_ms >= settings["slow_ms"]:
+        log_entry(
+            event="slow_query",
+            view=current_view(),
+            path=request.path if has_request_context() else None,
+            duration_ms=round(duration_ms, 2),
+            statement=shape,
+        )
+
+    if has_request_context() and "querylog_shapes" in g:
+        g.querylog_shapes[shape] += 1
+        g.querylog_times[shape] += duration_ms
+
+
+def start_request_log():
+    """Starts tallying statement shapes for a request."""
+
+    g.querylog_shapes = Counter()
+    g.querylog_times = defaultdict(float)
+
+
+def check_n_plus_one(response):
+    """Flags statement shapes repeated too often within the request."""
+
+    if "querylog_shapes" not in g:
+        return response
+
+    for shape, count in g.querylog_shapes.items():
+        if count >= settings["n_plus_one"]:
+            log_entry(
+                event="n_plus_one",
+                view=current_view(),
+                path=request.path,
+                count=count,
+                total_ms=round(g.querylog_times[shape], 2),
+                statement=shape,
+            )
+
+    return response
+
+
+@contextmanager
+def count_queries():
+    """Collects the SQL statements executed within the block into a list."""
+
+    statements = []
+
+    def record(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    event.listen(Engine, "after_cursor_execute", record)
+    try:
+        yield statements
+    finally:
+        event.remove(Engine, "after_cursor_execute", record)
+
+
+############################################################
+# Report
+
+
+def summarize(entries):
+    """Aggregates query-log entries by event, view and statement shape."""
+
+    summary = {}
+
+    for entry in entries:
+        key = (entry["event"], entry["view"], entry["statement"])
+        item = summary.setdefault(
+            key,
+            {
+                "event": entry["event"],
+                "view": entry["view"],
+                "statement": entry["statement"],
+                "occurrences": 0,
+                "total_ms": 0.0,
+                "max_ms": 0.0,
+                "max_count": 0,
+            },
+        )
+        duration = entry.get("duration_ms", entry.get("total_ms", 0.0))
+        item["occurrences"] += 1
+        item["total_ms"] += duration
+        item["max_ms"] = max(item["max_ms"], duration)
+        item["max_count"] = max(item["max_count"], entry.get("count", 1))
+
+    return sorted(summary.values(), key=lambda item: item["total_ms"], reverse=True)
+
+
+@click.command("query-report")
+@click.argument("path", required=False)
+@click.option("--limit", default=20, help="Number of entries to show per event.")
+@click.option("--as-json", is_flag=True, help="Print the report as JSON.")
+@with_appcontext
+def query_report(path, limit, as_json):
+    """Summarizes a query log file (QUERY_LOG_PATH by default)."""
+
+    from flask import current_app
+
+    path = path or current_app.config.get("QUERY_LOG_PATH")
+    if not path:
+        raise click.UsageError("No log file given and QUERY_LOG_PATH is not set.")
+
+    entries = []
+    with open(path) as log_file:
+        for line in log_file:
+            try:
+                entries.append(json.loads(line))
+            except ValueError:
+                continue
+
+    report = summarize(entries)
+
+    if as_json:
+        click.echo(json.dumps(report, indent=2))
+        return
+
+    for event_name, heading in (
+        ("slow_query", "Slow queries"),
+        ("n_plus_one", "Repeated queries (N+1)"),
+    ):
+        items = [item for item in report if item["event"] == event_name][:limit]
+        click.echo(f"{heading}: {len(items)}")
+
+        for item in items:
+            click.echo(
+                f"  {item['view']}: {item['occurrences']}x, "
+                f"total {item['total_ms']:.1f} ms, max {item['max_ms']:.1f} ms"
+                + (
+                    f", up to {item['max_count']} per request"
+                    if event_name == "n_plus_one"
+                    else ""
+                )
+            )
+            click.echo(f"    {item['statement'][:200]}")
+
+
+def init_querylog(app):
+    """Connects the slow-query log and N+1 detector to the Flask app."""
+
+    app.cli.add_command(query_report)
+
+    if not app.config.get("QUERY_LOG_ENABLED", True):
+        return
+
+    settings["slow_ms"] = app.config.get("SLOW_QUERY_THRESHOLD_MS", 100.0)
+    settings["n_plus_one"] = app.config.get("N_PLUS_ONE_THRESHOLD", 5)
+
+    if app.config.get("QUERY_LOG_PATH") and not logger.handlers:
+        handler = logging.FileHandler(app.config["QUERY_LOG_PATH"])
+        handler.setFormatter(logging.Formatter("%(message)s"))
+        logger.addHandler(handler)
+
+    observe_statements(record_statement)
+
+    app.before_request(start_request_log)
+    app.after_request(check_n_plus_one)
@@ -0,0 +1,375 @@
+"""Rate limiting of the app's busiest and costliest endpoints, with token buckets.
+
+RATE_LIMITS maps endpoint names (or fnmatch patterns of them, like "api_*"
+for the whole JSON API) to limits, each a scope and a rate such as
+"30/minute". A limit gives every client of the endpoints it covers a bucket
+holding up to that many tokens, refilled at that rate; a request takes a
+token from each bucket, and is answered with a 429 and a Retry-After header
+if one is empty. The scopes are:
+
+- "user": one bucket per logged-in user (per IP address for anyone else);
+- "ip": one bucket per IP address;
+- "endpoint": one bucket shared by everyone, such as for the lyrics API's
+  quota.
+
+Limits are checked in the order given, and a request refused by one doesn't
+take tokens from the ones after it, so list the narrowest first. Checks run
+before the user is loaded, from the session cookie alone, so a refused
+request never reaches the main database.
+
+Buckets are kept in memory by default, so each worker process limits on its
+own. Set RATE_LIMIT_STORAGE_URL to a database URL to share them between
+processes instead: a SQLite file (for workers on one host) or a database
+server of its own, never the main database. If that storage can't be
+reached, requests are let through rather than refused.
+"""
+
+import logging
+import math
+import threading
+import time
+from fnmatch import fnmatchcase
+
+from flask import jsonify, render_template, request, session
+from sqlalchemy import (
+    Column,
+    Float,
+    MetaData,
+    Table,
+    Text,
+    create_engine,
+    event,
+    select,
+)
+from sqlalchemy.exc import IntegrityError, SQLAlchemyError
+from sqlalchemy.pool import QueuePool
+
+from metrics import metrics
+
+logger = logging.getLogger("setlist.ratelimit")
+
+PERIODS = {"second": 1, "minute": 60, "hour": 3600, "day": 86400}
+SCOPES = ("user", "ip", "endpoint")
+# How often buckets that have refilled (and so needn't be kept) are pruned.
+PRUNE_INTERVAL = 60
+
+settings = {"limits": {}, "session_key": "curr_user", "proxies": 0}
+
+# Endpoint name -> [(rule name, scope, Rate)], filled in as endpoints are seen.
+_rules = {}
+
+
+class Rate:
+    """A token bucket's size and refill rate, parsed from e.g. "30/minute"."""
+
+    def __init__(self, text):
+        try:
+            count, period = text.split("/")
+            self.capacity = int(count)
+            self.period = PERIODS[period.strip()]
+        except (KeyError, ValueError):
+            raise ValueError(
+                f"Invalid rate {text!r}; use a count per {', '.join(PERIODS)}, "
+                "like 30/minute."
+            )
+
+        if self.capacity < 1:
+            raise ValueError(f"Invalid rate {text!r}; the count must be positive.")
+
+        self.per_second = self.capacity / self.period
+
+    def take(self, tokens, updated_at, now):
+        """Takes a token from a bucket last left with tokens at updated_at.
+
+        Returns the tokens left and, if the bucket was empty (and so left as
+        it was), how many seconds until it holds a token; else None."""
+
+        if tokens is None:
+            tokens = self.capacity
+        else:
+            elapsed = max(0.0, now - updated_at)
+            tokens = min(self.capacity, tokens + elapsed * self.per_second)
+
+        if tokens >= 1:
+            return tokens - 1, None
+
+        return tokens, (1 - tokens) / self.per_second
+
+
+class MemoryBuckets:
+    """Token buckets kept in this process."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.buckets = {}
+        self.pruned_at = time.time()
+
+    def take(self, key, rate, now):
+        """Takes a token from a bucket, returning None or the seconds to wait."""
+
+        with self.lock:
+            tokens, updated_at = self.buckets.get(key, (None, None))
+            tokens, retry_after = rate.take(tokens, updated_at, now)
+            self.buckets[key] = (tokens, now)
+
+            if now - self.pruned_at > PRUNE_INTERVAL:
+                self.prune(now)
+
+        return retry_after
+
+    def prune(self, now):
+        """Forgets buckets long enough untouched to have refilled completely."""
+
+        horizon = now - max_period()
+        self.buckets = {
+            key: bucket for key, bucket in self.buckets.items() if bucket[1] > horizon
+        }
+        self.pruned_at = now
+
+    def reset(self):
+        """Refills every bucket."""
+
+        with self.lock:
+            self.buckets.clear()
+
+
+class DatabaseBuckets:
+    """Token buckets kept in a database of their own, shared between processes.
+
+    Each take is one short transaction that locks the bucket's row (or, on
+    SQLite, the database) while it's read and written."""
+
+    def __init__(self, url):
+        self.metadata = MetaData()
+        self.table = Table(
+            "rate_limit_buckets",
+            self.metadata,
+            Column("key", Text, primary_key=True),
+            Column("tokens", Float, nullable=False),
+            Column("updated_at", Float, nullable=False, index=True),
+        )
+        self.pruned_at = 0.0
+
+        if url.startswith("sqlite"):
+            # Pooled (SQLAlchemy would otherwise reconnect for every take),
+            # and so handed between threads.
+            self.engine = create_engine(
+                url,
+                poolclass=QueuePool,
+                connect_args={"check_same_thread": False},
+            )
+            self.lock_sqlite_transactions()
+        else:
+            self.engine = create_engine(url)
+
+        self.create_table()
+
+    def create_table(self):
+        """Creates the buckets' table, unless another process just has."""
+
+        for attempt in range(2):
+            try:
+                with self.engine.begin() as connection:
+                    self.metadata.create_all(connection)
+                return
+            except SQLAlchemyError:
+                # Workers starting together race to create it; the loser
+                # finds it there the second time.
+                if attempt:
+                    raise
+
+    def lock_sqlite_transactions(self):
+        """Makes SQLite transactions take the write lock as they begin.
+
+        Otherwise two processes could read a bucket, and then neither could
+        write it."""
+
+        @event.listens_for(self.engine, "connect")
+        def connect(dbapi_connection, connection_record):
+            dbapi_connection.isolation_level = None
+            dbapi_connection.execute("PRAGMA journal_mode=WAL")
+            # Losing the last moment of buckets to a power cut is harmless.
+            dbapi_connection.execute("PRAGMA synchronous=NORMAL")
+            dbapi_connection.execute("PRAGMA busy_timeout=1000")
+
+        @event.listens_for(self.engine, "begin")
+        def begin(connection):
+            connection.execute("BEGIN IMMEDIATE")
+
+    def take(self, key, rate, now):
+        """Takes a token from a bucket, returning None or the seconds to wait."""
+
+        table = self.table
+
+        for attempt in range(2):
+            try:
+                with self.engine.begin() as connection:
+                    row = connection.execute(
+                        select([table.c.tokens, table.c.updated_at])
+                        .where(table.c.key == key)
+                        .with_for_update()
+                    ).first()
+                    tokens, updated_at = row if row is not None else (None, None)
+                    tokens, retry_after = rate.take(tokens, updated_at, now)
+
+                    if row is None:
+                        connection.execute(
+                            table.insert(), key=key, tokens=tokens, updated_at=now
+                        )
+                    else:
+                        connection.execute(
+                            table.update().where(table.c.key == key),
+                            tokens=tokens,
+                            updated_at=now,
+                        )
+
+                    if now - self.pruned_at > PRUNE_INTERVAL:
+                        self.pruned_at = now
+                        connection.execute(
+                            table.delete().where(
+                                table.c.updated_at < now - max_period()
+                            )
+                        )
+
+                return retry_after
+            except IntegrityError:
+                # Another process added the bucket first; take from theirs.
+                if attempt:
+                    raise
+
+    def reset(self):
+        """Refills every bucket."""
+
+        with self.engine.begin() as connection:
+            connection.execute(self.table.delete())
+
+
+buckets = MemoryBuckets()
+
+
+def max_period():
+    """Returns the longest any bucket takes to refill completely."""
+
+    return max(
+        (rate.period for limits in settings["limits"].values() for _, rate in limits),
+        default=0,
+    )
+
+
+def endpoint_rules(endpoint):
+    """Returns the (rule name, scope, Rate) limits covering an endpoint."""
+
+    rules = _rules.get(endpoint)
+
+    if rules is None:
+        rules = [
+            (name, scope, rate)
+            for name, limits in settings["limits"].items()
+            if fnmatchcase(endpoint, name)
+            for scope, rate in limits
+        ]
+        _rules[endpoint] = rules
+
+    return rules
+
+
+def client_ip():
+    """Returns the client's IP address, as seen by the first trusted proxy."""
+
+    proxies = settings["proxies"]
+    route = request.access_route
+
+    if proxies and len(route) >= proxies:
+        return route[-proxies]
+
+    return request.remote_addr
+
+
+def bucket_key(name, scope):
+    """Returns the key of the current client's bucket for a limit."""
+
+    if scope == "endpoint":
+        return f"{name}:endpoint"
+
+    user_id = session.get(settings["session_key"]) if scope == "user" else None
+
+    if user_id is not None:
+        return f"{name}:{scope}:user:{user_id}"
+
+    return f"{name}:{scope}:ip:{client_ip()}"
+
+
+def check_rate_limits():
+    """Refuses the request with a 429 if it's over any of its endpoint's limits."""
+
+    if request.endpoint is None:
+        return None
+
+    now = time.time()
+
+    for name, scope, rate in endpoint_rules(request.endpoint):
+        try:
+            retry_after = buckets.take(bucket_key(name, scope), rate, now)
+        except SQLAlchemyError as error:
+            logger.warning("Rate limit storage unavailable, not limiting: %r", error)
+            return None
+
+        if retry_after is not None:
+            metrics.record_rate_limited(request.endpoint, scope)
+            return too_many_requests(math.ceil(retry_after))
+
+    return None
+
+
+def too_many_requests(retry_after):
+    """Returns a 429 response, asking the client to wait retry_after seconds."""
+
+    message = f"Too many requests; try again in {retry_after} seconds."
+
+    if request.path.startswith("/api/"):
+        response = jsonify(error=message)
+    else:
+        response = render_template("429.html", message=message)
+
+    return response, 429, {"Retry-After": str(retry_after)}
+
+
+def parse_limits(config):
+    """Returns RATE_LIMITS with each rate parsed, or raises ValueError."""
+
+    limits = {}
+
+    for name, rules in config.items():
+        for scope, _ in rules:
+            if scope not in SCOPES:
+                raise ValueError(
+                    f"Invalid rate limit scope {scope!r} for {name}; "
+                    f"use one of {', '.join(SCOPES)}."
+                )
+
+        limits[name] = [(scope, Rate(text)) for scope, text in rules]
+
+    return limits
+
+
+def init_ratelimit(app):
+    """Limits requests to the Flask app's endpoints, as RATE_LIMITS sets out."""
+
+    global buckets
+
+    if not app.config.get("RATE_LIMIT_ENABLED", True):
+        return
+
+    settings["limits"] = parse_limits(app.config.get("RATE_LIMITS", {}))
+    settings["session_key"] = app.config.get("RATE_LIMIT_SESSION_KEY", "curr_user")
+    settings["proxies"] = app.config.get("RATE_LIMIT_PROXIES", 0)
+    _rules.clear()
+
+    url = app.config.get("RATE_LIMIT_STORAGE_URL")
+
+    if url == app.config["SQLALCHEMY_DATABASE_URI"]:
+        raise ValueError("RATE_LIMIT_STORAGE_URL must not be the main database.")
+
+    buckets = DatabaseBuckets(url) if url else MemoryBuckets()
+
+    app.before_request(check_rate_limits)
@@ -0,0 +1,112 @@
+"""Read-replica routing for the Setlist Manager.
+
+Views marked with @reads_from_replica run their SELECTs against a read
+replica (one of the SQLALCHEMY_BINDS named replica*, picked at random per
+request) when they're requested with GET. Everything else uses the primary:
+other views, flushes and bulk writes, and every query after a session has
+written anything.
+
+Replicas lag the primary a little, so a user who has just changed something
+would otherwise not see their change. After any POST (or other unsafe
+request), that user's reads go to the primary for REPLICA_LAG_WINDOW seconds.
+"""
+
+import random
+import time
+from functools import wraps
+
+from flask import g, has_request_context, request, session
+from flask_sqlalchemy import SignallingSession, SQLAlchemy
+from sqlalchemy import event, orm
+from sqlalchemy.sql.expression import SelectBase
+
+LAST_WRITE_KEY = "last_write"
+SAFE_METHODS = ("GET", "HEAD", "OPTIONS")
+
+settings = {"binds": [], "lag_window": 5.0}
+
+
+class RoutingSession(SignallingSession):
+    """A session that sends a replica-reading view's SELECTs to a replica."""
+
+    def __init__(self, db, **options):
+        super().__init__(db, **options)
+        self.db = db
+        self.wrote = False
+        self.replica_bind = None
+
+    def get_bind(self, mapper=None, clause=None):
+        if isinstance(clause, SelectBase) and self.may_use_replica():
+            if self.replica_bind is None:
+                self.replica_bind = random.choice(settings["binds"])
+
+            return self.db.get_engine(self.app, bind=self.replica_bind)
+
+        return super().get_bind(mapper, clause)
+
+    def may_use_replica(self):
+        """Returns whether the current query may be answered by a replica."""
+
+        return (
+            bool(settings["binds"])
+            and not self.wrote
+            and not self._flushing
+            and has_request_context()
+            and g.get("read_from_replica", False)
+            and not wrote_recently()
+        )
+
+
+@event.listens_for(RoutingSession, "after_flush")
+@event.listens_for(RoutingSession, "after_bulk_update")
+@event.listens_for(RoutingSession, "after_bulk_delete")
+def note_write(session_or_context, *args):
+    """Keeps a session on the primary once it has written anything."""
+
+    getattr(session_or_context, "session", session_or_context).wrote = True
+
+
+class RoutingSQLAlchemy(SQLAlchemy):
+    """Flask-SQLAlchemy, with sessions that can read from replicas."""
+
+    def create_session(self, options):
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
+
+
+def wrote_recently():
+    """Returns whether the current user wrote within the replica lag window."""
+
+    last_write = session.get(LAST_WRITE_KEY)
+    return last_write is not None and time.time() - last_write < settings["lag_window"]
+
+
+def reads_from_replica(view):
+    """Lets a view's GET requests be answered from a read replica."""
+
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        g.read_from_replica = request.method in ("GET", "HEAD")
+        return view(*args, **kwargs)
+
+    return wrapper
+
+
+def remember_write(response):
+    """Notes when the user last sent a request that may have written."""
+
+    if request.method not in SAFE_METHODS and settings["binds"]:
+        session[LAST_WRITE_KEY] = time.time()
+
+    return response
+
+
+def init_replicas(app):
+    """Sets up read-replica routing for the Flask app."""
+
+    settings["binds"] = sorted(
+        bind
+        for bind in app.config.get("SQLALCHEMY_BINDS") or {}
+        if bind.startswith("replica")
+    )
+    settings["lag_window"] = app.config.get("REPLICA_LAG_WINDOW", 5.0)
+    app.after_request(remember_write)
@@ -0,0 +1,41 @@
+// Suggests song titles and artists from /api/autocomplete as a search term is
+// typed, when searching songs by title or artist.
+
+const AUTOCOMPLETE_DELAY_MS = 100;
+const AUTOCOMPLETE_FIELDS = { title: "titles", artist: "artists" };
+
+let autocompleteTimeout = null;
+
+async function suggestCompletions() {
+  let field = $("#category").val();
+  let prefix = $("#term").val();
+  let suggestions = $("#term-suggestions").empty();
+
+  if (!(field in AUTOCOMPLETE_FIELDS) || !prefix.trim()) {
+    return;
+  }
+
+  let response = await axios.get("/api/autocomplete", {
+    params: { q: prefix, field: field },
+  });
+
+  // Drop answers to a prefix the user has since typed past.
+  if ($("#term").val() !== prefix) {
+    return;
+  }
+
+  for (let completion of response.data[AUTOCOMPLETE_FIELDS[field]]) {
+    suggestions.append($("<option>").attr("value", completion));
+  }
+}
+
+$(function () {
+  $("#term")
+    .attr({ list: "term-suggestions", autocomplete: "off" })
+    .after('<datalist id="term-suggestions"></datalist>')
+    .on("input", function () {
+      clearTimeout(autocompleteTimeout);
+      autocompleteTimeout = setTimeout(suggestCompletions, AUTOCOMPLETE_DELAY_MS);
+    });
+  $("#category").on("change", suggestCompletions);
+});
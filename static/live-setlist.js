@@ -0,0 +1,123 @@
+// Keeps a setlist or perform page up to date as the setlist changes elsewhere,
+// and in perform mode, moves followers to the song the band leader is on.
+
+const LIVE = JSON.parse(document.getElementById("live-setlist").textContent);
+
+let liveVersion = LIVE.version;
+let liveSongs = LIVE.songs;
+let liveNotes = LIVE.notes;
+
+// Functions for making HTML ----------------------------
+
+function escapeHTML(text) {
+  return String(text)
+    .replace(/&/g, "&amp;")
+    .replace(/</g, "&lt;")
+    .replace(/>/g, "&gt;")
+    .replace(/"/g, "&quot;");
+}
+
+function performURL(songId) {
+  let query = LIVE.mode ? `?mode=${LIVE.mode}` : "";
+  return `/setlists/${LIVE.setlistId}/perform/${songId}${query}`;
+}
+
+function makeShowSongHTML(song) {
+  return `<li><a href="/songs/${song.id}">${escapeHTML(song.title)}</a> by ${escapeHTML(song.artist)}</li>`;
+}
+
+function makePerformSongHTML(song) {
+  let style = song.id === LIVE.activeSongId ? "primary" : "secondary";
+  return `<div>
+        <a class="my-4 btn btn-block btn-${style}" href="${performURL(song.id)}">${escapeHTML(song.title)}</a>
+    </div>`;
+}
+
+function renderSetlist() {
+  let makeHTML = LIVE.page === "perform" ? makePerformSongHTML : makeShowSongHTML;
+
+  $("#live-songs")
+    .html(liveSongs.map(makeHTML).join(""))
+    .toggle(LIVE.page === "perform" || liveSongs.length > 0);
+  $("#live-no-songs").toggle(liveSongs.length === 0);
+  $("#live-notes").text(liveNotes);
+  $("#live-notes-section").toggle(liveNotes !== "");
+}
+
+// Applying changes -------------------------------------
+
+// Applies {start, end, text} splices, counting code points as the server does.
+function applyTextDelta(text, delta) {
+  let chars = Array.from(text);
+
+  for (let splice of delta) {
+    chars.splice(splice.start, splice.end - splice.start, ...Array.from(splice.text));
+  }
+  return chars.join("");
+}
+
+function applyChange(change) {
+  if (change.version !== liveVersion + 1) {
+    // We missed a change, so start again from the server's copy.
+    window.location.reload();
+    return;
+  }
+
+  for (let op of change.ops) {
+    if (op.op === "move") {
+      liveSongs.splice(op.to, 0, liveSongs.splice(op.from, 1)[0]);
+    } else if (op.op === "insert") {
+      liveSongs.splice(op.index, 0, change.songs[op.song_id]);
+    } else if (op.op === "remove") {
+      liveSongs.splice(op.index, 1);
+    }
+  }
+
+  liveNotes = applyTextDelta(liveNotes, change.notes);
+  liveVersion = change.version;
+  renderSetlist();
+}
+
+function followLeader(position) {
+  if (LIVE.mode === "follow" && position.song_id !== LIVE.activeSongId) {
+    window.location.replace(performURL(position.song_id));
+  }
+}
+
+// Event stream -----------------------------------------
+
+function connect() {
+  let events = new EventSource(`/api/setlists/${LIVE.setlistId}/events`);
+
+  events.addEventListener("sync", function (e) {
+    if (JSON.parse(e.data).version !== liveVersion) {
+      window.location.reload();
+    }
+  });
+
+  events.addEventListener("change", function (e) {
+    applyChange(JSON.parse(e.data));
+  });
+
+  events.addEventListener("position", function (e) {
+    followLeader(JSON.parse(e.data));
+  });
+
+  events.addEventListener("reload", function () {
+    window.location.reload();
+  });
+}
+
+$(document).ready(function () {
+  if (!window.EventSource) {
+    return;
+  }
+
+  connect();
+
+  if (LIVE.mode === "lead") {
+    axios.post(`/api/setlists/${LIVE.setlistId}/position`, {
+      song_id: LIVE.activeSongId,
+    });
+  }
+});
@@ -1,15 +1,51 @@
 const BASE_URL = window.location.pathname.split("/")[0];
 const SETLIST_ID = window.location.pathname.split("/")[2];
 
+// The "Other Songs" list is virtualized: only the rows scrolled into view (plus
+// a few either side) are in the DOM, and padding on the list stands in for the
+// rest. Rows therefore have a fixed height.
+const ROW_HEIGHT = 48;
+const OVERSCAN_ROWS = 10;
+const FILTER_DELAY_MS = 150;
+const NOTES_SAVE_DELAY_MS = 1000;
+const RETRY_DELAY_MS = 1000; // doubled after each failed retry
+const MAX_RETRIES = 5;
+
 let setlistSongs = [];
-let otherSongs = [];
+let otherSongs = []; // sorted by compareSongs
+let filteredSongs = null; // sorted subset of otherSongs, or null if unfiltered
+let songsById = new Map();
+
+let renderPending = false;
+let filterTimeout = null;
+
+// Edits are sent as patches against the setlist version they were made on.
+// One patch is in flight at a time; operations made meanwhile queue up and go
+// out together in the next one. A patch lost to a network error is retried a
+// few times, backing off; one the server refused would only be refused again,
+// so the editor reloads the setlist instead.
+let setlistVersion = null;
+let savedNotes = "";
+let pendingOps = [];
+let patchInFlight = false;
+let notesTimeout = null;
+let retryTimeout = null;
+let retries = 0;
 
 // Functions for making HTML ----------------------------
 
+function escapeHTML(text) {
+  return String(text)
+    .replace(/&/g, "&amp;")
+    .replace(/</g, "&lt;")
+    .replace(/>/g, "&gt;")
+    .replace(/"/g, "&quot;");
+}
+
 function makeSetlistSongHTML(song) {
   return `
         <li id="song-li-${song.id}" data-id="${song.id}" class="alert alert-primary item" style="user-select: none;">||&nbsp
-            <a href="/songs/${song.id}" target="_blank">${song.title}</a> <small>by ${song.artist}</small>
+            <a href="/songs/${song.id}" target="_blank">${escapeHTML(song.title)}</a> <small>by ${escapeHTML(song.artist)}</small>
             <span class="badge badge-light float-right mt-1" style="cursor: pointer;" id="remove-song-${song.id}" data-id="${song.id}">X</span>
         </li>
     `;
@@ -17,32 +53,126 @@ function makeSetlistSongHTML(song) {
 
 function makeOtherSongHTML(song) {
   return `
-        <li id="song-li-${song.id}" data-id="${song.id}" class="alert alert-primary item">
-            <span class="badge badge-light" style="cursor: pointer;" data-id="${song.id}" id="add-song-${song.id}">&lt</span> 
-            <a href="/songs/${song.id}" target="_blank">${song.title}</a> <small>by ${song.artist}</small>
+        <li id="song-li-${song.id}" data-id="${song.id}" class="alert alert-primary item text-truncate"
+            style="height: ${ROW_HEIGHT - 4}px; margin-bottom: 4px; padding: 0.6rem 1rem;">
+            <span class="badge badge-light" style="cursor: pointer;" data-id="${song.id}" id="add-song-${song.id}">&lt</span>
+            <a href="/songs/${song.id}" target="_blank">${escapeHTML(song.title)}</a> <small>by ${escapeHTML(song.artist)}</small>
         </li>
     `;
 }
 
-// Helper function for sorting
+// Helper function for sorting; ties are broken by id so that every song has
+// exactly one sorted position, which binary search relies on.
 function compareSongs(a, b) {
-  let a_title = a.title.toLowerCase();
-  let b_title = b.title.toLowerCase();
+  return a.sortKey < b.sortKey
+    ? -1
+    : a.sortKey > b.sortKey
+    ? 1
+    : a.id - b.id;
+}
 
-  return a_title < b_title ? -1 : a_title > b_title ? 1 : 0;
+// Returns the index at which song is, or would be inserted, in sorted songs.
+function sortedIndex(songs, song) {
+  let low = 0;
+  let high = songs.length;
+
+  while (low < high) {
+    let mid = (low + high) >>> 1;
+    if (compareSongs(songs[mid], song) < 0) {
+      low = mid + 1;
+    } else {
+      high = mid;
+    }
+  }
+  return low;
 }
 
-// Helper function for verifying update
-function arrayEquals(a, b) {
-  if (!Array.isArray(a) || !Array.isArray(b) || a.length !== b.length) {
-    return false;
+function insertSorted(songs, song) {
+  songs.splice(sortedIndex(songs, song), 0, song);
+}
+
+function removeSorted(songs, song) {
+  let index = sortedIndex(songs, song);
+  if (songs[index] === song) {
+    songs.splice(index, 1);
   }
-  for (i = 0; i < a.length; i++) {
-    if (a[i] !== b[i]) {
-      return false;
-    }
+}
+
+function prepareSong(song) {
+  song.sortKey = song.title.toLowerCase();
+  song.searchKey = `${song.sortKey}\n${song.artist.toLowerCase()}`;
+  songsById.set(song.id, song);
+  return song;
+}
+
+// Returns the splice turning oldText into newText, as a list of at most one
+// {start, end, text}. Positions count code points, as the server's do.
+function textDelta(oldText, newText) {
+  let oldChars = Array.from(oldText);
+  let newChars = Array.from(newText);
+  let start = 0;
+
+  while (
+    start < oldChars.length &&
+    start < newChars.length &&
+    oldChars[start] === newChars[start]
+  ) {
+    start++;
+  }
+
+  let oldEnd = oldChars.length;
+  let newEnd = newChars.length;
+
+  while (
+    oldEnd > start &&
+    newEnd > start &&
+    oldChars[oldEnd - 1] === newChars[newEnd - 1]
+  ) {
+    oldEnd--;
+    newEnd--;
+  }
+
+  if (start === oldEnd && start === newEnd) {
+    return [];
+  }
+  return [{ start, end: oldEnd, text: newChars.slice(start, newEnd).join("") }];
+}
+
+// Rendering the virtualized "Other Songs" list ---------
+
+function visibleOtherSongs() {
+  return filteredSongs === null ? otherSongs : filteredSongs;
+}
+
+function renderOtherSongs() {
+  renderPending = false;
+
+  let list = document.getElementById("songs-not-in-setlist");
+  let songs = visibleOtherSongs();
+  let first = Math.max(
+    0,
+    Math.floor(list.scrollTop / ROW_HEIGHT) - OVERSCAN_ROWS
+  );
+  let last = Math.min(
+    songs.length,
+    Math.ceil((list.scrollTop + list.clientHeight) / ROW_HEIGHT) + OVERSCAN_ROWS
+  );
+
+  let html = "";
+  for (let i = first; i < last; i++) {
+    html += makeOtherSongHTML(songs[i]);
+  }
+
+  list.style.paddingTop = `${first * ROW_HEIGHT}px`;
+  list.style.paddingBottom = `${(songs.length - last) * ROW_HEIGHT}px`;
+  list.innerHTML = html;
+}
+
+function scheduleRender() {
+  if (!renderPending) {
+    renderPending = true;
+    window.requestAnimationFrame(renderOtherSongs);
   }
-  return true;
 }
 
 // Displaying, filtering, moving songs ------------------
@@ -52,133 +182,220 @@ async function showSongsInitial() {
     `${BASE_URL}/api/setlists/${SETLIST_ID}/get-songs`
   );
 
-  setlistSongs = setlistSongsResponse.data.setlistSongs;
-  otherSongs = setlistSongsResponse.data.otherSongs;
+  setlistSongs = setlistSongsResponse.data.setlistSongs.map(prepareSong);
+  otherSongs = setlistSongsResponse.data.otherSongs.map(prepareSong);
+  otherSongs.sort(compareSongs);
+  setlistVersion = setlistSongsResponse.data.version;
+  savedNotes = setlistSongsResponse.data.notes;
+
+  $("#songs-in-setlist").append(setlistSongs.map(makeSetlistSongHTML).join(""));
+  $("#setlist-notes").val(savedNotes);
+
+  sortable(".sortable");
+  filterSongs();
+}
 
-  for (let song of setlistSongs) {
-    let newSong = $(makeSetlistSongHTML(song));
-    $("#songs-in-setlist").append(newSong);
+// Replaces the editor's state with the server's, after a refused edit.
+async function reloadSongs() {
+  try {
+    let res = await axios.get(
+      `${BASE_URL}/api/setlists/${SETLIST_ID}/get-songs`
+    );
+    resetSongs(
+      res.data.setlistSongs.map((song) => song.id),
+      res.data.notes,
+      res.data.version
+    );
+  } catch (err) {
+    window.location.reload();
   }
+}
 
-  for (let song of otherSongs) {
-    let newSong = $(makeOtherSongHTML(song));
-    $("#songs-not-in-setlist").append(newSong);
+// Replaces the editor's state with the server's, after a conflicting edit.
+function resetSongs(songIds, notes, version) {
+  if (!songIds.every((id) => songsById.has(id))) {
+    // Songs were added to the catalog since the page loaded.
+    window.location.reload();
+    return;
   }
 
+  let inSetlist = new Set(songIds);
+
+  setlistSongs = songIds.map((id) => songsById.get(id));
+  otherSongs = Array.from(songsById.values()).filter(
+    (song) => !inSetlist.has(song.id)
+  );
+  otherSongs.sort(compareSongs);
+  setlistVersion = version;
+  savedNotes = notes;
+  pendingOps = [];
+
+  $("#songs-in-setlist").html(setlistSongs.map(makeSetlistSongHTML).join(""));
+  $("#setlist-notes").val(notes);
+
   sortable(".sortable");
+  filterSongs();
 }
 
-function filterSongs() {
-  if ($("#filter").is(":checked")) {
-    let filterString = $("#filter-string").val().toLowerCase();
-    for (let song of otherSongs) {
-      if (filterString === "") {
-        clearFilter();
-      } else if (
-        !(
-          song.title.toLowerCase().includes(filterString) ||
-          song.artist.toLowerCase().includes(filterString)
-        )
-      ) {
-        $(`#song-li-${song.id}`).addClass("d-none");
-      } else {
-        $(`#song-li-${song.id}`).removeClass("d-none");
-      }
-    }
-  } else {
-    clearFilter();
-  }
+function matchesFilter(song, filterString) {
+  return song.searchKey.includes(filterString);
 }
 
-function clearFilter() {
-  for (let song of otherSongs) {
-    $(`#song-li-${song.id}`).removeClass("d-none");
+function currentFilter() {
+  if (!$("#filter").is(":checked")) {
+    return "";
   }
+  return $("#filter-string").val().toLowerCase();
 }
 
-function addSongToSetlist(song) {
-  let newHTML = makeSetlistSongHTML(song);
-  let oldSongLocation = otherSongs.indexOf(song);
+function filterSongs() {
+  let filterString = currentFilter();
+
+  filteredSongs =
+    filterString === ""
+      ? null
+      : otherSongs.filter((song) => matchesFilter(song, filterString));
 
+  document.getElementById("songs-not-in-setlist").scrollTop = 0;
+  scheduleRender();
+}
+
+function filterSongsSoon() {
+  clearTimeout(filterTimeout);
+  filterTimeout = setTimeout(filterSongs, FILTER_DELAY_MS);
+}
+
+function addSongToSetlist(song) {
+  pendingOps.push({ op: "insert", song_id: song.id, index: setlistSongs.length });
   setlistSongs.push(song);
-  otherSongs.splice(oldSongLocation, 1);
+  removeSorted(otherSongs, song);
+  if (filteredSongs !== null) {
+    removeSorted(filteredSongs, song);
+  }
 
-  $(`#song-li-${song.id}`).remove();
-  $("#songs-in-setlist").append($(newHTML));
+  $("#songs-in-setlist").append($(makeSetlistSongHTML(song)));
+  scheduleRender();
+  sendPatch();
 }
 
 function removeSongFromSetlist(song) {
-  let newHTML = makeOtherSongHTML(song);
-  let oldSongLocation = setlistSongs.indexOf(song);
+  let songLi = $(`#song-li-${song.id}`);
 
-  otherSongs.push(song);
-  setlistSongs.splice(oldSongLocation, 1);
+  pendingOps.push({ op: "remove", index: songLi.index() });
+  setlistSongs.splice(setlistSongs.indexOf(song), 1);
+  insertSorted(otherSongs, song);
+  if (filteredSongs !== null && matchesFilter(song, currentFilter())) {
+    insertSorted(filteredSongs, song);
+  }
 
-  $(`#song-li-${song.id}`).remove();
+  songLi.remove();
+  scheduleRender();
+  sendPatch();
+}
 
-  otherSongs.sort(compareSongs);
-  $("#songs-not-in-setlist").empty();
+// Saving changes ---------------------------------------
 
-  for (let song of otherSongs) {
-    let newSong = $(makeOtherSongHTML(song));
-    $("#songs-not-in-setlist").append(newSong);
+async function sendPatch() {
+  if (patchInFlight || setlistVersion === null) {
+    return;
   }
 
-  filterSongs();
+  let notes = $("#setlist-notes").val();
+  let notesDelta = textDelta(savedNotes, notes);
+
+  if (pendingOps.length === 0 && notesDelta.length === 0) {
+    return;
+  }
+
+  let ops = pendingOps;
+  let retrying = false;
+  pendingOps = [];
+  patchInFlight = true;
+  clearTimeout(retryTimeout);
+
+  try {
+    let res = await axios.post(
+      `${BASE_URL}/api/setlists/${SETLIST_ID}/patch`,
+      { version: setlistVersion, ops: ops, notes: notesDelta }
+    );
+
+    setlistVersion = res.data.version;
+    savedNotes = notes;
+    retries = 0;
+    $("#success").show().delay(3000).fadeOut("slow");
+  } catch (err) {
+    if (err.response && err.response.status === 409) {
+      let current = err.response.data;
+      resetSongs(current.songs, current.notes, current.version);
+      alert(
+        "This setlist was changed somewhere else, so it has been reloaded. " +
+          "Please make your latest change again."
+      );
+    } else if (!err.response && retries < MAX_RETRIES) {
+      pendingOps = ops.concat(pendingOps);
+      retrying = true;
+      retryTimeout = setTimeout(sendPatch, RETRY_DELAY_MS * 2 ** retries);
+      retries++;
+    } else {
+      retries = 0;
+      await reloadSongs();
+      alert(
+        "Something went wrong and the setlist was not successfully updated, " +
+          "so it has been reloaded. Please make your latest change again."
+      );
+    }
+  } finally {
+    patchInFlight = false;
+  }
+
+  if (!retrying && pendingOps.length > 0) {
+    sendPatch();
+  }
 }
 
 // Event listeners --------------------------------------
 
 $("#filter-string").on("input", function () {
-  filterSongs();
+  filterSongsSoon();
 });
 
 $("#filter").on("click", function () {
   filterSongs();
 });
 
-$("#songs-in-setlist").on("click", "span", function () {
-  let songIndex = setlistSongs
-    .map(function (e) {
-      return e.id;
-    })
-    .indexOf(parseInt($(this).data("id")));
+$("#songs-not-in-setlist").on("scroll", function () {
+  scheduleRender();
+});
 
-  removeSongFromSetlist(setlistSongs[songIndex]);
+$("#songs-in-setlist").on("click", "span", function () {
+  removeSongFromSetlist(songsById.get(parseInt($(this).data("id"))));
   sortable(".sortable");
 });
 
 $("#songs-not-in-setlist").on("click", "span", function () {
-  let songIndex = otherSongs
-    .map(function (e) {
-      return e.id;
-    })
-    .indexOf(parseInt($(this).data("id")));
-
-  addSongToSetlist(otherSongs[songIndex]);
+  addSongToSetlist(songsById.get(parseInt($(this).data("id"))));
   sortable(".sortable");
 });
 
-$("#save-changes").on("click", async function () {
-  let serializedSetlist = sortable(".sortable", "serialize");
-  let updatedSetlistIDs = serializedSetlist[0].items.map(
-    (x) => $(x.node).data().id
-  );
-
-  res = await axios.post(
-    `${BASE_URL}/api/setlists/${SETLIST_ID}/update-songs`,
-    {
-      songs: updatedSetlistIDs,
-      notes: $("#setlist-notes").val(),
-    }
-  );
+document
+  .getElementById("songs-in-setlist")
+  .addEventListener("sortupdate", function (e) {
+    pendingOps.push({
+      op: "move",
+      from: e.detail.origin.index,
+      to: e.detail.destination.index,
+    });
+    sendPatch();
+  });
+
+$("#setlist-notes").on("input", function () {
+  clearTimeout(notesTimeout);
+  notesTimeout = setTimeout(sendPatch, NOTES_SAVE_DELAY_MS);
+});
 
-  returnedIDs = res.data.songs.map((x) => x.id);
-  if (arrayEquals(updatedSetlistIDs, returnedIDs)) {
-    $("#success").show().delay(3000).fadeOut("slow");
-  } else {
-    alert("Something went wrong and the setlist was not successfully updated.");
-  }
+$("#save-changes").on("click", function () {
+  clearTimeout(notesTimeout);
+  sendPatch();
 });
 
 $(document).ready(function () {
@@ -0,0 +1,287 @@
+"""Catalog and setlist statistics, kept in summary tables.
+
+How often each song (all users' copies of it together) and each artist is
+used in setlists, and the size of each user's catalog and setlists, are
+GROUP BY aggregates over setlists_songs, songs and setlists. Rather than run
+those on every request, refresh() recomputes them into the *Stats tables (see
+models.py) in one transaction, and the statistics page and API read the
+tables through their indexes: the latest refresh, and the top songs, artists
+and catalogs, each with a LIMIT, so they cost the same however large the
+catalog.
+
+The tables are refreshed periodically: a read that finds them older than
+STATS_MAX_AGE seconds starts `python -m stats` in the background (or, with
+STATS_REFRESH=inline or an in-memory database, refreshes them there and
+then), and `flask refresh-stats` refreshes them from a scheduler.
+"""
+
+import os
+import subprocess
+import sys
+import threading
+import time
+from datetime import datetime, timedelta
+
+import click
+from flask.cli import with_appcontext
+from sqlalchemy import distinct, func, select
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import joinedload
+
+from models import (
+    db,
+    ArtistUsageStats,
+    CanonicalSong,
+    Setlist,
+    SetlistSong,
+    Song,
+    SongUsageStats,
+    StatsRefresh,
+    User,
+    UserStats,
+)
+
+settings = {"max_age": 300, "refresh": "background", "spawn_interval": 10.0}
+
+# When this process last started a refresher.
+_state = {"spawned_at": 0.0}
+_lock = threading.Lock()
+
+
+def song_usage():
+    """Returns a SELECT of each used canonical song's SongUsageStats row."""
+
+    return (
+        select(
+            [
+                CanonicalSong.id,
+                CanonicalSong.title,
+                CanonicalSong.artist,
+                CanonicalSong.artist_key,
+                func.count(),
+                func.count(distinct(SetlistSong.setlist_id)),
+            ]
+        )
+        .select_from(
+            SetlistSong.__table__.join(Song.__table__).join(CanonicalSong.__table__)
+        )
+        .group_by(
+            CanonicalSong.id,
+            CanonicalSong.title,
+            CanonicalSong.artist,
+            CanonicalSong.artist_key,
+        )
+    )
+
+
+def artist_usage():
+    """Returns a SELECT of each used artist's ArtistUsageStats row.
+
+    It reads the freshly refreshed song_usage_stats, which are far fewer
+    rows than the setlist entries they summarize."""
+
+    return select(
+        [
+            SongUsageStats.artist_key,
+            func.min(SongUsageStats.artist),
+            func.count(),
+            func.sum(SongUsageStats.use_count),
+        ]
+    ).group_by(SongUsageStats.artist_key)
+
+
+def user_usage():
+    """Returns a SELECT of each user's UserStats row."""
+
+    songs = (
+        select([Song.user_id, func.count().label("songs")])
+        .where(Song.user_id.isnot(None))
+        .group_by(Song.user_id)
+        .alias("user_songs")
+    )
+    setlists = (
+        select(
+            [
+                Setlist.user_id,
+                func.count().label("setlists"),
+                func.sum(Setlist.song_count).label("setlist_songs"),
+            ]
+        )
+        .group_by(Setlist.user_id)
+        .alias("user_setlists")
+    )
+
+    return select(
+        [
+            User.id,
+            func.coalesce(songs.c.songs, 0),
+            func.coalesce(setlists.c.setlists, 0),
+            func.coalesce(setlists.c.setlist_songs, 0),
+        ]
+    ).select_from(
+        User.__table__.outerjoin(songs, songs.c.user_id == User.id).outerjoin(
+            setlists, setlists.c.user_id == User.id
+        )
+    )
+
+
+def refresh():
+    """Recomputes the summary tables from the live ones, in one transaction.
+
+    Returns False if another process refreshed them at the same time."""
+
+    started = time.perf_counter()
+
+    try:
+        with db.engine.begin() as connection:
+            for model in (SongUsageStats, ArtistUsageStats, UserStats, StatsRefresh):
+                connection.execute(model.__table__.delete())
+
+            for model, query in (
+                (SongUsageStats, song_usage()),
+                (ArtistUsageStats, artist_usage()),
+                (UserStats, user_usage()),
+            ):
+                columns = [column.name for column in model.__table__.columns]
+                connection.execute(model.__table__.insert().from_select(columns, query))
+
+            totals = {
+                f"{name}_count": connection.execute(
+                    select([func.count()]).select_from(model.__table__)
+                ).scalar()
+                for name, model in (
+                    ("user", User),
+                    ("song", Song),
+                    ("canonical_song", CanonicalSong),
+                    ("setlist", Setlist),
+                    ("setlist_song", SetlistSong),
+                )
+            }
+            connection.execute(
+                StatsRefresh.__table__.insert(),
+                refreshed_at=datetime.utcnow(),
+                duration_ms=(time.perf_counter() - started) * 1000,
+                **totals,
+            )
+    except IntegrityError:
+        return False
+
+    return True
+
+
+def is_stale(latest):
+    """Returns whether the last refresh is missing or older than STATS_MAX_AGE."""
+
+    return latest is None or datetime.utcnow() - latest.refreshed_at > timedelta(
+        seconds=settings["max_age"]
+    )
+
+
+def latest_refresh():
+    """Returns the last refresh, starting a new one if it's stale.
+
+    Returns None if the statistics have never been computed and are being
+    computed in the background."""
+
+    latest = StatsRefresh.query.order_by(StatsRefresh.id.desc()).first()
+
+    if not is_stale(latest):
+        return latest
+
+    if settings["refresh"] == "inline":
+        refresh()
+        return StatsRefresh.query.order_by(StatsRefresh.id.desc()).first()
+
+    start_refresher()
+    return latest
+
+
+def start_refresher():
+    """Starts a refresher process, unless this process started one recently."""
+
+    now = time.monotonic()
+
+    with _lock:
+        if now - _state["spawned_at"] < settings["spawn_interval"]:
+            return
+        _state["spawned_at"] = now
+
+    subprocess.Popen(
+        [sys.executable, "-m", "stats"],
+        cwd=os.path.dirname(os.path.abspath(__file__)),
+        stdin=subprocess.DEVNULL,
+    )
+
+
+def top_songs(limit):
+    """Returns the songs used in the most setlist entries."""
+
+    return (
+        SongUsageStats.query.order_by(
+            SongUsageStats.use_count.desc(), SongUsageStats.canonical_id
+        )
+        .limit(limit)
+        .all()
+    )
+
+
+def top_artists(limit):
+    """Returns the artists whose songs are used in the most setlist entries."""
+
+    return (
+        ArtistUsageStats.query.order_by(
+            ArtistUsageStats.use_count.desc(), ArtistUsageStats.artist_key
+        )
+        .limit(limit)
+        .all()
+    )
+
+
+def largest_catalogs(limit):
+    """Returns the stats of the users with the most songs, with the users."""
+
+    return (
+        UserStats.query.options(joinedload(UserStats.user))
+        .order_by(UserStats.song_count.desc(), UserStats.user_id)
+        .limit(limit)
+        .all()
+    )
+
+
+@click.command("refresh-stats")
+@with_appcontext
+def refresh_stats_command():
+    """Recomputes the statistics summary tables."""
+
+    if refresh():
+        click.echo("Statistics refreshed.")
+    else:
+        click.echo("Statistics were being refreshed by another process.")
+
+
+def init_stats(app):
+    """Sets up statistics refreshes for the Flask app."""
+
+    in_memory = app.config["SQLALCHEMY_DATABASE_URI"] in (
+        "sqlite://",
+        "sqlite:///:memory:",
+    )
+
+    settings["max_age"] = app.config.get("STATS_MAX_AGE", 300)
+    # A refresher process can't see an in-memory database.
+    settings["refresh"] = (
+        "inline" if in_memory else app.config.get("STATS_REFRESH", "background")
+    )
+    app.cli.add_command(refresh_stats_command)
+
+
+if __name__ == "__main__":
+    # A refresher process, started by start_refresher. This file runs as
+    # __main__, so use the stats module the app has set up.
+    from app import app
+    from stats import is_stale, refresh
+
+    with app.app_context():
+        # Another worker's refresher may have got there first.
+        if is_stale(StatsRefresh.query.order_by(StatsRefresh.id.desc()).first()):
+            refresh()
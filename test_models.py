@@ -1,17 +1,83 @@
 """Tests of the models for the Setlist Manager app."""
 
 import os
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import zlib
 from unittest import TestCase
 from sqlalchemy.exc import IntegrityError
 
-from models import db, Song, Setlist, SetlistSong, User
-
-os.environ["DATABASE_URL"] = "postgresql:///setlist-manager-test"
+from models import (
+    db,
+    Song,
+    Setlist,
+    SetlistSong,
+    User,
+    SongLyrics,
+    CanonicalSong,
+    CanonicalLyrics,
+    lyrics_settings,
+    normalize_key,
+    ORDER_GAP,
+    key_between,
+    song_list_ops,
+    text_delta,
+    apply_text_delta,
+)
+from migrations import MIGRATIONS, run_migrations
+
+# Tests run on an in-memory SQLite database unless TEST_DATABASE_URL is set
+# (e.g. to postgresql:///setlist-manager-test).
+os.environ["DATABASE_URL"] = os.environ.get("TEST_DATABASE_URL", "sqlite://")
+os.environ["BCRYPT_LOG_ROUNDS"] = "4"
 
 from app import app
 
 db.create_all()
 
+# The schema the app had before it had migrations, as SQLite created it.
+BASELINE_SCHEMA = """
+CREATE TABLE users (
+    id INTEGER NOT NULL,
+    email TEXT NOT NULL,
+    username TEXT NOT NULL,
+    password TEXT NOT NULL,
+    darkmode BOOLEAN NOT NULL,
+    PRIMARY KEY (id),
+    UNIQUE (email),
+    UNIQUE (username),
+    CHECK (darkmode IN (0, 1))
+);
+CREATE TABLE songs (
+    id INTEGER NOT NULL,
+    user_id INTEGER,
+    title TEXT NOT NULL,
+    artist TEXT NOT NULL,
+    lyrics TEXT,
+    PRIMARY KEY (id),
+    FOREIGN KEY(user_id) REFERENCES users (id) ON DELETE SET NULL
+);
+CREATE TABLE setlists (
+    id INTEGER NOT NULL,
+    user_id INTEGER NOT NULL,
+    name TEXT NOT NULL,
+    notes TEXT,
+    PRIMARY KEY (id),
+    FOREIGN KEY(user_id) REFERENCES users (id) ON DELETE CASCADE
+);
+CREATE TABLE setlists_songs (
+    id INTEGER NOT NULL,
+    setlist_id INTEGER NOT NULL,
+    song_id INTEGER NOT NULL,
+    "index" INTEGER NOT NULL,
+    PRIMARY KEY (id),
+    FOREIGN KEY(setlist_id) REFERENCES setlists (id) ON DELETE CASCADE,
+    FOREIGN KEY(song_id) REFERENCES songs (id) ON DELETE CASCADE
+);
+"""
+
 
 class SetlistManagerModelTestCase(TestCase):
     """Tests for the app's models."""
@@ -24,6 +90,7 @@ class SetlistManagerModelTestCase(TestCase):
             db.session.delete(u)
         SetlistSong.query.delete()
         Song.query.delete()
+        CanonicalSong.query.delete()
         Setlist.query.delete()
         db.session.commit()
 
@@ -181,6 +248,110 @@ class SetlistManagerModelTestCase(TestCase):
 
         self.assertEqual(repr(s), f"<Song {s.id}: Song Title by Test Artist>")
 
+    def test_song_lyrics_storage(self):
+        """Are lyrics stored once per song, compressed when they're long?"""
+
+        u = User(
+            username="testuser", email="testuser@email.com", password="HASHED_PASSWORD"
+        )
+        db.session.add(u)
+        db.session.commit()
+
+        lyrics = "Never gonna give you up\n" * 50
+        lyrics_settings["compress_over"] = 100
+
+        try:
+            s = Song(user_id=u.id, title="Song Title", artist="Artist", lyrics=lyrics)
+            db.session.add(s)
+            db.session.commit()
+            song_id, canonical_id = s.id, s.canonical_id
+        finally:
+            lyrics_settings["compress_over"] = None
+
+        db.session.expunge_all()
+        row = CanonicalLyrics.query.get(canonical_id)
+
+        self.assertIsNone(SongLyrics.query.get(song_id))
+        self.assertIsNone(row.text)
+        self.assertLess(len(row.compressed), len(lyrics))
+        self.assertEqual(row.length, len(lyrics))
+        self.assertEqual(Song.query.get(song_id).lyrics, lyrics)
+
+        song = Song.query.get(song_id)
+        song.lyrics = "Short"
+        db.session.commit()
+
+        self.assertEqual(SongLyrics.query.get(song_id).text, "Short")
+        self.assertIsNone(SongLyrics.query.get(song_id).compressed)
+        self.assertEqual(Song.query.get(song_id).lyrics, "Short")
+
+        song.lyrics = None
+        db.session.commit()
+
+        self.assertIsNone(SongLyrics.query.get(song_id))
+        self.assertIsNone(Song.query.get(song_id).lyrics)
+        self.assertEqual(CanonicalLyrics.query.get(canonical_id).read(), lyrics)
+
+    def test_canonical_songs(self):
+        """Do users' copies of a song share one canonical song and its lyrics?"""
+
+        u1 = User(username="user1", email="user1@email.com", password="HASHED")
+        u2 = User(username="user2", email="user2@email.com", password="HASHED")
+        db.session.add_all([u1, u2])
+        db.session.commit()
+
+        s1 = Song(user_id=u1.id, title="Don't Stop", artist="Fleetwood Mac")
+        s2 = Song(
+            user_id=u2.id,
+            title="dont  stop",
+            artist="FLEETWOOD MAC",
+            lyrics="Don't stop thinking about tomorrow",
+        )
+        s3 = Song(user_id=u2.id, title="Dreams", artist="Fleetwood Mac")
+        db.session.add_all([s1, s2, s3])
+        db.session.commit()
+
+        self.assertEqual(normalize_key("Dón't  Stop!"), "dont stop")
+        self.assertEqual(s1.canonical_id, s2.canonical_id)
+        self.assertNotEqual(s1.canonical_id, s3.canonical_id)
+        self.assertEqual(CanonicalSong.query.count(), 2)
+        self.assertEqual(s1.canonical.title, "Don't Stop")
+
+        # s1 has no lyrics, and doesn't get the ones u2 gave s2.
+        self.assertIsNone(s1.lyrics)
+        self.assertTrue(s2.shares_lyrics)
+        self.assertEqual(SongLyrics.query.count(), 0)
+
+        s1.lyrics = "Don't stop thinking about tomorrow"
+        db.session.commit()
+
+        self.assertTrue(s1.shares_lyrics)
+        self.assertEqual(SongLyrics.query.count(), 0)
+
+        s1.lyrics = "Don't stop, it'll soon be here"
+        db.session.commit()
+
+        self.assertFalse(s1.shares_lyrics)
+        self.assertEqual(SongLyrics.query.count(), 1)
+        self.assertEqual(s2.lyrics, "Don't stop thinking about tomorrow")
+
+        db.session.delete(s3)
+        CanonicalSong.prune([s3.canonical_id, s1.canonical_id])
+        db.session.commit()
+
+        self.assertEqual(CanonicalSong.query.count(), 1)
+
+        with self.assertRaises(IntegrityError):
+            db.session.add(
+                CanonicalSong(
+                    title="Don't stop",
+                    artist="Fleetwood Mac",
+                    title_key="dont stop",
+                    artist_key="fleetwood mac",
+                )
+            )
+            db.session.commit()
+
     # Setlist model #############################################
 
     def test_setlist_model(self):
@@ -240,3 +411,238 @@ class SetlistManagerModelTestCase(TestCase):
         self.assertEqual(len(sl.songs), 1)
         self.assertEqual(len(sl.setlist_songs), 1)
         self.assertEqual(sl.setlist_songs[0].id, ss.id)
+
+    def test_key_between(self):
+        """Are ordering keys placed between their neighbours when there's room?"""
+
+        self.assertEqual(key_between(None, None), ORDER_GAP)
+        self.assertEqual(key_between(None, ORDER_GAP), 0)
+        self.assertEqual(key_between(ORDER_GAP, None), 2 * ORDER_GAP)
+        self.assertEqual(key_between(0, ORDER_GAP), ORDER_GAP // 2)
+        self.assertIsNone(key_between(4, 5))
+        self.assertIsNone(key_between((1 << 31) - 1, None))
+
+    def test_setlist_renumbered_when_keys_run_out(self):
+        """Is a setlist renumbered when a move has no gap to land in?"""
+
+        u = User(
+            username="testuser", email="testuser@email.com", password="HASHED_PASSWORD"
+        )
+        db.session.add(u)
+        db.session.commit()
+
+        songs = [Song(user_id=u.id, title=f"Song {n}", artist="Artist") for n in "ABC"]
+        sl = Setlist(user_id=u.id, name="Test Setlist")
+        db.session.add_all(songs + [sl])
+        db.session.commit()
+
+        for index, song in enumerate(songs):
+            db.session.add(SetlistSong(setlist_id=sl.id, song_id=song.id, index=index))
+        db.session.commit()
+
+        sl.apply_song_ops([{"op": "move", "from": 2, "to": 1}])
+        db.session.commit()
+
+        self.assertEqual([s.title for s in sl.songs], ["Song A", "Song C", "Song B"])
+        self.assertEqual(
+            [ss.index for ss in sorted(sl.setlist_songs, key=lambda ss: ss.index)],
+            [ORDER_GAP, 2 * ORDER_GAP, 3 * ORDER_GAP],
+        )
+
+    def test_song_list_ops(self):
+        """Are song order changes described with as few operations as possible?"""
+
+        self.assertEqual(song_list_ops([1, 2, 3], [1, 2, 3]), [])
+        self.assertEqual(
+            song_list_ops([1, 2, 3, 4], [2, 3, 4, 1]),
+            [{"op": "move", "from": 0, "to": 3}],
+        )
+        self.assertEqual(
+            song_list_ops([1, 2, 3], [3, 5, 1]),
+            [
+                {"op": "remove", "index": 1},
+                {"op": "insert", "song_id": 5, "index": 2},
+                {"op": "move", "from": 0, "to": 2},
+            ],
+        )
+
+    def test_text_delta(self):
+        """Does text_delta produce the splice apply_text_delta undoes it with?"""
+
+        self.assertEqual(text_delta("Encore", "Encore"), [])
+        self.assertEqual(
+            text_delta("Encore: no", "Encore: yes"),
+            [{"start": 8, "end": 10, "text": "yes"}],
+        )
+        self.assertEqual(
+            apply_text_delta("Tune to D♭", text_delta("Tune to D♭", "Tune to E♭")),
+            "Tune to E♭",
+        )
+
+    # Migrations ################################################
+
+    def test_new_database_is_migrated(self):
+        """Is a database created from the models already fully migrated?"""
+
+        self.assertEqual(run_migrations(), [])
+
+
+class MigrationTestCase(TestCase):
+    """Tests of upgrading a database from the baseline schema."""
+
+    def migrate(self, rows, **env):
+        """Runs `flask migrate` on a baseline SQLite database holding rows.
+
+        Returns a connection to the migrated database."""
+
+        path = os.path.join(tempfile.mkdtemp(), "baseline.db")
+
+        with sqlite3.connect(path) as connection:
+            connection.executescript(BASELINE_SCHEMA + rows)
+        connection.close()
+
+        result = subprocess.run(
+            [sys.executable, "-m", "flask", "migrate"],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            env=dict(
+                os.environ,
+                FLASK_APP="app",
+                DATABASE_URL=f"sqlite:///{path}",
+                LIVE_SYNC_BROKER="memory",
+                CATALOG_PATH="",
+                **env,
+            ),
+            capture_output=True,
+            text=True,
+        )
+
+        self.assertEqual(result.returncode, 0, result.stderr)
+        self.assertEqual(
+            result.stdout.split(),
+            [word for name, _ in MIGRATIONS for word in ("Applied", name)],
+        )
+
+        connection = sqlite3.connect(path)
+        self.addCleanup(connection.close)
+        return connection
+
+    def test_baseline_database_is_migrated(self):
+        """Does every migration apply to a baseline database with data in it?"""
+
+        connection = self.migrate("""
+            INSERT INTO users VALUES (1, 'a@test.com', 'alice', 'HASHED', 0);
+            INSERT INTO songs VALUES
+                (1, 1, 'Dreams', 'Fleetwood Mac', 'Thunder only happens'),
+                (2, 1, 'Landslide', 'Fleetwood Mac', 'I took my love');
+            INSERT INTO setlists VALUES (1, 1, 'Gig', NULL), (2, 1, 'Empty', NULL);
+            INSERT INTO setlists_songs VALUES (1, 1, 2, 0), (2, 1, 1, 1);
+            """)
+
+        self.assertEqual(
+            connection.execute(
+                "SELECT id, song_count, first_song_id, lyrics_length, version "
+                "FROM setlists ORDER BY id"
+            ).fetchall(),
+            [
+                (1, 2, 2, len("Thunder only happens") + len("I took my love"), 0),
+                (2, 0, None, 0, 0),
+            ],
+        )
+
+    def test_setlist_song_order_is_gapped(self):
+        """Do old 0..n-1 setlist positions become gapped keys in the same order?"""
+
+        connection = self.migrate("""
+            INSERT INTO users VALUES (1, 'a@test.com', 'alice', 'HASHED', 0);
+            INSERT INTO songs VALUES
+                (1, 1, 'Song A', 'Artist', NULL),
+                (2, 1, 'Song B', 'Artist', NULL),
+                (3, 1, 'Song C', 'Artist', NULL);
+            INSERT INTO setlists VALUES (1, 1, 'Gig', NULL), (2, 1, 'Encore', NULL);
+            INSERT INTO setlists_songs VALUES
+                (1, 1, 1, 2), (2, 1, 2, 0), (3, 1, 3, 1), (4, 2, 1, 0);
+            """)
+
+        self.assertEqual(
+            connection.execute(
+                'SELECT setlist_id, song_id, "index" FROM setlists_songs '
+                'ORDER BY setlist_id, "index"'
+            ).fetchall(),
+            [
+                (1, 2, 1 * ORDER_GAP),
+                (1, 3, 2 * ORDER_GAP),
+                (1, 1, 3 * ORDER_GAP),
+                (2, 1, 1 * ORDER_GAP),
+            ],
+        )
+        self.assertIn(
+            "ix_setlists_songs_setlist_id_index",
+            [
+                name
+                for (name,) in connection.execute(
+                    "SELECT name FROM sqlite_master WHERE type = 'index'"
+                )
+            ],
+        )
+
+    def test_duplicate_songs_share_matching_lyrics(self):
+        """Are duplicate songs merged, sharing only the lyrics they had in common?"""
+
+        connection = self.migrate("""
+            INSERT INTO users VALUES
+                (1, 'a@test.com', 'alice', 'HASHED', 0),
+                (2, 'b@test.com', 'bob', 'HASHED', 0),
+                (3, 'c@test.com', 'carol', 'HASHED', 0),
+                (4, 'd@test.com', 'dave', 'HASHED', 0);
+            INSERT INTO songs VALUES
+                (1, 1, 'Dreams', 'Fleetwood Mac', 'Thunder only happens'),
+                (2, 2, 'dreams', 'FLEETWOOD MAC', 'Thunder only happens'),
+                (3, 3, 'Dreams!', 'fleetwood mac', NULL),
+                (4, 4, 'DREAMS', 'Fleetwood Mac', 'Players only love you'),
+                (5, 1, 'Landslide', 'Fleetwood Mac', 'I took my love');
+            """)
+
+        songs = connection.execute(
+            "SELECT id, canonical_id, shares_lyrics FROM songs ORDER BY id"
+        ).fetchall()
+        dreams = songs[0][1]
+
+        self.assertEqual(
+            [canonical_id for _, canonical_id, _ in songs[:4]], [dreams] * 4
+        )
+        self.assertNotEqual(songs[4][1], dreams)
+        self.assertEqual([shares for _, _, shares in songs], [1, 1, 0, 0, 1])
+        self.assertEqual(
+            connection.execute(
+                "SELECT text FROM canonical_lyrics WHERE canonical_id = ?", (dreams,)
+            ).fetchall(),
+            [("Thunder only happens",)],
+        )
+        self.assertEqual(
+            connection.execute("SELECT song_id, text FROM song_lyrics").fetchall(),
+            [(4, "Players only love you")],
+        )
+
+    def test_shared_lyrics_are_compressed(self):
+        """Are long shared lyrics stored compressed, as LYRICS_COMPRESS_OVER says?"""
+
+        lyrics = "Thunder only happens when it is raining\n" * 5
+        connection = self.migrate(
+            f"""
+            INSERT INTO users VALUES (1, 'a@test.com', 'alice', 'HASHED', 0);
+            INSERT INTO songs VALUES
+                (1, 1, 'Dreams', 'Fleetwood Mac', '{lyrics}'),
+                (2, 1, 'Landslide', 'Fleetwood Mac', 'I took my love');
+            """,
+            LYRICS_COMPRESS_OVER="100",
+        )
+
+        rows = connection.execute(
+            "SELECT text, compressed, length FROM canonical_lyrics "
+            "ORDER BY canonical_id"
+        ).fetchall()
+
+        self.assertEqual(rows[0][0], None)
+        self.assertEqual(zlib.decompress(rows[0][1]).decode(), lyrics)
+        self.assertEqual(rows[0][2], len(lyrics))
+        self.assertEqual(rows[1], ("I took my love", None, len("I took my love")))